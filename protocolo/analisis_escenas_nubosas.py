@@ -3,11 +3,15 @@
 # ============================================================================
 
 import os
+import sys
 import glob
 from pymongo import MongoClient
 import pandas as pd
 import matplotlib.pyplot as plt
 
+sys.path.append('/root/git/ProtocoloV2/protocolo')
+from manifest import bandas_normalizadas
+
 # Configuración de MongoDB
 client = MongoClient()
 database = client.Satelites
@@ -38,7 +42,7 @@ def verificar_normalizacion_completa(escena_name, ruta_nor):
         }
     
     # Buscar archivos normalizados
-    archivos_norm = glob.glob(os.path.join(ruta_completa, '*_grn2_*.tif'))
+    archivos_norm = bandas_normalizadas(ruta_completa)
     archivos_total = glob.glob(os.path.join(ruta_completa, '*.tif'))
     
     return {
@@ -0,0 +1,58 @@
+import os
+from pymongo import MongoClient
+
+
+
+# Un MongoClient por proceso: PyMongo no admite usar tras un fork el cliente creado en el padre
+_clientes = {}
+
+
+def cliente():
+
+    """Devuelve el MongoClient del proceso actual, creándolo en el primer uso.
+
+    Los workers de los ProcessPoolExecutor (teselas en download.py, bandas en
+    Landsat.normalize) heredan por fork las variables del módulo, así que el cliente
+    se indexa por pid y cada proceso abre el suyo en lugar de reutilizar el del padre.
+
+    Returns:
+        pymongo.MongoClient: Cliente de este proceso.
+    """
+
+    pid = os.getpid()
+    if pid not in _clientes:
+        _clientes.clear()
+        _clientes[pid] = MongoClient()
+    return _clientes[pid]
+
+
+class Perezosa:
+
+    """Base de datos o colección de MongoDB que se resuelve en cada acceso con `cliente()`.
+
+    Sustituye a las variables de módulo `database = client.Satelites` y
+    `db = database.Landsat`, de modo que importar un módulo no abre ninguna conexión.
+
+    Args:
+        *ruta (str): Nombre de la base de datos y, opcionalmente, de la colección.
+    """
+
+    def __init__(self, *ruta):
+        self._ruta = ruta
+
+    def _resolver(self):
+        objeto = cliente()
+        for nombre in self._ruta:
+            objeto = objeto[nombre]
+        return objeto
+
+    def __getattr__(self, nombre):
+        if nombre.startswith('__') or nombre == '_ruta':
+            raise AttributeError(nombre)
+        return getattr(self._resolver(), nombre)
+
+    def __getitem__(self, nombre):
+        return self._resolver()[nombre]
+
+    def __repr__(self):
+        return 'Perezosa({})'.format('.'.join(self._ruta))
@@ -43,6 +43,12 @@ GEONETWORK_USERNAME = os.getenv('GEONETWORK_USERNAME')
 GEONETWORK_PASSWORD = os.getenv('GEONETWORK_PASSWORD')
 GEONETWORK_SERVER = os.getenv('GEONETWORK_SERVER', 'https://goyas.csic.es/geonetwork')
 
+# Cloud triage of new scenes (estimated cloud % in PN/RBIOS from a decimated QA_PIXEL read)
+# <= TRIAJE_NUBES_COMPLETO: full pipeline; <= TRIAJE_NUBES_REDUCIDO: clouds and normalization only;
+# above: the scene goes to the deferred queue
+TRIAJE_NUBES_COMPLETO = float(os.getenv('TRIAJE_NUBES_COMPLETO', '60'))
+TRIAJE_NUBES_REDUCIDO = float(os.getenv('TRIAJE_NUBES_REDUCIDO', '90'))
+
 # Validation: Check if critical variables are loaded
 def validate_config():
     """Validate that critical environment variables are loaded."""
@@ -0,0 +1,80 @@
+import os
+import sys
+import glob
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
+
+
+
+def dibujar_diagnostico(ruta_npz, salida=None):
+
+    """Dibuja el diagnóstico de normalización de una banda a partir de su fichero `_diag.npz`.
+
+    El fichero lo genera `Landsat.normalize(diagnosticos='histograma')` y contiene los
+    histogramas 2D de las muestras de PIAs antes y después del filtrado de residuos,
+    junto con los parámetros de las dos regresiones.
+
+    Args:
+        ruta_npz (str): Ruta al fichero `_diag.npz`.
+        salida (str, optional): Ruta del PNG de salida. Por defecto se guarda junto al
+            npz con el mismo nombre que generaba el modo gráfico.
+
+    Returns:
+        str: Ruta del PNG generado.
+    """
+
+    if salida is None:
+        salida = ruta_npz.replace('_diag.npz', '.png')
+
+    with np.load(ruta_npz) as diag:
+        bordes = diag['bordes']
+        paneles = [
+            (diag['antes'], float(diag['first_slope']), float(diag['first_intercept']), 'Greens', 'Regresion PIAs'),
+            (diag['despues'], float(diag['slope']), float(diag['intercept']), 'Blues', 'Regresion PIAs-STD'),
+        ]
+        titulo = str(diag['titulo'])
+
+    fig, axes = plt.subplots(1, 2, figsize=(15, 10))
+    xs = np.array([bordes[0], bordes[-1]])
+
+    for ax, (conteo, slope, intercept, cmap, nombre) in zip(axes, paneles):
+        conteo = np.ma.masked_equal(conteo.T, 0)
+        if conteo.count():
+            ax.pcolormesh(bordes, bordes, conteo, cmap=cmap, norm=LogNorm())
+        ax.plot(xs, xs * slope + intercept, color='grey', label="y={0:.5f}x+{1:.5f}".format(slope, intercept))
+        ax.set_xlim((0, 1))
+        ax.set_ylim((0, 1))
+        ax.set_title(nombre)
+        ax.legend()
+
+    fig.suptitle(titulo, fontsize=15, weight='bold')
+    plt.savefig(salida)
+    plt.close(fig)
+
+    return salida
+
+
+def dibujar_diagnosticos(ruta_nor):
+
+    """Dibuja todos los diagnósticos de normalización pendientes de una escena.
+
+    Args:
+        ruta_nor (str): Ruta a la carpeta `nor` de la escena.
+
+    Returns:
+        list: Rutas de los PNG generados.
+    """
+
+    salidas = []
+    for ruta_npz in sorted(glob.glob(os.path.join(ruta_nor, '*_diag.npz'))):
+        salidas.append(dibujar_diagnostico(ruta_npz))
+        print(f'Diagnóstico dibujado: {salidas[-1]}')
+
+    return salidas
+
+
+if __name__ == "__main__":
+    # Uso: python diagnosticos.py /mnt/datos_last/nor/20240115l9oli202_34 [...]
+    for ruta in sys.argv[1:]:
+        dibujar_diagnosticos(ruta)
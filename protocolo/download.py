@@ -3,7 +3,8 @@ import sys
 import tarfile
 import datetime
 import requests
-from pymongo import MongoClient
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from usgs import api
 
 # Añadir ruta al código personalizado
@@ -14,6 +15,9 @@ from productos import Product
 from coast import Coast
 from utils import enviar_correo, enviar_notificacion_finalizada
 from config import USGS_USERNAME, USGS_PASSWORD, EMAIL_RECIPIENTS, validate_config
+from config import TRIAJE_NUBES_COMPLETO, TRIAJE_NUBES_REDUCIDO
+from teselas import TESELAS, TESELA_PRINCIPAL
+from conexion import Perezosa
 
 # --- FUNCIÓN PARA LOGIN USGS CON LOGOUT AUTOMÁTICO ---
 def get_usgs_api_key(usuario, password):
@@ -37,15 +41,123 @@ password = USGS_PASSWORD
 api_key = get_usgs_api_key(usuario, password)
 
 # --- CONEXIÓN BASE DE DATOS ---
-client = MongoClient()
-database = client.Satelites
-db = database.Landsat
+# Cada proceso abre su propio cliente en el primer acceso (ver conexion.py)
+database = Perezosa('Satelites')
+db = Perezosa('Satelites', 'Landsat')
+diferidas = Perezosa('Satelites', 'Diferidas')
+
+
+# --- TRIAJE DE NUBES ---
+def triaje_escena(landsat, umbral_completo=TRIAJE_NUBES_COMPLETO, umbral_reducido=TRIAJE_NUBES_REDUCIDO):
+    """
+    Decide cómo procesar una escena a partir de una lectura diezmada de QA_PIXEL.
+
+    Se usa la menor cobertura de nubes estimada entre PN y RBIOS: si cualquiera de las
+    dos zonas es aprovechable la escena se procesa.
+
+    Returns:
+        tuple: Modo ('completo', 'reducido' o 'diferido') y coberturas estimadas.
+    """
+    coberturas = landsat.triaje_nubes()
+    validas = [v for v in coberturas.values() if v is not None]
+    nubes = min(validas) if validas else 100
+
+    if nubes <= umbral_completo:
+        modo = 'completo'
+    elif nubes <= umbral_reducido:
+        modo = 'reducido'
+    else:
+        modo = 'diferido'
+
+    print(f"  ☁️  Triaje: {nubes}% de nubes estimado -> {modo}")
+    return modo, coberturas
+
+
+def procesar_escena(sc_dest, display_id, reducido=False, landsat=None, n_workers=None, tar=None,
+                    gapfill_recortado=False):
+    """
+    Ejecuta Landsat.run y, salvo en modo reducido, Product.run, y envía la notificación.
+
+    Con `tar` las bandas se leen directamente del archivo descargado (sin extraer).
+    `gapfill_recortado` se pasa a Landsat.run (gapfill de Landsat 7 solo en la ventana de estudio).
+    """
+    quicklook = None
+    try:
+        if landsat is None:
+            landsat = Landsat(sc_dest, tar=tar)
+        quicklook = landsat.qk_name
+
+        landsat.run(reducido=reducido, n_workers=n_workers, gapfill_recortado=gapfill_recortado)
+
+        info_escena = {
+            'escena': landsat.last_name,
+            'nubes_escena': landsat.newesc['Clouds']['cloud_scene'],
+            'nubes_land': landsat.newesc['Clouds']['land cloud cover'],
+            'nubes_Doñana': landsat.pn_cover,
+            'bandas_normalizadas': landsat.bandas_normalizadas
+        }
+
+        print(f"🖼️ Quicklook generado: {quicklook}")
+
+        if reducido:
+            # Escena muy nubosa: solo nubes y normalización, sin productos
+            print(f"⏭️  Pipeline reducido: no se generan productos para {display_id}")
+            info_escena['productos_generados'] = []
+        else:
+            landsatp = Product(landsat.nor_escena)
+            landsatp.run()
+            info_escena['productos_generados'] = landsatp.productos_generados
+
+        enviar_notificacion_finalizada(info_escena, archivo_adjunto=quicklook)
+
+    except Exception as e:
+        print(f"❌ Error procesando escena {display_id}: {e}")
+        try:
+            enviar_notificacion_finalizada({"escena": display_id}, archivo_adjunto=quicklook)
+        except Exception as notif_error:
+            print(f"⚠️ No se pudo enviar notificación: {notif_error}")
+
+
+def procesar_diferidas(reducido=False, gapfill_recortado=False):
+    """
+    Procesa las escenas de la cola de diferidas y las saca de la cola.
+
+    Args:
+        reducido (bool): Procesarlas con el pipeline reducido (nubes y normalización).
+        gapfill_recortado (bool): Gapfill de Landsat 7 solo en la ventana de estudio.
+    """
+    for doc in list(diferidas.find()):
+        print(f"\n🚀 Procesando escena diferida: {doc['_id']}")
+        if not os.path.exists(doc['ruta']):
+            print(f"⚠️ No existe {doc['ruta']}, se elimina de la cola")
+        else:
+            procesar_escena(doc['ruta'], doc['_id'], reducido=reducido, tar=doc.get('tar'),
+                            gapfill_recortado=gapfill_recortado)
+        diferidas.delete_one({'_id': doc['_id']})
+
 
 # --- FUNCIÓN PRINCIPAL DE DESCARGA ---
 def download_landsat_scenes(latitude, longitude, days_back=15, end_date=None,
                              process=True, max_cloud_cover=100,
                              output_dir='/mnt/datos_last/ori/rar',
-                             reprocess=False):
+                             reprocess=False, triaje=False,
+                             umbral_completo=TRIAJE_NUBES_COMPLETO,
+                             umbral_reducido=TRIAJE_NUBES_REDUCIDO,
+                             teselas=(TESELA_PRINCIPAL,), n_workers=None, extraer=True,
+                             gapfill_recortado=False):
+    """
+    Busca, descarga y procesa las escenas nuevas de las teselas indicadas.
+
+    Las teselas (path_row, ver teselas.TESELAS) se procesan en paralelo, una por proceso,
+    y las escenas de cada tesela en orden; `n_workers` es el pool de cada tesela en
+    Landsat.run. Con `extraer=False` el tar no se extrae y Landsat lee las bandas y el
+    MTL del propio archivo a través de /vsitar/. Con `gapfill_recortado=True` el gapfill de
+    Landsat 7 se limita a la ventana de estudio (ver Landsat.apply_gapfill).
+
+    Con `triaje=True` las escenas por encima de `umbral_reducido` van a la cola de
+    diferidas y no se vuelven a descargar; se procesan llamando a `procesar_diferidas()`.
+    Sin triaje (por defecto) las escenas que sigan en la cola se tratan como nuevas.
+    """
 
     hoy = datetime.date.today() if end_date is None else datetime.date.fromisoformat(end_date)
     inicio = hoy - datetime.timedelta(days=days_back)
@@ -80,8 +192,8 @@ def download_landsat_scenes(latitude, longitude, days_back=15, end_date=None,
             path = path_row[:3]
             row = path_row[-2:]
             
-            # FILTRO CRÍTICO: Solo path 202 y row 34
-            if path != "202" or row != "34":
+            # FILTRO CRÍTICO: Solo las teselas configuradas (por defecto path 202 y row 34)
+            if f"{path}_{row}" not in teselas or f"{path}_{row}" not in TESELAS:
                 escenas_filtradas_path += 1
                 print(f"  ⏭️  Ignorando {display_id} (path/row: {path}/{row})")
                 continue
@@ -98,10 +210,14 @@ def download_landsat_scenes(latitude, longitude, days_back=15, end_date=None,
             print(f"  🔎 Chequeando en MongoDB si existe: {last_name}")
 
             escena_en_db = db.find_one({'_id': last_name})
+            en_cola = triaje and diferidas.find_one({'_id': display_id})
 
-            if not escena_en_db or reprocess:
+            if not (escena_en_db or en_cola) or reprocess:
                 escenas_nuevas.append(escena)
                 print(f"  ⭐ Nueva escena para procesar!")
+            elif en_cola and not escena_en_db:
+                escenas_ya_procesadas += 1
+                print(f"  🕒 En la cola de diferidas (procesar con procesar_diferidas())")
             else:
                 escenas_ya_procesadas += 1
                 print(f"  ✔️  Ya procesada previamente")
@@ -125,93 +241,127 @@ def download_landsat_scenes(latitude, longitude, days_back=15, end_date=None,
         )
         return
 
+    # Agrupamos por tesela: cada una se procesa en su propio proceso
+    por_tesela = {}
     for escena in escenas_nuevas:
-        display_id = escena["displayId"]
-        entity_id = escena["entityId"]
-        mail = 0
-        quicklook = None
+        path_row = escena['displayId'].split('_')[2]
+        por_tesela.setdefault(f"{path_row[:3]}_{path_row[-2:]}", []).append(escena)
 
-        print(f"\n🚀 Procesando escena: {display_id}")
+    procesar = partial(procesar_tesela, output_dir=output_dir, triaje=triaje, umbral_completo=umbral_completo,
+                       umbral_reducido=umbral_reducido, n_workers=n_workers, extraer=extraer,
+                       gapfill_recortado=gapfill_recortado)
 
-        opciones = api.download_options(
-            dataset="landsat_ot_c2_l2",
-            entity_ids=[entity_id],
-            api_key=api_key
-        )
+    if len(por_tesela) > 1:
+        print(f"🧩 Procesando {len(por_tesela)} teselas en paralelo: {', '.join(sorted(por_tesela))}")
+        with ProcessPoolExecutor(max_workers=len(por_tesela)) as executor:
+            list(executor.map(procesar, por_tesela.values()))
+    else:
+        for escenas_tesela in por_tesela.values():
+            procesar(escenas_tesela)
 
-        producto = next(
-            (p for p in opciones["data"] if p.get("productName") == "Landsat Collection 2 Level-2 Product Bundle" and p.get("available")),
-            None
-        )
 
-        if not producto:
-            print(f"❌ No se puede descargar {display_id}")
-            continue
+def procesar_tesela(escenas, output_dir, triaje=False, umbral_completo=TRIAJE_NUBES_COMPLETO,
+                    umbral_reducido=TRIAJE_NUBES_REDUCIDO, n_workers=None, extraer=True, gapfill_recortado=False):
+    """
+    Descarga y procesa en orden las escenas nuevas de una tesela.
+    """
+    for escena in escenas:
+        descargar_escena(escena, output_dir, triaje, umbral_completo, umbral_reducido, n_workers, extraer,
+                         gapfill_recortado)
 
-        download_info = api.download_request(
-            dataset="landsat_ot_c2_l2",
-            entity_id=entity_id,
-            product_id=producto["id"],
-            api_key=api_key
-        )
 
-        available = download_info.get("data", {}).get("availableDownloads", [])
-        if not available:
-            print(f"⚠️ No hay descargas disponibles para {display_id}")
-            continue
+def descargar_escena(escena, output_dir, triaje=False, umbral_completo=TRIAJE_NUBES_COMPLETO,
+                     umbral_reducido=TRIAJE_NUBES_REDUCIDO, n_workers=None, extraer=True, gapfill_recortado=False):
+    """
+    Descarga, extrae (salvo con `extraer=False`), hace el triaje de nubes y procesa una escena.
+    """
+    display_id = escena["displayId"]
+    entity_id = escena["entityId"]
+    mail = 0
+    quicklook = None
 
-        url = available[0].get("url")
-        nombre_archivo = f"{display_id}.tar"
-        ruta_tar = os.path.join(output_dir, nombre_archivo)
+    print(f"\n🚀 Procesando escena: {display_id}")
 
-        print(f"⬇️ Descargando {nombre_archivo}...")
-        with requests.get(url, stream=True) as r:
-            r.raise_for_status()
-            with open(ruta_tar, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
+    opciones = api.download_options(
+        dataset="landsat_ot_c2_l2",
+        entity_ids=[entity_id],
+        api_key=api_key
+    )
 
-        print(f"✅ Descargado: {ruta_tar}")
+    producto = next(
+        (p for p in opciones["data"] if p.get("productName") == "Landsat Collection 2 Level-2 Product Bundle" and p.get("available")),
+        None
+    )
 
-        sr2 = os.path.split(output_dir)[0]
-        sc_dest = os.path.join(sr2, display_id)
-        os.makedirs(sc_dest, exist_ok=True)
+    if not producto:
+        print(f"❌ No se puede descargar {display_id}")
+        return
 
-        try:
-            print(f"📦 Extrayendo {nombre_archivo} a {sc_dest}")
-            with tarfile.open(ruta_tar) as tar:
-                tar.extractall(sc_dest)
+    download_info = api.download_request(
+        dataset="landsat_ot_c2_l2",
+        entity_id=entity_id,
+        product_id=producto["id"],
+        api_key=api_key
+    )
 
-            landsat = Landsat(sc_dest)
-            quicklook = landsat.qk_name
+    available = download_info.get("data", {}).get("availableDownloads", [])
+    if not available:
+        print(f"⚠️ No hay descargas disponibles para {display_id}")
+        return
 
-            landsat.run()
+    url = available[0].get("url")
+    nombre_archivo = f"{display_id}.tar"
+    ruta_tar = os.path.join(output_dir, nombre_archivo)
 
-            info_escena = {
-                'escena': landsat.last_name,
-                'nubes_escena': landsat.newesc['Clouds']['cloud_scene'],
-                'nubes_land': landsat.newesc['Clouds']['land cloud cover'],
-                'nubes_Doñana': landsat.pn_cover,
-                'bandas_normalizadas': landsat.bandas_normalizadas
-            }
+    print(f"⬇️ Descargando {nombre_archivo}...")
+    with requests.get(url, stream=True) as r:
+        r.raise_for_status()
+        with open(ruta_tar, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=8192):
+                f.write(chunk)
 
-            print(f"🖼️ Quicklook generado: {quicklook}")
+    print(f"✅ Descargado: {ruta_tar}")
 
-            landsatp = Product(landsat.nor_escena)
-            landsatp.run()
+    sr2 = os.path.split(output_dir)[0]
+    sc_dest = os.path.join(sr2, display_id)
+    os.makedirs(sc_dest, exist_ok=True)
 
-            info_escena['productos_generados'] = landsatp.productos_generados
+    tar = None if extraer else ruta_tar
 
-            enviar_notificacion_finalizada(info_escena, archivo_adjunto=quicklook)
+    try:
+        if extraer:
+            print(f"📦 Extrayendo {nombre_archivo} a {sc_dest}")
+            with tarfile.open(ruta_tar) as t:
+                t.extractall(sc_dest)
+        else:
+            print(f"📦 Leyendo {nombre_archivo} sin extraer")
+
+        # Sin efectos secundarios hasta saber si la escena merece procesarse
+        landsat = Landsat(sc_dest, perezoso=True, tar=tar)
 
-        except Exception as e:
-            print(f"❌ Error procesando escena {display_id}: {e}")
-            try:
-                enviar_notificacion_finalizada({"escena": display_id}, archivo_adjunto=quicklook)
-            except Exception as notif_error:
-                print(f"⚠️ No se pudo enviar notificación: {notif_error}")
-            continue  
+        modo = 'completo'
+        if triaje:
+            modo, coberturas = triaje_escena(landsat, umbral_completo, umbral_reducido)
+
+    except Exception as e:
+        print(f"❌ Error procesando escena {display_id}: {e}")
+        try:
+            enviar_notificacion_finalizada({"escena": display_id}, archivo_adjunto=quicklook)
+        except Exception as notif_error:
+            print(f"⚠️ No se pudo enviar notificación: {notif_error}")
+        return
+
+    if modo == 'diferido':
+        diferidas.update_one({'_id': display_id}, {'$set': {
+            'ruta': sc_dest, 'tar': tar, 'escena': landsat.last_name, 'triaje': coberturas,
+            'fecha': datetime.datetime.now()}}, upsert=True)
+        print(f"🕒 {display_id} enviada a la cola de diferidas")
+        return
 
+    procesar_escena(sc_dest, display_id, reducido=(modo == 'reducido'), landsat=landsat, n_workers=n_workers, tar=tar,
+                    gapfill_recortado=gapfill_recortado)
+    # Si venía de la cola de diferidas (ejecución anterior con triaje) ya no está pendiente
+    diferidas.delete_one({'_id': display_id})
 
 
 # --- LLAMADA PRINCIPAL ---
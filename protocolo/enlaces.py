@@ -0,0 +1,91 @@
+import os
+import sys
+import shutil
+
+
+
+# Modos de enlace, de más a menos ligero. 'auto' prueba reflink, luego hardlink y por último copia.
+MODOS = ('auto', 'reflink', 'hardlink', 'copia')
+
+# Punto único de control: si es None se usa la variable de entorno MODO_ENLACE (por defecto 'auto')
+MODO = None
+
+# ioctl FICLONE de Linux (btrfs, xfs con reflink=1, ...)
+_FICLONE = 0x40049409
+
+
+def modo_enlace():
+
+    """Devuelve el modo de enlace activo (`MODO` o la variable de entorno `MODO_ENLACE`).
+
+    Raises:
+        ValueError: Si el modo no está en `MODOS`.
+    """
+
+    modo = MODO or os.getenv('MODO_ENLACE', 'auto')
+    if modo not in MODOS:
+        raise ValueError('Modo de enlace {} no válido, debe ser uno de {}'.format(modo, MODOS))
+    return modo
+
+
+def _reflink(src, dst):
+
+    if not sys.platform.startswith('linux'):
+        raise OSError('reflink solo disponible en Linux')
+
+    import fcntl
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def enlazar(src, dst, modo=None):
+
+    """Deja en `dst` el contenido de `src` sin copiar datos cuando el sistema de ficheros lo permite.
+
+    Con reflink los dos ficheros comparten bloques hasta que uno se modifica; con hardlink son
+    el mismo inodo, así que `dst` no debe abrirse para escribir en sitio (todas las etapas
+    escriben ficheros nuevos, nunca en modo 'r+'). Si ninguno es posible (otro volumen, FAT,
+    NFS sin soporte) se hace `shutil.copy2`. Un `dst` existente se sustituye.
+
+    Args:
+        src (str): Fichero de origen.
+        dst (str): Ruta de destino.
+        modo (str, optional): 'auto', 'reflink', 'hardlink' o 'copia'. Por defecto `modo_enlace()`.
+
+    Returns:
+        str: Método usado finalmente ('reflink', 'hardlink', 'copia' o 'existente').
+    """
+
+    modo = modo or modo_enlace()
+
+    if os.path.exists(dst):
+        if os.path.samefile(src, dst):
+            return 'existente'
+        # Nunca se escribe a través de un hardlink previo: se rompe el enlace antes
+        os.remove(dst)
+
+    if modo in ('auto', 'reflink'):
+        try:
+            _reflink(src, dst)
+            return 'reflink'
+        except OSError:
+            if modo == 'reflink':
+                raise
+
+    if modo in ('auto', 'hardlink'):
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError:
+            if modo == 'hardlink':
+                raise
+
+    shutil.copy2(src, dst)
+    return 'copia'
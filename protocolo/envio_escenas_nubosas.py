@@ -12,6 +12,7 @@ from pymongo import MongoClient
 
 # Añadir ruta del código para importar configuración
 sys.path.append('/root/git/ProtocoloV2/protocolo')
+from manifest import bandas_normalizadas
 try:
     from config import SSH_USER, SSH_KEY_PATH, SERVER_HOSTS
 except ImportError:
@@ -49,7 +50,7 @@ def verificar_normalizacion(escena_name, ruta_nor):
         return False
     
     # Buscar archivos .tif (excluyendo fmask y hillshade)
-    archivos_tif = glob.glob(os.path.join(ruta_completa, '*_grn2_*.tif'))
+    archivos_tif = bandas_normalizadas(ruta_completa)
     
     # Debe tener al menos 4 bandas normalizadas
     return len(archivos_tif) >= 4
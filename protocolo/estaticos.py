@@ -0,0 +1,137 @@
+import os
+import sys
+import tempfile
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+
+
+# Capas estáticas de water_mask_pv2 que usa Product.flood (fichero '<capa>_<tesela>.tif')
+CAPAS_FLOOD = ('dtm', 'slope', 'fmask', 'ndwi_p99', 'mndwi_p99', 'cob_veg', 'ndvi_p10', 'ndvi_mean')
+
+# Bits de la máscara de exclusión estática
+EXCLUIDO = 1  # pendiente fuerte sin agua histórica, climatología de NDVI alta o cobertura vegetal > 75
+DTM_ALTO = 2  # DTM > 2.5 m, para la condición de NDVI de la escena
+
+
+def rutas_estaticos(water_masks, tesela):
+
+    """Devuelve las rutas de las capas estáticas de una tesela y de su máscara de exclusión.
+
+    Args:
+        water_masks (str): Carpeta water_mask_pv2.
+        tesela (str): Identificador 'PPP_RR' de la tesela.
+
+    Returns:
+        dict: Ruta de cada capa de `CAPAS_FLOOD` y de la máscara de exclusión (`exclusion`).
+    """
+
+    rutas = {capa: os.path.join(water_masks, '{}_{}.tif'.format(capa, tesela)) for capa in CAPAS_FLOOD}
+    rutas['exclusion'] = os.path.join(water_masks, 'flood_exclusion_{}.tif'.format(tesela))
+    return rutas
+
+
+def _firma(rutas):
+
+    return ';'.join('{}:{}:{}'.format(os.path.split(rutas[capa])[1], os.stat(rutas[capa]).st_size,
+                                      int(os.stat(rutas[capa]).st_mtime)) for capa in CAPAS_FLOOD)
+
+
+def _exclusion_bloque(capas):
+
+    """Calcula la máscara de exclusión estática de un bloque con las mismas reglas que Product.flood."""
+
+    excluido = (capas['slope'] > 8) & ~((capas['ndwi_p99'] > 0.25) | (capas['mndwi_p99'] > 0.8))
+    excluido |= (capas['ndvi_p10'] > 0.3) & (capas['ndvi_mean'] > 0.5)
+    excluido |= capas['cob_veg'] > 75
+
+    mascara = np.where(excluido, EXCLUIDO, 0).astype(np.uint8)
+    mascara[capas['dtm'] > 2.5] |= DTM_ALTO
+    return mascara
+
+
+def precalcular_exclusion(water_masks, tesela, filas=1024):
+
+    """Precalcula la máscara de exclusión estática de flood de una tesela.
+
+    Se recorre la tesela por bloques de filas, así que la memoria no depende del tamaño de
+    las capas. La máscara (`flood_exclusion_<tesela>.tif`) es uint8 en teselas de 256x256
+    con los bits `EXCLUIDO` y `DTM_ALTO`, calculados sobre los valores originales de cada
+    capa, y lleva en la etiqueta FIRMA el tamaño y la fecha de las capas de origen. Se
+    escribe en un temporal único de la misma carpeta y se renombra, así que varias escenas
+    de la tesela pueden pedirla a la vez.
+
+    Args:
+        water_masks (str): Carpeta water_mask_pv2.
+        tesela (str): Identificador 'PPP_RR' de la tesela.
+        filas (int, optional): Filas por bloque. Por defecto 1024.
+
+    Returns:
+        str: Ruta de la máscara.
+    """
+
+    rutas = rutas_estaticos(water_masks, tesela)
+    firma = _firma(rutas)
+
+    print('Precalculando la exclusión estática de flood de la tesela', tesela)
+
+    fd, tmp = tempfile.mkstemp(suffix='.tif', dir=water_masks)
+    os.close(fd)
+
+    fuentes = {capa: rasterio.open(rutas[capa]) for capa in CAPAS_FLOOD}
+    try:
+        ref = fuentes['dtm']
+        perfil = {'driver': 'GTiff', 'width': ref.width, 'height': ref.height, 'crs': ref.crs,
+                  'transform': ref.transform, 'tiled': True, 'blockxsize': 256, 'blockysize': 256,
+                  'compress': 'lzw', 'count': 1, 'dtype': 'uint8'}
+
+        with rasterio.open(tmp, 'w', **perfil) as exclusion:
+            for fila in range(0, ref.height, filas):
+                ventana = Window(0, fila, ref.width, min(filas, ref.height - fila))
+                capas = {capa: fuentes[capa].read(1, window=ventana) for capa in CAPAS_FLOOD}
+                exclusion.write(_exclusion_bloque(capas), 1, window=ventana)
+
+            exclusion.update_tags(FIRMA=firma, EXCLUIDO=EXCLUIDO, DTM_ALTO=DTM_ALTO)
+
+        os.replace(tmp, rutas['exclusion'])
+    finally:
+        for src in fuentes.values():
+            src.close()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    return rutas['exclusion']
+
+
+def exclusion_estatica(water_masks, tesela):
+
+    """Devuelve la máscara de exclusión estática de flood, recalculándola si no está al día.
+
+    Args:
+        water_masks (str): Carpeta water_mask_pv2.
+        tesela (str): Identificador 'PPP_RR' de la tesela.
+
+    Returns:
+        tuple: Máscara uint8 (bits `EXCLUIDO` y `DTM_ALTO`) y sus metadatos (`meta` de rasterio).
+    """
+
+    rutas = rutas_estaticos(water_masks, tesela)
+    firma = _firma(rutas)
+
+    actualizada = False
+    if os.path.exists(rutas['exclusion']):
+        with rasterio.open(rutas['exclusion']) as src:
+            actualizada = src.tags().get('FIRMA') == firma
+
+    if not actualizada:
+        precalcular_exclusion(water_masks, tesela)
+
+    with rasterio.open(rutas['exclusion']) as src:
+        return src.read(1), src.meta.copy()
+
+
+if __name__ == "__main__":
+    # Uso: python estaticos.py /mnt/datos_last/data/water_mask_pv2 202_34 [otras teselas ...]
+    for tesela in sys.argv[2:]:
+        precalcular_exclusion(sys.argv[1], tesela)
@@ -0,0 +1,286 @@
+import os
+import re
+import json
+import shutil
+import tarfile
+from datetime import datetime
+
+
+
+ETAPAS = ('ori', 'geo', 'rad', 'nor', 'pro')
+
+# Marcas de etapa en los nombres de las bandas procesadas (..._g2_blue_b2.tif, ..._grn2_blue_b2.tif)
+MARCAS = ('grn2', 'gr2', 'g2')
+
+
+def clave_fichero(nombre, escena=None):
+
+    """Devuelve la clave con la que se indexa un fichero de una escena en el manifiesto.
+
+    - Originales de Collection 2: lo que sigue al tier (`SR_B4`, `QA_PIXEL`, `MTL.txt`).
+    - Bandas de geo, rad y nor: lo que sigue a la marca de etapa (`blue_b2`, `fmask`).
+    - Productos: lo que sigue al nombre de la escena (`flood`, `ndvi_`).
+    - Resto: el nombre sin extensión (`hillshade`, `coeficientes.txt`).
+
+    La extensión solo se añade a la clave si no es `.tif`.
+
+    Args:
+        nombre (str): Nombre del fichero.
+        escena (str, optional): Nombre de la escena procesada (p.ej. 20240115l9oli202_34).
+
+    Returns:
+        str: Clave del fichero.
+    """
+
+    base, ext = os.path.splitext(nombre)
+    ext = '' if ext.lower() == '.tif' else ext.lower()
+    partes = base.split('_')
+
+    if len(partes) > 7 and partes[6] in ('T1', 'T2', 'RT'):
+        return '_'.join(partes[7:]) + ext
+    for marca in MARCAS:
+        if marca in partes:
+            return '_'.join(partes[partes.index(marca) + 1:]) + ext
+    if escena and base.startswith(escena + '_'):
+        return base[len(escena) + 1:] + ext
+
+    return base + ext
+
+
+class SceneManifest:
+
+    """Índice de los ficheros de una escena en todas las etapas del protocolo.
+
+    Cada carpeta de la escena se lista una sola vez con `os.scandir`, la primera vez que
+    se consulta, y los ficheros quedan indexados por su clave (`clave_fichero`). Las etapas
+    que escriben ficheros nuevos vuelven a escanear su carpeta (`escanear`) o los registran
+    (`registrar`). El manifiesto se guarda como un JSON pequeño junto a la escena para que
+    el resto de etapas y los scripts de análisis no tengan que listar directorios.
+
+    Una etapa puede indexar además los miembros de un `.tar` sin extraerlos: sus rutas son
+    las del sistema de ficheros virtual de GDAL (`/vsitar/...`), y los ficheros que sí estén
+    en la carpeta de la etapa tienen preferencia sobre los del tar.
+
+    Args:
+        carpetas (dict): Carpeta de la escena en cada etapa ('ori', 'geo', 'rad', 'nor', 'pro').
+        escena (str, optional): Nombre de la escena procesada.
+        tars (dict, optional): Fichero `.tar` de las etapas que se leen del archivo descargado.
+    """
+
+    def __init__(self, carpetas, escena=None, tars=None):
+
+        self.carpetas = dict(carpetas)
+        self.escena = escena
+        self.tars = dict(tars or {})
+        self._ficheros = {}
+
+
+    def escanear(self, *etapas):
+
+        """Lista (de nuevo) con un único `os.scandir` las carpetas de las etapas indicadas.
+
+        Args:
+            *etapas (str): Etapas a escanear. Por defecto todas.
+        """
+
+        for etapa in etapas or tuple(self.carpetas):
+            ficheros = {}
+            tar = self.tars.get(etapa)
+            if tar and os.path.exists(tar):
+                with tarfile.open(tar) as t:
+                    miembros = sorted(m.name for m in t.getmembers() if m.isfile())
+                for nombre in miembros:
+                    ficheros[clave_fichero(os.path.basename(nombre), self.escena)] = self._prefijo_tar(etapa) + nombre
+            carpeta = self.carpetas.get(etapa)
+            if carpeta and os.path.isdir(carpeta):
+                with os.scandir(carpeta) as it:
+                    for entrada in sorted(it, key=lambda e: e.name):
+                        if entrada.is_file():
+                            ficheros[clave_fichero(entrada.name, self.escena)] = entrada.name
+            self._ficheros[etapa] = ficheros
+
+
+    def _prefijo_tar(self, etapa):
+
+        return '/vsitar/{}/'.format(self.tars[etapa])
+
+
+    def _miembro_tar(self, etapa, ruta):
+
+        """Devuelve el nombre del miembro del tar si `ruta` apunta dentro del tar de la etapa, o None."""
+
+        if ruta and etapa in self.tars and ruta.startswith(self._prefijo_tar(etapa)):
+            return ruta[len(self._prefijo_tar(etapa)):]
+        return None
+
+
+    def leer_texto(self, etapa, clave):
+
+        """Devuelve el contenido de un fichero de texto (p.ej. el MTL), esté extraído o dentro del tar.
+
+        Returns:
+            str: Contenido del fichero, o None si no existe.
+        """
+
+        ruta = self.ruta(etapa, clave)
+        if ruta is None:
+            return None
+
+        miembro = self._miembro_tar(etapa, ruta)
+        if miembro is not None:
+            with tarfile.open(self.tars[etapa]) as t:
+                return t.extractfile(miembro).read().decode()
+
+        with open(ruta, 'r') as f:
+            return f.read()
+
+
+    def extraer(self, etapa, claves):
+
+        """Extrae del tar a la carpeta de la etapa solo los ficheros indicados y reescanea la etapa.
+
+        Para los pasos que modifican ficheros originales en sitio (gapfill de Landsat 7).
+
+        Args:
+            etapa (str): Etapa con tar.
+            claves (list): Claves de los ficheros a extraer.
+        """
+
+        miembros = [self._miembro_tar(etapa, self.ruta(etapa, clave)) for clave in claves]
+        miembros = [m for m in miembros if m is not None]
+        if not miembros:
+            return
+
+        os.makedirs(self.carpetas[etapa], exist_ok=True)
+        with tarfile.open(self.tars[etapa]) as t:
+            for miembro in miembros:
+                t.extract(miembro, self.carpetas[etapa])
+        self.escanear(etapa)
+
+
+    def existe(self, etapa, ruta):
+
+        """Indica si `ruta` es un fichero de la etapa, ya esté en su carpeta o dentro de su tar.
+
+        `os.path.exists` no ve las rutas `/vsitar/...`; para ellas se consulta el índice del tar.
+        """
+
+        if not ruta:
+            return False
+        if self._miembro_tar(etapa, ruta) is not None:
+            return ruta in self.ficheros(etapa).values()
+        return os.path.exists(ruta)
+
+
+    def copiar(self, etapa, ruta, destino):
+
+        """Copia un fichero de la etapa a `destino`, leyéndolo del tar si no está extraído.
+
+        Returns:
+            str: Ruta de la copia.
+        """
+
+        miembro = self._miembro_tar(etapa, ruta)
+        if miembro is None:
+            return shutil.copy(ruta, destino)
+
+        with tarfile.open(self.tars[etapa]) as t, open(destino, 'wb') as f:
+            shutil.copyfileobj(t.extractfile(miembro), f)
+        return destino
+
+
+    def ficheros(self, etapa):
+
+        """Devuelve el diccionario clave -> ruta de los ficheros de una etapa."""
+
+        if etapa not in self._ficheros:
+            self.escanear(etapa)
+        carpeta = self.carpetas[etapa]
+        return {clave: os.path.join(carpeta, nombre) for clave, nombre in self._ficheros[etapa].items()}
+
+
+    def ruta(self, etapa, clave):
+
+        """Devuelve la ruta del fichero con esa clave en la etapa, o None si no existe."""
+
+        return self.ficheros(etapa).get(clave)
+
+
+    def buscar(self, etapa, patron):
+
+        """Devuelve, ordenadas, las rutas de la etapa cuyo nombre de fichero cumple la regex `patron`."""
+
+        return sorted(ruta for ruta in self.ficheros(etapa).values() if re.search(patron, os.path.split(ruta)[1]))
+
+
+    def registrar(self, etapa, ruta):
+
+        """Añade al manifiesto un fichero recién escrito en la carpeta de una etapa."""
+
+        if etapa not in self._ficheros:
+            self.escanear(etapa)
+        nombre = os.path.split(ruta)[1]
+        self._ficheros[etapa][clave_fichero(nombre, self.escena)] = nombre
+
+
+    def guardar(self, ruta):
+
+        """Guarda el manifiesto como JSON (escritura atómica).
+
+        Args:
+            ruta (str): Ruta del fichero JSON.
+        """
+
+        for etapa in self.carpetas:
+            if etapa not in self._ficheros:
+                self.escanear(etapa)
+
+        datos = {'escena': self.escena, 'fecha': datetime.now().isoformat(timespec='seconds'),
+                 'carpetas': self.carpetas, 'tars': self.tars, 'ficheros': self._ficheros}
+
+        tmp = ruta + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(datos, f, indent=1, sort_keys=True)
+        os.replace(tmp, ruta)
+
+
+    @classmethod
+    def cargar(cls, ruta):
+
+        """Carga un manifiesto guardado con `guardar`.
+
+        Args:
+            ruta (str): Ruta del fichero JSON.
+
+        Returns:
+            SceneManifest: Manifiesto con los ficheros indexados, sin volver a listar las carpetas.
+        """
+
+        with open(ruta) as f:
+            datos = json.load(f)
+
+        manifest = cls(datos['carpetas'], datos.get('escena'), datos.get('tars'))
+        manifest._ficheros = {etapa: dict(ficheros) for etapa, ficheros in datos['ficheros'].items()}
+        return manifest
+
+
+def bandas_normalizadas(nor_escena):
+
+    """Devuelve las bandas normalizadas (`*_grn2_*.tif`) de una escena.
+
+    Se leen del `manifest.json` de la escena si existe; si no, se lista la carpeta una vez.
+    Pensado para los scripts de análisis, que recorren miles de escenas.
+
+    Args:
+        nor_escena (str): Carpeta nor de la escena.
+
+    Returns:
+        list: Rutas de las bandas normalizadas.
+    """
+
+    patron = r'_grn2_.*\.tif$'
+    ruta = os.path.join(nor_escena, 'manifest.json')
+    if os.path.exists(ruta):
+        return SceneManifest.cargar(ruta).buscar('nor', patron)
+
+    return SceneManifest({'nor': nor_escena}).buscar('nor', patron)
@@ -15,6 +15,7 @@ from pymongo import MongoClient
 # Añadir ruta del código
 sys.path.append('/root/git/ProtocoloV2/protocolo')
 from productos import Product
+from manifest import bandas_normalizadas
 
 try:
     from config import SSH_USER, SSH_KEY_PATH, SERVER_HOSTS
@@ -64,7 +65,7 @@ def identificar_escenas_normalizadas(umbral_nubes=20):
         if not os.path.exists(ruta_nor_esc):
             continue
         
-        archivos_norm = glob.glob(os.path.join(ruta_nor_esc, '*_grn2_*.tif'))
+        archivos_norm = bandas_normalizadas(ruta_nor_esc)
         if len(archivos_norm) < 4:
             continue
         
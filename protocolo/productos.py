@@ -20,23 +20,79 @@ import geopandas as gpd
 import matplotlib.pyplot as plt
 from rasterio.features import geometry_mask
 from rasterio.mask import mask
+from rasterio.windows import Window
 from osgeo import gdal, gdalconst
 from datetime import datetime, date
+from concurrent.futures import ThreadPoolExecutor
 from rasterstats import zonal_stats
 
 # Añadimos la ruta con el código a nuestro pythonpath para poder importar la clase Landsat
 sys.path.append('/root/git/ProtocoloV2/protocolo')
+from qa import mascara_qa, RELLENO, DESPEJADO, AGUA
+from teselas import config_tesela, id_tesela, requerir, DatosTeselaError
+from manifest import SceneManifest
+from estaticos import exclusion_estatica, EXCLUIDO, DTM_ALTO
 from config import SSH_USER, SSH_KEY_PATH, SERVER_HOSTS
 
 #from utils import process_composition_rgb, process_flood_mask, generar_metadatos_flood, subir_xml_y_tif_a_geonetwork
 from utils import * 
 from coast import Coast
 
-from pymongo import MongoClient
-client = MongoClient()
+from conexion import Perezosa
+
+database = Perezosa('Satelites')
+db = Perezosa('Satelites', 'Landsat')
+
+# Bandas de reflectividad normalizadas, que la caché de bandas guarda como float32
+REFLECTIVIDADES = ('blue', 'green', 'red', 'nir', 'swir1', 'swir2')
+
+# Índices espectrales que calcula Product.calcular_indices: bandas de entrada, fórmula sobre
+# ellas (en el mismo orden), sufijo del GeoTIFF de salida y nombre con el que se registra en
+# MongoDB. Run calcula NDVI, NDWI y MNDWI; el resto se piden a calcular_indices.
+INDICES = {
+    'ndvi': {'bandas': ('nir', 'red'), 'formula': lambda nir, red: (nir - red) / (nir + red),
+             'sufijo': '_ndvi_.tif', 'producto': 'NDVI'},
+    'ndwi': {'bandas': ('green', 'nir'), 'formula': lambda green, nir: (green - nir) / (green + nir),
+             'sufijo': '_ndwi.tif', 'producto': 'NDWI'},
+    'mndwi': {'bandas': ('green', 'swir1'), 'formula': lambda green, swir1: (green - swir1) / (green + swir1),
+              'sufijo': '_mndwi.tif', 'producto': 'MNDWI'},
+    'ndmi': {'bandas': ('nir', 'swir1'), 'formula': lambda nir, swir1: (nir - swir1) / (nir + swir1),
+             'sufijo': '_ndmi.tif', 'producto': 'NDMI'},
+    'awei': {'bandas': ('green', 'nir', 'swir1', 'swir2'),
+             'formula': lambda green, nir, swir1, swir2: 4 * (green - swir1) - (0.25 * nir + 2.75 * swir2),
+             'sufijo': '_awei.tif', 'producto': 'AWEI'},
+}
+
+def percentil_histograma(conteos, q, desplazamiento=0):
+
+    """Calcula el percentil `q` de unos valores enteros a partir de su histograma.
+
+    Da el mismo resultado que `np.percentile` (método lineal) sobre los valores originales:
+    se buscan en el histograma acumulado los dos estadísticos de orden que rodean al índice
+    virtual (n - 1) * q / 100 y se interpolan con la misma fórmula que numpy.
+
+    Args:
+        conteos (numpy.ndarray): Número de píxeles de cada valor (bin i = valor i + desplazamiento).
+        q (float): Percentil entre 0 y 100.
+        desplazamiento (int, optional): Valor del primer bin. Por defecto 0.
+
+    Returns:
+        float: Percentil.
+    """
+
+    n = int(conteos.sum())
+    indice = (n - 1) * np.true_divide(q, 100)
+    anterior = np.floor(indice)
+    gamma = indice - anterior
+
+    acumulado = np.cumsum(conteos)
+    a = np.float64(np.searchsorted(acumulado, int(anterior), side='right') + desplazamiento)
+    b = np.float64(np.searchsorted(acumulado, min(int(anterior) + 1, n - 1), side='right') + desplazamiento)
+
+    if gamma >= 0.5:
+        return b - (b - a) * (1 - gamma)
+    return a + (b - a) * gamma
 
-database = client.Satelites
-db = database.Landsat
 
 class Product(object):
     
@@ -44,12 +100,14 @@ class Product(object):
     '''Esta clase genera los productos de inundacion, turbidez del agua y ndvi de las escenas normalizadas'''
     
         
-    def __init__(self, ruta_nor):
+    def __init__(self, ruta_nor, memmap=False):
         
         """Inicializa un objeto Product con la ruta de la escena normalizada.
 
         Args:
             ruta_nor (str): Ruta al directorio de la escena normalizada.
+            memmap (bool, optional): Guardar las bandas de la caché (`banda`) en ficheros
+                mapeados en memoria dentro de `temp` en lugar de en RAM. Por defecto False.
         """
 
         self.escena = os.path.split(ruta_nor)[1]
@@ -61,6 +119,9 @@ class Product(object):
         self.productos = os.path.join(self.raiz, 'pro')
         self.data = os.path.join(self.raiz, 'data')
         self.water_masks = os.path.join(self.data, 'water_mask_pv2')
+        # Tesela WRS-2 de la escena (p.ej. 20240115l9oli202_34 -> 202_34)
+        path, row = self.escena[-6:].split('_')
+        self.tesela = config_tesela(id_tesela(path, row), self.data)
         self.temp = os.path.join(self.raiz, 'temp')
         os.makedirs(self.temp, exist_ok=True)
         
@@ -79,8 +140,8 @@ class Product(object):
         # Lista con los productos obtenidos para el envío de mails
         self.productos_generados = []
 
-        # Shape con recintos
-        self.recintos = os.path.join(self.data, 'Recintos_Marisma.shp')
+        # Shape con recintos (de la tesela)
+        self.recintos = self.tesela['recintos']
         self.lagunas = os.path.join(self.data, 'lagunas_carola_32629.shp')
         self.lagunas_labordette = os.path.join(self.data, 'lagunas_labordette.shp')
         self.resultados_lagunas = {}
@@ -108,8 +169,20 @@ class Product(object):
         # Mascara de nuebes. Hay que hacerlo así porque sabe dios por qué ^!·/&"! los valores no son los mismos en OLI que en ETM+ y TM
         if self.sensor == 'OLI':
             self.cloud_mask_values = [21824, 21952]
+            self.clases_validas = (DESPEJADO, AGUA)
+            self.voto_agua = (AGUA,) # 21952
         else:
             self.cloud_mask_values = [1, 5440, 5504] # 1 es el valor de los gaps
+            self.clases_validas = (RELLENO, DESPEJADO, AGUA) # Los gaps vienen rellenos con gapfill
+            # Valor histórico del voto de Fmask en flood: 5440 (cloud_mask_values[1]), que en TM y
+            # ETM+ es tierra despejada y no agua. Se mantiene para no cambiar las series de flood
+            self.voto_agua = (DESPEJADO,)
+
+        # Caché de bandas de la escena: cada banda se lee una sola vez por Product.run
+        self.memmap = memmap
+        self._bandas = {}
+        self._metadatos = {}
+        self._memmaps = []
 
         # Inicializar atributos de bandas con None por defecto
         self.blue = None
@@ -121,7 +194,14 @@ class Product(object):
         self.fmask = None
         self.hillshade = None
 
-        for i in os.listdir(self.nor_escena):
+        # Ficheros de la escena desde el manifiesto que deja Landsat.run; si no está, se lista nor una vez
+        self.ruta_manifest = os.path.join(self.nor_escena, 'manifest.json')
+        if os.path.exists(self.ruta_manifest):
+            self.manifest = SceneManifest.cargar(self.ruta_manifest)
+        else:
+            self.manifest = SceneManifest({'nor': self.nor_escena, 'pro': self.pro_escena}, self.escena)
+
+        for i in [os.path.split(r)[1] for r in self.manifest.ficheros('nor').values()]:
             if re.search('tif$', i):
                 # Verificamos si el archivo es 'fmask' o 'hillshade'
                 if 'fmask' in i:
@@ -185,6 +265,80 @@ class Product(object):
         print('escena importada para productos correctamente')
 
         
+    def banda(self, nombre):
+
+        """Devuelve una banda de la escena leyéndola solo la primera vez que se pide.
+
+        Las bandas de reflectividad (`REFLECTIVIDADES`) se guardan como float32 y el resto
+        (fmask, hillshade, y los productos ndvi, ndwi, mndwi y flood ya calculados) en su tipo
+        original. Los arrays son de solo lectura; con `memmap=True` viven en ficheros de
+        `temp` que se borran con `liberar`.
+
+        Args:
+            nombre (str): 'blue', 'green', 'red', 'nir', 'swir1', 'swir2', 'fmask', 'hillshade'
+                o el nombre de un producto de la escena ('ndvi', 'ndwi', 'mndwi', 'flood').
+
+        Returns:
+            numpy.ndarray: Array 2D con la banda.
+        """
+
+        if nombre not in self._bandas:
+            ruta = getattr(self, nombre + '_escena', None) or getattr(self, nombre)
+            with rasterio.open(ruta) as src:
+                dtype = np.float32 if nombre in REFLECTIVIDADES else src.dtypes[0]
+                if self.memmap:
+                    fichero = os.path.join(self.temp, '{}_{}.dat'.format(self.escena, nombre))
+                    self._memmaps.append(fichero)
+                    datos = np.memmap(fichero, dtype=dtype, mode='w+', shape=(src.height, src.width))
+                else:
+                    datos = np.empty((src.height, src.width), dtype=dtype)
+                src.read(1, out=datos)
+                self._metadatos[nombre] = (src.meta.copy(), src.tags())
+            self._guardar_banda(nombre, datos)
+
+        return self._bandas[nombre]
+
+
+    def _guardar_banda(self, nombre, datos, perfil=None):
+
+        """Añade a la caché un array recién leído o un producto recién calculado."""
+
+        if isinstance(datos, np.memmap):
+            datos.flush()
+        datos.setflags(write=False)
+        self._bandas[nombre] = datos
+        if perfil is not None:
+            self._metadatos[nombre] = (perfil.copy(), {})
+
+
+    def perfil(self, nombre):
+
+        """Devuelve una copia de los metadatos (`meta` de rasterio) de una banda de la caché."""
+
+        self.banda(nombre)
+        return self._metadatos[nombre][0].copy()
+
+
+    def etiquetas(self, nombre):
+
+        """Devuelve las etiquetas GDAL (tags) de una banda de la caché."""
+
+        self.banda(nombre)
+        return self._metadatos[nombre][1]
+
+
+    def liberar(self):
+
+        """Vacía la caché de bandas y borra sus ficheros mapeados en memoria."""
+
+        self._bandas.clear()
+        self._metadatos.clear()
+        for fichero in self._memmaps:
+            if os.path.exists(fichero):
+                os.remove(fichero)
+        self._memmaps = []
+
+
     def generate_composition_rgb(self):
         
         """Genera la composición RGB en pro_escena (sobrescribe si existe)."""
@@ -194,7 +348,8 @@ class Product(object):
             self.nir,
             self.blue,
             self.rbios,
-            output_path
+            output_path,
+            bandas={self.swir1: self.banda('swir1'), self.nir: self.banda('nir'), self.blue: self.banda('blue')}
         )
 
     def generate_flood_mask(self):
@@ -208,234 +363,191 @@ class Product(object):
         )
             
         
-    def ndvi(self):
+    def calcular_indices(self, nombres=('ndvi', 'ndwi', 'mndwi'), filas=512, n_workers=None, division='nan',
+                         cachear=True):
 
-        """Calcula el NDVI (Índice de Vegetación de Diferencia Normalizada) para la escena.
+        """Calcula varios índices espectrales de `INDICES` en una sola pasada por bloques de filas.
 
-        El NDVI se guarda como un archivo GeoTIFF y se actualiza en la base de datos.
+        Las bandas de entrada se toman una sola vez de la caché (`banda`) y los bloques se
+        evalúan en paralelo con hilos, en float32 y sin temporales del tamaño de la escena.
+        Un píxel es NoData (-9999) en un índice si lo es en alguna de sus bandas. Cada índice
+        se guarda como GeoTIFF en pro_escena, se añade a la caché y se registra en la base de
+        datos.
+
+        Con `cachear=False` cada bloque se lee de los ficheros (o de la caché si la banda ya
+        estaba cargada) y se escribe directamente en los GeoTIFF, sin añadir nada a la caché:
+        la memoria queda acotada por el tamaño del bloque (ver `run(filas_flood=...)`).
+
+        Args:
+            nombres (tuple): Índices de `INDICES` a calcular. Por defecto NDVI, NDWI y MNDWI.
+            filas (int, optional): Filas por bloque. Por defecto 512.
+            n_workers (int, optional): Hilos para los bloques. Por defecto los de ThreadPoolExecutor.
+            division (str, optional): Qué hacer con las divisiones por cero: 'nan' deja NaN/inf
+                como hasta ahora, 'nodata' las pasa a -9999.
+            cachear (bool, optional): Leer las bandas completas y guardar los índices en la
+                caché. Por defecto True.
         """
 
-        self.ndvi_escena = os.path.join(self.pro_escena, self.escena + '_ndvi_.tif')
-        print(self.ndvi_escena)
-        
-        with rasterio.open(self.nir) as nir:
-            NIR = nir.read()
-            
-        with rasterio.open(self.red) as red:
-            RED = red.read()
+        if division not in ('nan', 'nodata'):
+            raise ValueError("division debe ser 'nan' o 'nodata'")
 
-        num = NIR.astype(float)-RED.astype(float)
-        den = NIR+RED
-        ndvi = np.true_divide(num, den)
-        ndvi[NIR == -9999] = -9999
-                
-        profile = nir.meta
-        profile.update(nodata=-9999)
-        profile.update(dtype=rasterio.float32)
+        bandas = sorted({b for n in nombres for b in INDICES[n]['bandas']})
 
-        with rasterio.open(self.ndvi_escena, 'w', **profile) as dst:
-            dst.write(ndvi.astype(rasterio.float32))
-                    
-        try:
-        
-            db.update_one({'_id':self.escena}, {'$addToSet':{'Productos': 'NDVI'}},  upsert=True)
-            
-        except Exception as e:
-            print("Unexpected error:", type(e), e)
-            
-        print(f'Ndvi guardado en: {self.ndvi_escena}')
+        def calcular(datos, salidas):
 
+            nulos = {b: datos[b] == -9999 for b in bandas}
 
-    def ndwi(self):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                for n in nombres:
+                    salida = salidas[n]
+                    salida[...] = INDICES[n]['formula'](*[datos[b] for b in INDICES[n]['bandas']])
+                    if division == 'nodata':
+                        salida[~np.isfinite(salida)] = -9999
+                    for b in INDICES[n]['bandas']:
+                        salida[nulos[b]] = -9999
 
-        """Calcula el NDWI (Índice de Agua de Diferencia Normalizada) para la escena.
+        if cachear:
+            entradas = {b: self.banda(b) for b in bandas}
+            alto, ancho = entradas[bandas[0]].shape
+            salidas = {n: np.empty((alto, ancho), dtype=np.float32) for n in nombres}
 
-        El NDWI se guarda como un archivo GeoTIFF y se actualiza en la base de datos.
-        """
+            def bloque(fila):
 
-        self.ndwi_escena = os.path.join(self.pro_escena, self.escena + '_ndwi.tif')
-        #print outfile
-        
-        with rasterio.open(self.nir) as nir:
-            NIR = nir.read()
-            
-        with rasterio.open(self.green) as green:
-            GREEN = green.read()
-            
-        num = GREEN-NIR
-        den = GREEN+NIR
-        ndwi = num/den
+                filas_bloque = slice(fila, min(fila + filas, alto))
+                calcular({b: entradas[b][filas_bloque] for b in bandas},
+                         {n: salidas[n][filas_bloque] for n in nombres})
 
-        # Aplicamos NoData (-9999) al marco exterior
-        ndwi[NIR == -9999] = -9999
-            
-        profile = nir.meta
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                list(executor.map(bloque, range(0, alto, filas)))
+
+            profile = self.perfil(bandas[0])
+        else:
+            with rasterio.open(getattr(self, bandas[0] + '_escena', None) or getattr(self, bandas[0])) as src:
+                profile = src.meta.copy()
+            alto, ancho = profile['height'], profile['width']
+
+        profile.update(nodata=-9999)
         profile.update(dtype=rasterio.float32)
 
-        with rasterio.open(self.ndwi_escena, 'w', **profile) as dst:
-            dst.write(ndwi.astype(rasterio.float32))
+        rutas = {}
+        for n in nombres:
+            rutas[n] = os.path.join(self.pro_escena, self.escena + INDICES[n]['sufijo'])
+            setattr(self, n + '_escena', rutas[n])
 
-        try:
-        
-            db.update_one({'_id':self.escena}, {'$addToSet':{'Productos': 'NDWI'}},  upsert=True)
+        if cachear:
+            for n in nombres:
+                with rasterio.open(rutas[n], 'w', **profile) as dst:
+                    dst.write(salidas[n], 1)
+                self._guardar_banda(n, salidas[n], profile)
+        else:
+            # Bloque a bloque: se leen las bandas de la ventana y se escriben los índices
+            destinos = {n: rasterio.open(rutas[n], 'w', **profile) for n in nombres}
+            try:
+                for fila in range(0, alto, filas):
+                    ventana = Window(0, fila, ancho, min(filas, alto - fila))
+                    salidas = {n: np.empty((ventana.height, ancho), dtype=np.float32) for n in nombres}
+                    calcular({b: self._leer_bloque(b, ventana) for b in bandas}, salidas)
+                    for n in nombres:
+                        destinos[n].write(salidas[n], 1, window=ventana)
+            finally:
+                for dst in destinos.values():
+                    dst.close()
+
+        for n in nombres:
+
+            try:
             
-        except Exception as e:
-            print("Unexpected error:", type(e), e)
+                db.update_one({'_id':self.escena}, {'$addToSet':{'Productos': INDICES[n]['producto']}},  upsert=True)
+                
+            except Exception as e:
+                print("Unexpected error:", type(e), e)
 
-        print(f'Ndwi guardado en: {self.ndwi_escena}')
+            print(f'{INDICES[n]["producto"]} guardado en: {rutas[n]}')
 
 
-    def mndwi(self):
+    def ndvi(self):
 
-        """Calcula el MNDWI (Índice Modificado de Agua de Diferencia Normalizada) para la escena.
+        """Calcula el NDVI (Índice de Vegetación de Diferencia Normalizada) para la escena.
 
-        El MNDWI se guarda como un archivo GeoTIFF y se actualiza en la base de datos.
+        El NDVI se guarda como un archivo GeoTIFF y se actualiza en la base de datos.
         """
 
-        self.mndwi_escena = os.path.join(self.pro_escena, self.escena + '_mndwi.tif')
-        #print outfile
-        
-        with rasterio.open(self.swir1) as swir1:
-            SWIR1 = swir1.read()
+        self.calcular_indices(('ndvi',))
 
-        with rasterio.open(self.green) as green:
-            GREEN = green.read()
-        
-        num = GREEN-SWIR1
-        den = GREEN+SWIR1
-        mndwi = num/den
 
-        # Aplicamos NoData (-9999) al marco exterior
-        mndwi[SWIR1 == -9999] = -9999
-        
-        profile = swir1.meta
-        profile.update(dtype=rasterio.float32)
+    def ndwi(self):
 
-        with rasterio.open(self.mndwi_escena, 'w', **profile) as dst:
-            dst.write(mndwi.astype(rasterio.float32))
+        """Calcula el NDWI (Índice de Agua de Diferencia Normalizada) para la escena.
 
-        try:
-        
-            db.update_one({'_id':self.escena}, {'$addToSet':{'Productos': 'MNDWI'}},  upsert=True)
-            
-        except Exception as e:
-            print("Unexpected error:", type(e), e)
+        El NDWI se guarda como un archivo GeoTIFF y se actualiza en la base de datos.
+        """
+
+        self.calcular_indices(('ndwi',))
 
-        print(f'Mndwi guardado en: {self.mndwi_escena}')
 
+    def mndwi(self):
 
-    def flood(self):
+        """Calcula el MNDWI (Índice Modificado de Agua de Diferencia Normalizada) para la escena.
+
+        El MNDWI se guarda como un archivo GeoTIFF y se actualiza en la base de datos.
+        """
+
+        self.calcular_indices(('mndwi',))
+
+
+    def flood(self, filas=None):
         
         """Genera la máscara de inundación utilizando diversos criterios (e.g., NDWI, MNDWI, Slope).
 
         La máscara de inundación se guarda como un archivo GeoTIFF y se actualiza en la base de datos.
         Aplica reglas para determinar qué áreas son consideradas inundadas.
+
+        Con `filas` la clasificación se hace por bloques de ese número de filas, leyendo de los
+        ficheros las bandas que no estén ya en la caché, y el umbral de sombras (si el hillshade
+        no lo trae) sale de un histograma del hillshade. El resultado es idéntico al de la
+        escena completa, con la memoria acotada por el tamaño del bloque.
+
+        Args:
+            filas (int, optional): Filas por bloque. Por defecto None (escena completa).
         """
     
         self.flood_escena = os.path.join(self.pro_escena, self.escena + '_flood.tif')
         # print(self.flood_escena)
     
-        # Abrimos los rasters
-        dtm_path = os.path.join(self.water_masks, 'dtm_202_34.tif')
-        slope_path = os.path.join(self.water_masks, 'slope_202_34.tif')
-        fmask_path = os.path.join(self.water_masks, 'fmask_202_34.tif')
-        ndwi_path = os.path.join(self.water_masks, 'ndwi_p99_202_34.tif')
-        mndwi_path = os.path.join(self.water_masks, 'mndwi_p99_202_34.tif')
-        cobveg_path = os.path.join(self.water_masks, 'cob_veg_202_34.tif')
-        ndvi_p10_path = os.path.join(self.water_masks, 'ndvi_p10_202_34.tif')
-        ndvi_mean_path = os.path.join(self.water_masks, 'ndvi_mean_202_34.tif')
-    
-        with rasterio.open(dtm_path) as dtm, \
-             rasterio.open(slope_path) as slope, \
-             rasterio.open(fmask_path) as fmaskw, \
-             rasterio.open(ndwi_path) as ndwi, \
-             rasterio.open(mndwi_path) as mndwi, \
-             rasterio.open(cobveg_path) as cobveg, \
-             rasterio.open(ndvi_p10_path) as ndvi_p10, \
-             rasterio.open(ndvi_mean_path) as ndvi_mean, \
-             rasterio.open(self.ndvi_escena) as ndvi_scene, \
-             rasterio.open(self.ndwi_escena) as ndwi_scene, \
-             rasterio.open(self.mndwi_escena) as mndwi_scene, \
-             rasterio.open(self.fmask) as fmask_scene, \
-             rasterio.open(self.hillshade) as hillsh, \
-             rasterio.open(self.swir1) as swir1:
-    
-            DTM = dtm.read(1)
-            SLOPE = slope.read(1)
-            FMASKW = fmaskw.read(1)
-            NDWI = ndwi.read(1)
-            MNDWI = mndwi.read(1)
-            COBVEG = cobveg.read(1)
-            NDVIP10 = ndvi_p10.read(1)
-            NDVIMEAN = ndvi_mean.read(1)
-            NDVISCENE = ndvi_scene.read(1)
-            NDWISCENE = ndwi_scene.read(1)
-            MNDWISCENE = mndwi_scene.read(1)
-            FMASK_SCENE = fmask_scene.read(1)
-            HILLSHADE = hillsh.read(1)
-            SWIR1 = swir1.read(1)
-    
-            # Generamos la máscara de agua
-            water_mask = (SWIR1 < 0.12)
-    
-            # Aplicamos la condición de pendiente
-            slope_condition = (SLOPE > 8) & ~((NDWI > 0.25) | (MNDWI > 0.8))
-            water_mask[slope_condition] = 0
-    
-            # Excluimos valores nodata del cálculo del percentil
-            valid_hillshade = HILLSHADE[HILLSHADE != -9999]
-            shadow_threshold = np.percentile(valid_hillshade, 30)
-    
-            # Aplicamos la condición de sombras (Hillshade)
-            shadow_condition = HILLSHADE < shadow_threshold
-            water_mask[shadow_condition] = 0
-    
-            # Aplicamos la condición de NDVI
-            ndvi_condition = (NDVIP10 > 0.3) & (NDVIMEAN > 0.5)
-            water_mask[ndvi_condition] = 0
-    
-            # Aplicamos la condición de CobVeg
-            cobveg_condition = (COBVEG > 75)
-            water_mask[cobveg_condition] = 0
-    
-            # Aplicamos la condición de NDVI de la escena
-            ndvi_scene_condition = ((NDVISCENE > 0.60) & (DTM > 2.5))
-            water_mask[ndvi_scene_condition] = 0
-    
-            # Aplicamos la condición para nubes y sombras de nubes usando np.where
-            water_mask = np.where(~np.isin(FMASK_SCENE, self.cloud_mask_values), 2, water_mask)
-    
-            # Reclasificamos los 2 índices y Fmask
-            mndwi_r = np.where(MNDWISCENE > 0, 1, 0)
-            ndwi_r = np.where(NDWISCENE > 0, 1, 0)
-            fmask_r = np.where(FMASK_SCENE == self.cloud_mask_values[1], 1, 0)
-    
-            # Suma de los 3
-            water_ix_sum = mndwi_r + ndwi_r + fmask_r
-    
-            # Si dos de ellos dan valor agua, el pixel pasa a ser agua
-            water_masks_condition = (water_ix_sum >= 2)
-            water_mask[water_masks_condition] = 1
-    
-            # Aplicamos NoData (-9999) al marco exterior
-            water_mask[SWIR1 == -9999] = -9999
-    
+        # Exclusiones que no dependen de la escena (pendiente, climatología de NDVI, cobertura
+        # vegetal y DTM > 2.5), precalculadas por tesela con estaticos.precalcular_exclusion
+        ESTATICO, perfil_estatico = exclusion_estatica(self.water_masks, self.tesela['id'])
+
+        # El umbral de sombras viene calculado con el hillshade (Landsat.get_hillshade)
+        shadow_threshold = self._umbral_sombras(filas)
+
+        perfil = dict(driver='GTiff', height=ESTATICO.shape[0], width=ESTATICO.shape[1], count=1,
+                      dtype='int16', crs=perfil_estatico['crs'], transform=perfil_estatico['transform'],
+                      compress='lzw', nodata=-9999)
+
+        if filas:
+            # Por bloques de filas: la memoria no depende del tamaño de la escena y la
+            # máscara no se guarda en la caché (turbidity y depth la leerán del GeoTIFF)
+            self._bandas.pop('flood', None)
+            with rasterio.open(self.flood_escena, 'w', **perfil) as dst:
+                for fila in range(0, perfil['height'], filas):
+                    ventana = Window(0, fila, perfil['width'], min(filas, perfil['height'] - fila))
+                    water_mask = self._clasificar_flood(
+                        {n: self._leer_bloque(n, ventana) for n in ('ndvi', 'ndwi', 'mndwi', 'fmask', 'hillshade', 'swir1')},
+                        ESTATICO[ventana.toslices()], shadow_threshold)
+                    dst.write(water_mask.astype(np.int16), 1, window=ventana)
+        else:
+            # Bandas y productos de la escena desde la caché (ya leídos o calculados)
+            water_mask = self._clasificar_flood(
+                {n: self.banda(n) for n in ('ndvi', 'ndwi', 'mndwi', 'fmask', 'hillshade', 'swir1')},
+                ESTATICO, shadow_threshold)
+
             # Guardamos el resultado final
-            with rasterio.open(
-                self.flood_escena,
-                'w',
-                driver='GTiff',
-                height=water_mask.shape[0],
-                width=water_mask.shape[1],
-                count=1,
-                dtype='int16',
-                crs=dtm.crs,
-                transform=dtm.transform,
-                compress='lzw',
-                nodata=-9999
-            ) as dst:
+            with rasterio.open(self.flood_escena, 'w', **perfil) as dst:
                 dst.write(water_mask, 1)
-    
+                perfil_flood = dst.meta
+            self._guardar_banda('flood', water_mask.astype(np.int16), perfil_flood)
+
         try:
             db.update_one({'_id': self.escena}, {'$addToSet': {'Productos': 'Flood'}}, upsert=True)
         except Exception as e:
@@ -445,79 +557,199 @@ class Product(object):
 
     
         
+    def _clasificar_flood(self, bandas, ESTATICO, shadow_threshold):
+
+        """Aplica las reglas de la máscara de inundación a la escena completa o a un bloque.
+
+        Args:
+            bandas (dict): Arrays de 'ndvi', 'ndwi', 'mndwi', 'fmask', 'hillshade' y 'swir1'.
+            ESTATICO (numpy.ndarray): Máscara de exclusión estática (bits EXCLUIDO y DTM_ALTO).
+            shadow_threshold (float): Umbral de sombras del hillshade.
+
+        Returns:
+            numpy.ndarray: Máscara con 0 (seco), 1 (agua), 2 (nubes) y -9999 (NoData).
+        """
+
+        FMASK_SCENE = bandas['fmask']
+        SWIR1 = bandas['swir1']
+
+        # Generamos la máscara de agua
+        water_mask = (SWIR1 < 0.12)
+
+        # Aplicamos las condiciones de pendiente, NDVI histórico y CobVeg
+        water_mask[(ESTATICO & EXCLUIDO) > 0] = 0
+
+        # Aplicamos la condición de sombras (Hillshade)
+        shadow_condition = bandas['hillshade'] < shadow_threshold
+        water_mask[shadow_condition] = 0
+
+        # Aplicamos la condición de NDVI de la escena
+        ndvi_scene_condition = ((bandas['ndvi'] > 0.60) & ((ESTATICO & DTM_ALTO) > 0))
+        water_mask[ndvi_scene_condition] = 0
+
+        # Aplicamos la condición para nubes y sombras de nubes usando np.where
+        water_mask = np.where(~mascara_qa(FMASK_SCENE, self.sensor, self.clases_validas), 2, water_mask)
+
+        # Reclasificamos los 2 índices y Fmask (cloud_mask_values[1]: 21952 en OLI, 5440 en TM y ETM+)
+        mndwi_r = np.where(bandas['mndwi'] > 0, 1, 0)
+        ndwi_r = np.where(bandas['ndwi'] > 0, 1, 0)
+        fmask_r = np.where(mascara_qa(FMASK_SCENE, self.sensor, self.voto_agua), 1, 0)
+
+        # Suma de los 3
+        water_ix_sum = mndwi_r + ndwi_r + fmask_r
+
+        # Si dos de ellos dan valor agua, el pixel pasa a ser agua
+        water_masks_condition = (water_ix_sum >= 2)
+        water_mask[water_masks_condition] = 1
+
+        # Aplicamos NoData (-9999) al marco exterior
+        water_mask[SWIR1 == -9999] = -9999
+
+        return water_mask
+
+
+    def _leer_bloque(self, nombre, ventana):
+
+        """Devuelve una ventana de una banda, de la caché si ya está cargada o leída del fichero."""
+
+        if nombre in self._bandas:
+            return self._bandas[nombre][ventana.toslices()]
+
+        ruta = getattr(self, nombre + '_escena', None) or getattr(self, nombre)
+        with rasterio.open(ruta) as src:
+            datos = src.read(1, window=ventana)
+        return datos.astype(np.float32) if nombre in REFLECTIVIDADES else datos
+
+
+    def _umbral_sombras(self, filas=None):
+
+        """Devuelve el umbral de sombras: la etiqueta UMBRAL_SOMBRA del hillshade o su percentil 30.
+
+        Sin etiqueta, con `filas` el percentil se calcula con un histograma acumulado por
+        bloques (`percentil_histograma`), exacto para hillshades enteros de hasta 16 bits; con
+        otros tipos, o sin `filas`, se usa `np.percentile` sobre el hillshade completo.
+        """
+
+        if filas:
+            with rasterio.open(self.hillshade) as src:
+                etiqueta = src.tags().get('UMBRAL_SOMBRA')
+                dtype = np.dtype(src.dtypes[0])
+                alto, ancho = src.height, src.width
+        else:
+            etiqueta = self.etiquetas('hillshade').get('UMBRAL_SOMBRA')
+
+        if etiqueta is not None:
+            return float(etiqueta)
+
+        if filas and dtype.kind in 'ui' and dtype.itemsize <= 2:
+            desplazamiento = int(np.iinfo(dtype).min)
+            conteos = np.zeros(2 ** (8 * dtype.itemsize), dtype=np.int64)
+            with rasterio.open(self.hillshade) as src:
+                for fila in range(0, alto, filas):
+                    bloque = src.read(1, window=Window(0, fila, ancho, min(filas, alto - fila)))
+                    # Excluimos valores nodata del cálculo del percentil
+                    validos = bloque[bloque != -9999].astype(np.int64) - desplazamiento
+                    conteos += np.bincount(validos, minlength=conteos.size)
+            return percentil_histograma(conteos, 30, desplazamiento)
+
+        # Excluimos valores nodata del cálculo del percentil
+        HILLSHADE = self.banda('hillshade')
+        valid_hillshade = HILLSHADE[HILLSHADE != -9999]
+        return np.percentile(valid_hillshade, 30)
+
+
+    def _reunir(self, nombre, indices, sin_ceros=False):
+
+        """Devuelve en un vector float32 nuevo los valores de una banda de la caché en `indices` (planos).
+
+        Con `sin_ceros` los ceros pasan a 1, como hacía turbidity con la escena completa.
+        """
+
+        valores = np.asarray(self.banda(nombre)).ravel()[indices].astype(np.float32, copy=False)
+        if sin_ceros:
+            valores[valores == 0] = 1
+        return valores
+
+
     def turbidity(self):
 
         """Calcula la turbidez del agua en la escena usando bandas espectrales.
 
         El cálculo de la turbidez se guarda como un archivo GeoTIFF y se actualiza en la base de datos.
-        Usa diferentes modelos dependiendo del tipo de cuerpo de agua (río o marisma).
+        Usa diferentes modelos dependiendo del tipo de cuerpo de agua (río o marisma). Los modelos
+        se evalúan en float32 solo sobre los píxeles inundados, que luego se vuelcan en una
+        salida inicializada a NoData.
+
+        Raises:
+            DatosTeselaError: Si la tesela no tiene máscara de turbidez (`water_mask_turb`).
         """
         
-        waterMask = os.path.join(self.water_masks, 'water_mask_turb.tif')
+        # Máscara de marisma (1) y río (2) de la tesela, en la malla de sus escenas
+        waterMask, = requerir(self.tesela, 'water_mask_turb')
         self.turbidity_escena = os.path.join(self.pro_escena, self.escena + '_turbidity.tif')
         #print(self.turbidity_escena)
         
-        with rasterio.open(self.flood_escena) as flood:
-            FLOOD = flood.read()
+        FLOOD = self.banda('flood')
         
         with rasterio.open(waterMask) as wmask:
-            WMASK = wmask.read()
-            
-        with rasterio.open(self.blue) as blue:
-            BLUE = blue.read()
-            BLUE = np.where(BLUE == 0, 1, BLUE)
-            #BLUE = np.true_divide(BLUE, 10000)
-                        
-        with rasterio.open(self.green) as green:
-            GREEN = green.read()
-            GREEN = np.where(GREEN == 0, 1, GREEN)
-            #GREEN = np.true_divide(GREEN, 10000)
-            GREEN_R = np.where((GREEN<0.1), 0.1, GREEN)
-            GREEN_RECLASS = np.where((GREEN_R>=0.4), 0.4, GREEN_R)
-
-        with rasterio.open(self.red) as red:
-            RED = red.read()
-            RED = np.where(RED == 0, 1, RED)
-            #RED = np.true_divide(RED, 10000)
-            RED_RECLASS = np.where((RED>=0.2), 0.2, RED)
-            
-        with rasterio.open(self.nir) as nir:
-            NIR = nir.read()
-            NIR = np.where(NIR == 0, 1, NIR)
-            #NIR = np.true_divide(NIR, 10000)
-            NIR_RECLASS = np.where((NIR>0.5), 0.5, NIR)
-            
-        with rasterio.open(self.swir1) as swir1:
-            SWIR1 = swir1.read()
-            SWIR1 = np.where(SWIR1 == 0, 1, SWIR1)
-            #SWIR1 = np.true_divide(SWIR1, 10000)
-            SWIR_RECLASS = np.where((SWIR1>=0.09), 0.9, SWIR1)
-        
-        
-        #Turbidez para la el rio
-        rio = (-4.3 + (85.22 * GREEN_RECLASS) - (455.9 * np.power(GREEN_RECLASS,2)) \
-            + (594.58 * np.power(GREEN_RECLASS,3)) + (32.3 * RED) - (15.36 * NIR_RECLASS)  \
-            + (21 * np.power(NIR_RECLASS,2))) - 0.01        
-        #RIO = np.power(math.e, rio)
-        
-        #Turbidez para la marisma        
-        marisma = (4.1263574 + (18.8113118 * RED_RECLASS) - (32.2615219 * SWIR_RECLASS) \
-        - 0.0114108989999999 * np.true_divide(BLUE, NIR)) - 0.01
+            WMASK = wmask.read(1)
+
+        # Los modelos solo se evalúan en los píxeles inundados (con dato) de marisma y de río
+        inundado = (FLOOD == 1) & (self.banda('swir1') != -9999)
+        marisma_idx = np.flatnonzero(inundado & (WMASK == 1))
+        rio_idx = np.flatnonzero(inundado & (WMASK == 2))
+        del inundado
+
+        #Turbidez para la marisma: 4.1263574 + 18.8113118 * RED_R - 32.2615219 * SWIR_R - 0.0114109 * BLUE / NIR - 0.01
+        RED_RECLASS = self._reunir('red', marisma_idx, sin_ceros=True)
+        np.minimum(RED_RECLASS, 0.2, out=RED_RECLASS)
+        SWIR_RECLASS = self._reunir('swir1', marisma_idx, sin_ceros=True)
+        SWIR_RECLASS[SWIR_RECLASS >= 0.09] = 0.9
+        BLUE_NIR = self._reunir('blue', marisma_idx, sin_ceros=True)
+        BLUE_NIR /= self._reunir('nir', marisma_idx, sin_ceros=True)
+
+        marisma = RED_RECLASS
+        marisma *= 18.8113118
+        SWIR_RECLASS *= 32.2615219
+        marisma -= SWIR_RECLASS
+        BLUE_NIR *= 0.0114108989999999
+        marisma -= BLUE_NIR
+        marisma += 4.1263574 - 0.01
         #MARISMA = np.power(math.e, marisma)
-        
-        
-        TURBIDEZ = np.where(((FLOOD == 1) & (WMASK == 1)), marisma, 
-                             np.where(((FLOOD == 1) & (WMASK == 2)), rio, -9999))
 
-        TURBIDEZ[SWIR1 == -9999] = -9999
+        #Turbidez para el rio, en forma de Horner:
+        #-4.3 + 85.22 * G - 455.9 * G^2 + 594.58 * G^3 + 32.3 * RED - 15.36 * N + 21 * N^2 - 0.01
+        GREEN_RECLASS = self._reunir('green', rio_idx, sin_ceros=True)
+        np.clip(GREEN_RECLASS, 0.1, 0.4, out=GREEN_RECLASS)
+        NIR_RECLASS = self._reunir('nir', rio_idx, sin_ceros=True)
+        np.minimum(NIR_RECLASS, 0.5, out=NIR_RECLASS)
+        RED = self._reunir('red', rio_idx, sin_ceros=True)
+
+        rio = GREEN_RECLASS * np.float32(594.58)
+        rio -= 455.9
+        rio *= GREEN_RECLASS
+        rio += 85.22
+        rio *= GREEN_RECLASS
+        termino_nir = NIR_RECLASS * np.float32(21)
+        termino_nir -= 15.36
+        termino_nir *= NIR_RECLASS
+        rio += termino_nir
+        RED *= 32.3
+        rio += RED
+        rio += -4.3 - 0.01
+        #RIO = np.power(math.e, rio)
+
+        TURBIDEZ = np.full(FLOOD.shape, -9999, dtype=np.float32)
+        TURBIDEZ.ravel()[marisma_idx] = marisma
+        TURBIDEZ.ravel()[rio_idx] = rio
         
         
-        profile = swir1.meta
+        profile = self.perfil('swir1')
         profile.update(nodata=-9999)
         profile.update(dtype=rasterio.float32)
                              
         with rasterio.open(self.turbidity_escena, 'w', **profile) as dst:
-            dst.write(TURBIDEZ.astype(rasterio.float32))        
+            dst.write(TURBIDEZ, 1)
         
         try:
         
@@ -534,89 +766,93 @@ class Product(object):
         """Calcula la profundidad del agua en las áreas inundadas de la escena.
 
         La profundidad se calcula utilizando ratios entre bandas espectrales y modelos empíricos.
-        El resultado se guarda como un archivo GeoTIFF y se actualiza en la base de datos.
+        El resultado se guarda como un archivo GeoTIFF y se actualiza en la base de datos. Como en
+        turbidity, el modelo solo se evalúa (en float32) sobre los píxeles inundados.
+
+        Raises:
+            DatosTeselaError: Si la tesela no tiene escena de referencia para la profundidad
+                o faltan su banda NIR o su máscara de inundación.
         """
         
+        if not self.tesela['profundidad']:
+            raise DatosTeselaError('La tesela {} no tiene escena de referencia para la profundidad'.format(
+                self.tesela['id']))
+
         # Abrimos las bandas necesarias para correr el algoritmo
-        septb4 = os.path.join(self.water_masks, '20230930l9oli202_34_grn2_nir_b5.tif')
-        septwmask = os.path.join(self.water_masks, '20230930l9oli202_34_flood.tif')
+        septb4, septwmask = requerir(
+            self.tesela, os.path.join(self.water_masks, self.tesela['profundidad'] + '_grn2_nir_b5.tif'),
+            os.path.join(self.water_masks, self.tesela['profundidad'] + '_flood.tif'))
         
         self.depth_escena = os.path.join(self.pro_escena, self.escena + '_depth_.tif')
         #print(self.depth_escena)
 
-        with rasterio.open(self.flood_escena) as flood:
-            FLOOD = flood.read()
+        FLOOD = self.banda('flood')
             
         with rasterio.open(septb4) as septb4:
             
-            SEPTB4 = septb4.read()
+            SEPTB4 = septb4.read(1)
                         
             #En reflectividades
             #SEPTB4_REF = np.true_divide(SEPTB4, 306)
-            SEPTB4_REF = np.where(SEPTB4 >= 0.830065359, 0.830065359, SEPTB4)
         
         with rasterio.open(septwmask) as septwater:
-            SEPTWMASK = septwater.read()
-            
-        #Banda 1
-        with rasterio.open(self.blue) as blue:
-            BLUE = blue.read()
-            BLUE = np.where(BLUE >= 0.2, 0.2, BLUE)
+            SEPTWMASK = septwater.read(1)
 
-            #Blue en reflectividad
-            #BLUE_REF = np.true_divide(BLUE, 398)
-            
-            
-        #Banda 2
-        with rasterio.open(self.green) as green:
-            GREEN = green.read()
-            
-            #Green en reflectivdiad
-            #GREEN_REF = np.true_divide(GREEN, 401) #
-            
-        
-        #Banda 4
-        with rasterio.open(self.nir) as nir:
-            NIR = nir.read()
-            
-            #NIR en reflectividad
-            #NIR_REF = np.true_divide(NIR, 422)
-            
-        
-        #Banda 5
-        with rasterio.open(self.swir1) as swir1:
-            SWIR1 = swir1.read()
-            
-            #SWIR1 en reflecrtividad
-            #SWIR1_REF = np.true_divide(SWIR1, 324)
-            
-        
-        #Ratios
-        RATIO_GREEN_NIR = np.true_divide(GREEN, NIR)
-        RATIO_GREEN_NIR = np.where(RATIO_GREEN_NIR >= 2.5, 2.5, RATIO_GREEN_NIR)
-        RATIO_NIR_SEPTNIR = np.true_divide(NIR, SEPTB4)           
-        
-        #Profundidad para la marisma        
-            
-        a = 5.293739862 + (-0.038684824 * BLUE) + (0.02826867 * SWIR1) + (-0.007525455 * SEPTB4) + \
-            (1.023724916 * RATIO_GREEN_NIR) + (-1.041844944 * RATIO_NIR_SEPTNIR)
-        
-        a_safe = np.where(a > 50, 50, a)
-        
-        DEPTH = np.exp(a_safe) - 0.01
-        
+        # El modelo solo se evalúa en los píxeles inundados que no eran agua en septiembre
         #PASAR A NODATA EL AGUA DE SEPTIEMBRE!!!!
-        
         #Se podría pasar directamente a SWIR1 <= 53
-        DEPTH_ = np.where((FLOOD == 1) & (SEPTWMASK == 0), DEPTH, -9999)
+        agua_idx = np.flatnonzero((FLOOD == 1) & (SEPTWMASK == 0))
+        SEPTB4 = SEPTB4.ravel()[agua_idx].astype(np.float32)
+        del SEPTWMASK
 
-        profile = swir1.meta
+        #Banda 1
+        BLUE = self._reunir('blue', agua_idx)
+        np.minimum(BLUE, 0.2, out=BLUE)
+
+        #Bandas 2, 4 y 5
+        GREEN = self._reunir('green', agua_idx)
+        NIR = self._reunir('nir', agua_idx)
+        SWIR1 = self._reunir('swir1', agua_idx)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+
+            #Ratios
+            RATIO_GREEN_NIR = GREEN
+            RATIO_GREEN_NIR /= NIR
+            np.minimum(RATIO_GREEN_NIR, 2.5, out=RATIO_GREEN_NIR)
+            RATIO_NIR_SEPTNIR = NIR
+            RATIO_NIR_SEPTNIR /= SEPTB4
+
+            #Profundidad para la marisma
+            #a = 5.293739862 - 0.038684824 * BLUE + 0.02826867 * SWIR1 - 0.007525455 * SEPTB4 +
+            #    1.023724916 * RATIO_GREEN_NIR - 1.041844944 * RATIO_NIR_SEPTNIR
+            a = BLUE
+            a *= -0.038684824
+            SWIR1 *= 0.02826867
+            a += SWIR1
+            SEPTB4 *= -0.007525455
+            a += SEPTB4
+            RATIO_GREEN_NIR *= 1.023724916
+            a += RATIO_GREEN_NIR
+            RATIO_NIR_SEPTNIR *= -1.041844944
+            a += RATIO_NIR_SEPTNIR
+            a += 5.293739862
+
+            # a_safe y exponencial sobre el mismo vector
+            np.minimum(a, 50, out=a)
+            np.exp(a, out=a)
+            a -= 0.01
+
+        DEPTH_ = np.full(FLOOD.shape, -9999, dtype=np.float32)
+        DEPTH_.ravel()[agua_idx] = a
+
+        profile = self.perfil('swir1')
         profile.update(nodata=-9999)
         profile.update(dtype=rasterio.float32)
         #profile.update(driver='GTiff')
 
         with rasterio.open(self.depth_escena, 'w', **profile) as dst:
-            dst.write(DEPTH_.astype(rasterio.float32))
+            dst.write(DEPTH_, 1)
 
         try:
         
@@ -1453,7 +1689,7 @@ class Product(object):
         print("Resultado subida GeoNetwork:", resultado)
 
 
-    def run(self):
+    def run(self, filas_flood=None):
         """
         Execute the complete product generation workflow.
     
@@ -1473,21 +1709,32 @@ class Product(object):
         9. Transfer products to remote servers
         10. Extract coastline
         11. Generate and publish metadata to GeoNetwork
+
+        Parameters
+        ----------
+        filas_flood : int, optional
+            Rows per block for a windowed computation of the indices and the flood 
+            classification with bounded memory (see `calcular_indices(cachear=False)` 
+            and `flood`): nothing is cached until turbidity. None processes the whole 
+            scene at once (default).
         
         Raises
         ------
-        Exception
-            If any product generation step fails.
+        teselas.DatosTeselaError
+            If an ancillary file of the tile is missing. Other errors are 
+            printed and the run stops.
         """
         
         try:
             print('Comenzando el procesamiento de productos...')
     
-            # Calculate products
-            self.ndvi()
-            self.ndwi()
-            self.mndwi()
-            self.flood()
+            # Calculate products (NDVI, NDWI and MNDWI in one pass). With filas_flood the
+            # indices are streamed to disk and not cached, so flood reads them block by block
+            if filas_flood:
+                self.calcular_indices(('ndvi', 'ndwi', 'mndwi'), filas=filas_flood, cachear=False)
+            else:
+                self.calcular_indices(('ndvi', 'ndwi', 'mndwi'))
+            self.flood(filas=filas_flood)
             self.turbidity()
             self.depth()
     
@@ -1516,6 +1763,9 @@ class Product(object):
             self.generate_composition_rgb()
             self.generate_flood_mask()
 
+            # Las bandas de la caché ya no se necesitan
+            self.liberar()
+
             # Coastline extraction
             c = Coast(self.pro_escena)
             c.run()
@@ -1550,6 +1800,15 @@ class Product(object):
             for attr, nombre in nombres_productos.items():
                 if getattr(self, attr, None) is not None:
                     self.productos_generados.append(nombre)
+
+            # Registramos los productos en el manifiesto de la escena
+            self.manifest.escanear('pro')
+            self.manifest.guardar(self.ruta_manifest)
     
+        except DatosTeselaError:
+            # Faltan datos de la tesela: no es un fallo puntual de la escena y no se oculta
+            raise
         except Exception as e:
             print(f"Error durante el procesamiento: {e}")
+        finally:
+            self.liberar()
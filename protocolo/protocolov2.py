@@ -6,24 +6,373 @@ import stat
 import shutil
 import re
 import time
+import tempfile
 
 import numpy as np
+import geopandas as gpd
 import seaborn as sns; sns.set(color_codes=True)
 import matplotlib.pyplot as plt
 
 from osgeo import gdal, gdalconst
 from urllib.request import urlopen
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
 from datetime import datetime
 from scipy import ndimage
-from scipy.stats import linregress
+from rasterio.windows import Window
+from rasterio.features import rasterize
+from rasterio.transform import Affine
+from rasterio.enums import Resampling
 
 # MongoDB Database
-from pymongo import MongoClient
-client = MongoClient()
+from conexion import Perezosa
+from qa import mascara_qa
+from teselas import config_tesela, id_tesela, requerir, DatosTeselaError
+from manifest import SceneManifest
+from enlaces import enlazar
+database = Perezosa('Satelites')
+db = Perezosa('Satelites', 'Landsat')
 
-database = client.Satelites
-db = database.Landsat
+# Malla de salida comun a todas las escenas (xmin, ymin, xmax, ymax) y resolucion
+EXTENT = (633570, 4053510, 851160, 4249530) # Ventana de la tesela 202_34 (ver teselas.TESELAS)
+RES = 30
 
+# Filas por ventana del almacen de PIAs: la normalizacion solo lee de cada banda las ventanas con PIAs
+FILAS_PIAS = 256
+
+# Superficie (m2) de las zonas usadas para el porcentaje de nubes
+AREA_PN = 533740500
+AREA_RBIOS = 2680000000  # TODO: Adjust this value to match the actual area of RBIOS.shp
+
+# Coeficientes de reflectividad de superficie (Coleccion 2 Level-2)
+SR_ESCALA = 0.0000275
+SR_OFFSET = -0.2
+
+# Clases de las areas pseudo invariantes en Equilibrada.tif / NoEquilibrada.tif
+PIAS_CLASES = {1: 'Mar', 2: 'Embalses', 3: 'Pinar', 4: 'Urbano-1', 5: 'Urbano-2',
+               6: 'Aeropuertos', 7: 'Arena', 8: 'Pastizales', 9: 'Mineria'}
+
+
+def ventanas(height, width, filas):
+
+    """
+    Split a raster in horizontal blocks of `filas` rows.
+
+    Parameters
+    ----------
+    height, width : int
+        Raster size in pixels.
+
+    filas : int
+        Rows per block.
+
+    Yields
+    ------
+    rasterio.windows.Window
+        Window of each block, from top to bottom.
+    """
+
+    for fila in range(0, height, filas):
+        yield Window(0, fila, width, min(filas, height - fila))
+
+
+def reflectividad(DN):
+
+    """
+    Convert Collection 2 surface reflectance digital numbers to reflectance.
+
+    Applies the scale and offset, clips to [0, 1] and keeps -9999 as NoData, 
+    as `Landsat.coef_sr_st` does for the rad bands.
+
+    Parameters
+    ----------
+    DN : numpy.ndarray
+        Int32 values of a geo band.
+
+    Returns
+    -------
+    numpy.ndarray
+        Float32 reflectance.
+    """
+
+    sr = DN.astype(np.float32)
+    sr *= np.float32(SR_ESCALA)
+    sr += np.float32(SR_OFFSET)
+    np.clip(sr, 0, 1, out=sr)
+    sr[DN == -9999] = -9999
+
+    return sr
+
+
+# Resultado de un ajuste imposible (menos de dos muestras o `x` constante): no pasa `_ajuste_valido`
+AJUSTE_FALLIDO = (float('nan'), float('nan'), float('nan'))
+
+
+def ajustable(x):
+
+    """
+    Check that a line can be fitted to the samples: at least two and `x` not constant.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        1D samples of the independent variable.
+
+    Returns
+    -------
+    bool
+    """
+
+    return x.size >= 2 and bool(np.ptp(x) > 0)
+
+
+def regresion_lineal(x, y):
+
+    """
+    Ordinary least squares fit of `y` on `x` from sufficient statistics.
+
+    Equivalent to the slope, intercept and r of `scipy.stats.linregress`, computed 
+    from the sums and cross-products of the samples without building intermediate arrays.
+
+    Parameters
+    ----------
+    x, y : numpy.ndarray
+        1D float64 samples of the same size.
+
+    Returns
+    -------
+    tuple of float
+        Slope, intercept and correlation coefficient r. `AJUSTE_FALLIDO` (NaN) with 
+        fewer than two samples or no variance in `x`.
+    """
+
+    if not ajustable(x):
+        return AJUSTE_FALLIDO
+
+    n = x.size
+    sx = x.sum()
+    sy = y.sum()
+    ssxm = np.dot(x, x) - sx * sx / n
+    ssym = np.dot(y, y) - sy * sy / n
+    ssxym = np.dot(x, y) - sx * sy / n
+
+    slope = ssxym / ssxm
+    intercept = (sy - slope * sx) / n
+
+    if ssxm == 0 or ssym == 0:
+        r = 0.0
+    else:
+        r = min(max(ssxym / np.sqrt(ssxm * ssym), -1.0), 1.0)
+
+    return float(slope), float(intercept), float(r)
+
+
+def theil_sen(x, y, max_pares=200000, semilla=0):
+
+    """
+    Theil-Sen fit of `y` on `x`: median of the pairwise slopes.
+
+    All pairs are used while there are at most `max_pares`; above that a fixed 
+    pseudo-random subset of pairs is drawn, so the cost is bounded and the result 
+    is reproducible.
+
+    Parameters
+    ----------
+    x, y : numpy.ndarray
+        1D float64 samples of the same size.
+
+    max_pares : int, optional
+        Maximum number of pairs evaluated (default is 200000).
+
+    semilla : int, optional
+        Seed of the pair subset (default is 0).
+
+    Returns
+    -------
+    tuple of float
+        Slope, intercept and correlation coefficient r, as `regresion_lineal` 
+        (`AJUSTE_FALLIDO` when no line can be fitted).
+    """
+
+    if not ajustable(x):
+        return AJUSTE_FALLIDO
+
+    n = x.size
+    if n * (n - 1) // 2 <= max_pares:
+        i, j = np.triu_indices(n, 1)
+    else:
+        rng = np.random.default_rng(semilla)
+        i = rng.integers(0, n, max_pares)
+        j = rng.integers(0, n, max_pares)
+
+    dx = x[j] - x[i]
+    distintos = dx != 0
+    if not distintos.any():
+        return AJUSTE_FALLIDO
+    slope = float(np.median((y[j] - y[i])[distintos] / dx[distintos]))
+    intercept = float(np.median(y - slope * x))
+
+    return slope, intercept, regresion_lineal(x, y)[2]
+
+
+def ransac(x, y, n_candidatos=500, semilla=0):
+
+    """
+    RANSAC-style consensus fit of `y` on `x`.
+
+    Lines through `n_candidatos` fixed pseudo-random pairs of samples are scored by 
+    the number of samples within 2.5 robust standard deviations (MAD of the 
+    Theil-Sen residuals), and the final line is the least squares fit of the 
+    largest consensus set.
+
+    Parameters
+    ----------
+    x, y : numpy.ndarray
+        1D float64 samples of the same size.
+
+    n_candidatos : int, optional
+        Number of candidate lines (default is 500).
+
+    semilla : int, optional
+        Seed of the candidate pairs (default is 0).
+
+    Returns
+    -------
+    tuple of float
+        Slope, intercept and correlation coefficient r, as `regresion_lineal` 
+        (`AJUSTE_FALLIDO` when no line can be fitted).
+    """
+
+    if not ajustable(x):
+        return AJUSTE_FALLIDO
+
+    slope, intercept, _ = theil_sen(x, y, semilla=semilla)
+    if not np.isfinite(slope):
+        return AJUSTE_FALLIDO
+    residuo = y - slope * x - intercept
+    tolerancia = 2.5 * 1.4826 * np.median(np.abs(residuo - np.median(residuo)))
+
+    rng = np.random.default_rng(semilla)
+    i = rng.integers(0, x.size, n_candidatos)
+    j = rng.integers(0, x.size, n_candidatos)
+    validos = x[j] != x[i]
+    i, j = i[validos], j[validos]
+    pendientes = (y[j] - y[i]) / (x[j] - x[i])
+    ordenadas = y[i] - pendientes * x[i]
+
+    # Incluimos la recta de Theil-Sen como candidata para que el consenso nunca sea peor
+    pendientes = np.append(pendientes, slope)
+    ordenadas = np.append(ordenadas, intercept)
+    consenso = [np.count_nonzero(np.abs(y - p * x - o) <= tolerancia) for p, o in zip(pendientes, ordenadas)]
+    mejor = int(np.argmax(consenso))
+
+    dentro = np.abs(y - pendientes[mejor] * x - ordenadas[mejor]) <= tolerancia
+    return regresion_lineal(x[dentro], y[dentro])
+
+
+def muestra_estratificada(clases, max_por_clase, semilla=0):
+
+    """
+    Deterministic class-stratified sample of sample indices.
+
+    Every class keeps all its samples up to `max_por_clase`; larger classes are 
+    reduced to `max_por_clase` samples drawn with a fixed seed.
+
+    Parameters
+    ----------
+    clases : numpy.ndarray
+        1D array of non-negative integer classes (PIA class of each sample).
+
+    max_por_clase : int
+        Maximum number of samples per class.
+
+    semilla : int, optional
+        Seed of the draw (default is 0).
+
+    Returns
+    -------
+    numpy.ndarray
+        Sorted indices of the selected samples.
+    """
+
+    if clases.size == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    rng = np.random.default_rng(semilla)
+    orden = np.argsort(clases, kind='stable')
+    limites = np.concatenate(([0], np.cumsum(np.bincount(clases))))
+
+    seleccion = []
+    for c in range(limites.size - 1):
+        indices = orden[limites[c]:limites[c + 1]]
+        if indices.size > max_por_clase:
+            indices = rng.choice(indices, max_por_clase, replace=False)
+        seleccion.append(indices)
+
+    return np.sort(np.concatenate(seleccion))
+
+
+def sumas_por_clases(x, y, clases, n_clases=10):
+
+    """
+    Grouped sufficient statistics of a regression of `y` on `x` per class.
+
+    Parameters
+    ----------
+    x, y : numpy.ndarray
+        1D float64 samples of the same size.
+
+    clases : numpy.ndarray
+        1D non-negative integer class of each sample.
+
+    n_clases : int, optional
+        Minimum length of the output arrays (default is 10, the PIA classes and 0).
+
+    Returns
+    -------
+    dict
+        `n`, `sx`, `sy`, `sxx`, `syy` and `sxy` arrays indexed by class, each one 
+        computed with a single weighted `bincount`.
+    """
+
+    return {'n': np.bincount(clases, minlength=n_clases).astype(np.float64),
+            'sx': np.bincount(clases, weights=x, minlength=n_clases),
+            'sy': np.bincount(clases, weights=y, minlength=n_clases),
+            'sxx': np.bincount(clases, weights=x * x, minlength=n_clases),
+            'syy': np.bincount(clases, weights=y * y, minlength=n_clases),
+            'sxy': np.bincount(clases, weights=x * y, minlength=n_clases)}
+
+
+def lineal_desde_sumas(sumas):
+
+    """
+    Least squares fit from sufficient statistics, vectorized over classes.
+
+    Works on the arrays of `sumas_por_clases` (one fit per class) or on their totals 
+    (the pooled fit, equal to `regresion_lineal` on all the samples). Classes with 
+    fewer than two samples or no variance give NaN.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        Slope, intercept, correlation coefficient r and standard deviation of the residuals.
+    """
+
+    n, sx, sy = sumas['n'], sumas['sx'], sumas['sy']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ssxm = sumas['sxx'] - sx * sx / n
+        ssym = sumas['syy'] - sy * sy / n
+        ssxym = sumas['sxy'] - sx * sy / n
+
+        slope = ssxym / ssxm
+        intercept = (sy - slope * sx) / n
+        r = np.clip(ssxym / np.sqrt(ssxm * ssym), -1.0, 1.0)
+        std = np.sqrt(np.maximum(ssym - slope * ssxym, 0) / n)
+
+    return slope, intercept, r, std
+
+
+ESTIMADORES = {'ols': regresion_lineal, 'theilsen': theil_sen, 'ransac': ransac}
 
 
 class Landsat:
@@ -45,7 +394,7 @@ class Landsat:
                and prepares MongoDB insertion document.
     """
     
-    def __init__(self, ruta_escena, inicializar=True):
+    def __init__(self, ruta_escena, inicializar=True, bloque=None, perezoso=False, quicklook='usgs', tar=None):
 
         """
         Initialize a Landsat object from a given scene path.
@@ -64,6 +413,27 @@ class Landsat:
             Whether to perform full initialization, including metadata parsing, 
             folder creation, and MongoDB insertion (default is True).
 
+        bloque : int, optional
+            Number of rows per block for the windowed stages (`coef_sr_st`, `nor2l8`). 
+            None processes whole bands in memory (default).
+
+        perezoso : bool, optional
+            Only parse the scene. Output folders, quicklook and MongoDB document are 
+            created by `preparar()` when the first processing stage runs, so archived 
+            scenes can be instantiated for analysis or backfills without side effects 
+            (default is False).
+
+        quicklook : {'usgs', 'local'}, optional
+            Download the quicklook from USGS (default) or build it locally from 
+            decimated reads of the SR bands with `generar_quicklook()`.
+
+        tar : str, optional
+            Path to the downloaded `.tar` of the scene. The original bands and the MTL 
+            are then read straight from the archive through GDAL's `/vsitar/` filesystem 
+            and nothing is extracted; `ruta_escena` only holds the quicklook and masks. 
+            The Landsat 7 SLC-off gapfill, which writes the original bands, extracts 
+            just those bands.
+
         Attributes
         ----------
         escena : str
@@ -94,10 +464,22 @@ class Landsat:
             List of spectral bands successfully normalized for this scene.
 
         cloud_mask_values : list of int
-            Values used to identify cloud or fill pixels, depending on the sensor.
+            Clear land and clear water QA_PIXEL values of the sensor. Kept for reference, 
+            the masks are built with the lookup tables of `qa.mascara_qa`.
+
+        tesela : dict
+            Configuration of the scene's WRS-2 tile (extent, reference scene, PIA 
+            rasters and ancillary files), see `teselas.config_tesela`.
+
+        extent : tuple or None
+            Study window of the tile, resolved by `get_extent` when not fixed.
+
+        manifest : SceneManifest
+            Index of the scene files in every stage, built from one `os.scandir` per 
+            folder and saved to `ruta_manifest` (`nor_escena/manifest.json`) by `run`.
 
         qk_name : str
-            Path to the downloaded Landsat quicklook JPEG.
+            Path to the Landsat quicklook JPEG (downloaded or generated).
 
         pn_cover : float or None
             Percentage of cloud cover over Doñana, set later in processing.
@@ -108,6 +490,10 @@ class Landsat:
 
         
         self.ruta_escena = ruta_escena
+        self.bloque = bloque
+        self.quicklook = quicklook
+        self.tar = tar
+        self.preparada = False
 
         if not inicializar:
             return
@@ -142,19 +528,25 @@ class Landsat:
             self.last_name = (self.escena_date + self.sat + self.sensor + self.path + '_' + self.row[1:]).lower()
 
         self.pro_escena = os.path.join(self.pro, self.last_name)
-        os.makedirs(self.pro_escena, exist_ok=True)
 
         self.geo_escena = os.path.join(self.geo, self.last_name)
-        os.makedirs(self.geo_escena, exist_ok=True)
 
         self.rad_escena = os.path.join(self.rad, self.last_name)
-        os.makedirs(self.rad_escena, exist_ok=True)
 
         self.nor_escena = os.path.join(self.nor, self.last_name)
-        os.makedirs(self.nor_escena, exist_ok=True)
 
-        self.equilibrado = os.path.join(self.data, 'Equilibrada.tif')
-        self.noequilibrado = os.path.join(self.data, 'NoEquilibrada.tif')
+        # Indice de los ficheros de la escena en todas las etapas, compartido por todos los pasos
+        self.manifest = SceneManifest({'ori': self.ruta_escena, 'geo': self.geo_escena, 'rad': self.rad_escena,
+                                       'nor': self.nor_escena, 'pro': self.pro_escena}, self.last_name,
+                                      tars={'ori': tar} if tar else None)
+        self.ruta_manifest = os.path.join(self.nor_escena, 'manifest.json')
+
+        # Extent, referencias, PIAs y auxiliares de la tesela WRS-2 de la escena
+        self.tesela = config_tesela(id_tesela(self.path, self.row), self.data)
+        self.extent = self.tesela['extent']
+
+        self.equilibrado = self.tesela['equilibrada']
+        self.noequilibrado = self.tesela['noequilibrada']
         self.parametrosnor = {}
         self.iter = 1
 
@@ -162,38 +554,21 @@ class Landsat:
         self.bandas_normalizadas = []
 
         self.mtl = {}
-        for i in os.listdir(self.ruta_escena):
-            if i.endswith('MTL.txt'):
-                mtl = os.path.join(self.ruta_escena, i)
-                with open(mtl, 'r') as f:
-                    for line in f.readlines():
-                        if "=" in line:
-                            l = line.split("=")
-                            self.mtl[l[0].strip()] = l[1].strip()
-
-        if self.sat in ['L8', 'L9']:
-            for i in os.listdir(self.ruta_escena):
-                if i.endswith('.TIF'):
-                    banda = os.path.splitext(i)[0].split('_')[-1]
-                    setattr(self, banda.lower(), os.path.join(self.ruta_escena, i))
-        elif self.sat in ['L7', 'L5']:
-            for i in os.listdir(self.ruta_escena):
-                if i.endswith('.TIF'):
-                    banda = os.path.splitext(i)[0].split('_')[-1]
-                    setattr(self, banda.lower(), os.path.join(self.ruta_escena, i))
+        mtl = self.manifest.leer_texto('ori', 'MTL.txt')
+        if mtl:
+            for line in mtl.splitlines():
+                if "=" in line:
+                    l = line.split("=")
+                    self.mtl[l[0].strip()] = l[1].strip()
+
+        if self.sat in ['L8', 'L9', 'L7', 'L5']:
+            for clave, ruta in self.manifest.ficheros('ori').items():
+                if ruta.endswith('.TIF'):
+                    banda = clave.split('_')[-1]
+                    setattr(self, banda.lower(), ruta)
 
-        url_base = 'https://landsatlook.usgs.gov/gen-browse?size=rrb&type=refl&product_id={}'.format(self.mtl['LANDSAT_PRODUCT_ID'].strip('""'))
         self.qk_name = os.path.join(self.ruta_escena, self.escena + '_Quicklook.jpeg')
 
-        if not os.path.exists(self.qk_name):
-            with open(self.qk_name, 'wb') as qk:
-                qk.write(urlopen(url_base).read())
-            print('Quicklook descargado')
-        else:
-            print('El Quicklook ya estaba previamente descargado')
-
-        print('Landsat iniciada con éxito')
-
         self.pn_cover = None
         self.newesc = {
             '_id': self.last_name,
@@ -212,15 +587,151 @@ class Landsat:
             }
         }
 
+        if perezoso:
+            print('Landsat iniciada en modo perezoso')
+        else:
+            self.preparar()
+
+
+    def preparar(self):
+
+        """
+        Run the side effects of scene initialization once.
+
+        Creates the scene folders in `pro`, `geo`, `rad` and `nor`, gets the 
+        quicklook and inserts the scene document into MongoDB. It is called by 
+        the constructor, or by the first processing stage when the object was 
+        created with `perezoso=True`; later calls do nothing.
+        """
+
+        if self.preparada:
+            return
+
+        # Con tar, ruta_escena solo guarda el quicklook y las mascaras
+        for carpeta in [self.ruta_escena, self.pro_escena, self.geo_escena, self.rad_escena, self.nor_escena]:
+            os.makedirs(carpeta, exist_ok=True)
+
+        self.get_quicklook()
+        print('Landsat iniciada con éxito')
+
         try:
             db.insert_one(self.newesc)
         except Exception:
             db.update_one({'_id': self.last_name}, {'$set': {'Info.Iniciada': datetime.now()}}, upsert=True)
 
         print('Landsat instanciada y subida a la base de datos')
+        self.preparada = True
+
+
+    def get_quicklook(self):
+
+        """
+        Get the scene quicklook into `qk_name` if it does not exist yet.
+
+        Depending on the `quicklook` option of the constructor it is downloaded 
+        from the USGS LandsatLook service ('usgs') or generated locally with 
+        `generar_quicklook` ('local').
+        """
+
+        if os.path.exists(self.qk_name):
+            print('El Quicklook ya estaba previamente descargado')
+            return
+
+        if self.quicklook == 'local':
+            self.generar_quicklook()
+            print('Quicklook generado')
+            return
+
+        url_base = 'https://landsatlook.usgs.gov/gen-browse?size=rrb&type=refl&product_id={}'.format(self.mtl['LANDSAT_PRODUCT_ID'].strip('""'))
+        with open(self.qk_name, 'wb') as qk:
+            qk.write(urlopen(url_base).read())
+        print('Quicklook descargado')
+
+
+    def generar_quicklook(self, factor=16, salida=None):
+
+        """
+        Build the browse JPEG from decimated reads of the SR bands, without network access.
+
+        The SWIR1, NIR and blue bands are read at 1/`factor` of their resolution, 
+        converted to reflectance and stretched as in the RGB composition of the 
+        products (0-0.45 for SWIR1 and NIR, 0-0.2 for blue). Fill pixels are white.
+
+        Parameters
+        ----------
+        factor : int, optional
+            Decimation factor of the reads (default is 16, about 480 m pixels).
+
+        salida : str, optional
+            Output path. Defaults to `qk_name`.
+
+        Returns
+        -------
+        str
+            Path to the generated JPEG.
+        """
+
+        salida = salida or self.qk_name
+        bandas = [('b6', 0.45), ('b5', 0.45), ('b2', 0.2)] if self.sensor == 'OLI' else [('b5', 0.45), ('b4', 0.45), ('b1', 0.2)]
+
+        canales = []
+        relleno = None
+        for banda, maximo in bandas:
+            with rasterio.open(getattr(self, banda)) as src:
+                DN = src.read(1, out_shape=(max(1, src.height // factor), max(1, src.width // factor)),
+                              resampling=Resampling.nearest)
+            relleno = (DN == 0) if relleno is None else relleno & (DN == 0)
+            sr = DN * SR_ESCALA + SR_OFFSET
+            canales.append(np.clip(sr / maximo, 0, 1))
+
+        rgb = np.dstack(canales)
+        rgb[relleno] = 1
+
+        plt.imsave(salida, (rgb * 255).astype(np.uint8), format='jpeg')
+
+        return salida
+
+
+    def get_extent(self):
+
+        """
+        Return the study window of the scene's WRS-2 tile.
+
+        Tiles with a fixed extent in `teselas.TESELAS` use it (202_34 keeps the 
+        historical `EXTENT`). Otherwise it is the bounding box of the intersection of 
+        the tile footprint with the Biosphere Reserve, in the CRS of the scene and 
+        snapped outwards to the 30 m grid, computed once per object.
+
+        Returns
+        -------
+        tuple
+            (xmin, ymin, xmax, ymax) in the CRS of the scene.
+
+        Raises
+        ------
+        teselas.DatosTeselaError
+            If the extent has to be computed and the tile footprint (`wrs_PPPRRR.shp`)
+            or `RBIOS.shp` is missing.
+        """
+
+        if self.extent is None:
+            wrs, rbios = requerir(self.tesela, 'wrs', os.path.join(self.data, 'RBIOS.shp'))
+            qa = self.manifest.ruta('ori', 'QA_PIXEL')
+            with rasterio.open(qa) as src:
+                crs = src.crs
+
+            huella = gpd.read_file(wrs).to_crs(crs).unary_union
+            rbios = gpd.read_file(rbios).to_crs(crs).unary_union
+            xmin, ymin, xmax, ymax = huella.intersection(rbios).bounds
+
+            self.extent = (int(np.floor(xmin / RES) * RES), int(np.floor(ymin / RES) * RES),
+                           int(np.ceil(xmax / RES) * RES), int(np.ceil(ymax / RES) * RES))
+            print('Extent de la tesela', self.tesela['id'], self.extent)
 
+        return self.extent
 
-    def get_hillshade(self):
+
+    def get_hillshade(self, decimales=1, metodo='gdaldem'):
 
         """
         Generate a hillshade raster using a fixed DTM and scene solar metadata.
@@ -229,18 +740,53 @@ class Landsat:
         to compute a hillshade raster from a pre-defined Digital Terrain Model (DTM)
         specific to path/row 202/034. The result is saved in the `nor` folder of the scene.
 
+        With `metodo='numpy'` the hillshade is evaluated with numpy from the slope and 
+        aspect terms of the DTM, computed once and cached (see `_terreno_dtm`), using the 
+        same Horn algorithm as `gdaldem hillshade`. Hillshades are cached in 
+        `data/hillshades` by solar angles rounded to `decimales`, since many acquisitions 
+        share almost the same sun geometry, and the 30th percentile used by 
+        `Product.flood` as shadow threshold is stored as the `UMBRAL_SOMBRA` tag of the 
+        raster.
+
+        Parameters
+        ----------
+        decimales : int or None, optional
+            Decimals the sun azimuth and elevation are rounded to for the cache 
+            in the numpy method (default is 1). None keeps the exact angles.
+
+        metodo : str, optional
+            'gdaldem' (default) to call `gdaldem hillshade` with the exact angles of 
+            the scene, or 'numpy'.
+
         Raises
         ------
         RuntimeError
             If the `gdaldem hillshade` command fails during execution.
         """
 
-        dtm = os.path.join(self.data, 'dtm_202_34.tif') #Por defecto esta en 29 y solo para la 202_34
+        self.preparar()
+
+        dtm = self.tesela['dtm'] #En el CRS de la escena (29 para la 202_34)
         azimuth = self.mtl['SUN_AZIMUTH']
         elevation = self.mtl['SUN_ELEVATION']
         
         #Una vez tenemos estos parametros generamos el hillshade
         salida = os.path.join(self.nor_escena, 'hillshade.tif')
+
+        if metodo == 'numpy':
+            azimuth, elevation = float(azimuth), float(elevation)
+            if decimales is not None:
+                azimuth, elevation = round(azimuth, decimales), round(elevation, decimales)
+            cache = os.path.join(self.tesela['hillshades'], 'hillshade_{}_{}.tif'.format(azimuth, elevation))
+            if not os.path.exists(cache):
+                os.makedirs(os.path.dirname(cache), exist_ok=True)
+                self._hillshade_numpy(dtm, azimuth, elevation, cache)
+            else:
+                print('Hillshade reutilizado de', cache)
+            enlazar(cache, salida)
+            print('Hillshade generado')
+            return
+
         cmd = ["gdaldem", "hillshade", "-az", "-alt", "-of", "GTIFF"]
         cmd.append(dtm)
         cmd.append(salida)
@@ -256,6 +802,146 @@ class Landsat:
         else:
             print(stdout)
             print('Hillshade generado')
+
+
+    def _terreno_dtm(self, dtm):
+
+        """
+        Return the slope and aspect terms of the DTM, computing them only once.
+
+        The Horn gradients of the DTM are reduced to three float32 arrays that do not 
+        depend on the sun position: the cosine of the slope and the two components of 
+        the slope direction scaled by the sine of the slope. They are stored in 
+        `data/<dtm>_terreno.npz` and rebuilt only when the DTM file changes.
+
+        Parameters
+        ----------
+        dtm : str
+            Path to the DTM.
+
+        Returns
+        -------
+        dict
+            `cos_pendiente`, `orient_x`, `orient_y` (float32 arrays) and `valido` 
+            (bool array, False on the edges and next to DTM NoData, as in gdaldem).
+        """
+
+        ruta = os.path.splitext(dtm)[0] + '_terreno.npz'
+        firma = '{}:{}:{}'.format(os.path.split(dtm)[1], os.stat(dtm).st_size, int(os.stat(dtm).st_mtime))
+
+        if os.path.exists(ruta):
+            with np.load(ruta) as cache:
+                if str(cache['firma']) == firma:
+                    return {k: cache[k] for k in ('cos_pendiente', 'orient_x', 'orient_y', 'valido')}
+
+        print('Calculando pendiente y orientacion del DTM en', ruta)
+
+        with rasterio.open(dtm) as src:
+            Z = src.read(1).astype(np.float64)
+            ewres, nsres = src.transform.a, src.transform.e
+            nodata = src.nodata
+
+        # Ventana 3x3 de Horn (a b c / d e f / g h i) sobre el interior del raster
+        a, b, c = Z[:-2, :-2], Z[:-2, 1:-1], Z[:-2, 2:]
+        d, f = Z[1:-1, :-2], Z[1:-1, 2:]
+        g, h, i = Z[2:, :-2], Z[2:, 1:-1], Z[2:, 2:]
+
+        x = ((a + 2 * d + g) - (c + 2 * f + i)) / (8 * ewres)
+        y = ((g + 2 * h + i) - (a + 2 * b + c)) / (8 * nsres)
+        cos_pendiente = 1 / np.sqrt(1 + x * x + y * y)
+
+        valido = np.zeros(Z.shape, dtype=bool)
+        valido[1:-1, 1:-1] = True
+        if nodata is not None:
+            nd = (Z == nodata)
+            vecino = np.zeros(Z.shape, dtype=bool)
+            for dy in (-1, 0, 1):
+                for dx in (-1, 0, 1):
+                    vecino[1:-1, 1:-1] |= nd[1 + dy:Z.shape[0] - 1 + dy, 1 + dx:Z.shape[1] - 1 + dx]
+            valido &= ~vecino
+
+        terreno = {'cos_pendiente': np.zeros(Z.shape, dtype=np.float32), 'orient_x': np.zeros(Z.shape, dtype=np.float32),
+                   'orient_y': np.zeros(Z.shape, dtype=np.float32), 'valido': valido}
+        terreno['cos_pendiente'][1:-1, 1:-1] = cos_pendiente
+        terreno['orient_x'][1:-1, 1:-1] = x * cos_pendiente
+        terreno['orient_y'][1:-1, 1:-1] = y * cos_pendiente
+
+        # Temporal unico en la misma carpeta: varias escenas pueden estar generando la misma cache
+        fd, tmp = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(ruta))
+        os.close(fd)
+        try:
+            np.savez(tmp, firma=np.array(firma), **terreno)
+            os.replace(tmp, ruta)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        return terreno
+
+
+    def _hillshade_numpy(self, dtm, azimuth, elevation, salida):
+
+        """
+        Write the hillshade of the DTM for a sun position and store its shadow threshold.
+
+        The shade is `1 + 254 * cos(angle)` (1 where the angle is over 90 degrees) and 0 
+        on NoData, as `gdaldem hillshade` writes it. The 30th percentile of the raster 
+        is saved in the `UMBRAL_SOMBRA` tag so `Product.flood` does not recompute it.
+
+        Parameters
+        ----------
+        dtm : str
+            Path to the DTM.
+
+        azimuth : float
+            Sun azimuth in degrees.
+
+        elevation : float
+            Sun elevation in degrees.
+
+        salida : str
+            Path to the output GeoTIFF.
+        """
+
+        terreno = self._terreno_dtm(dtm)
+
+        az = np.radians(azimuth)
+        alt = np.radians(elevation)
+        # Coeficientes de la iluminacion: lo unico que cambia entre escenas
+        k0 = np.float32(np.sin(alt))
+        kx = np.float32(np.sin(az) * np.cos(alt))
+        ky = np.float32(np.cos(az) * np.cos(alt))
+
+        cang = terreno['cos_pendiente'] * k0
+        cang += terreno['orient_x'] * kx
+        cang -= terreno['orient_y'] * ky
+        cang *= 254
+        np.maximum(cang, 0, out=cang)
+        cang += 1.5
+        HS = cang.astype(np.uint8)
+        HS[~terreno['valido']] = 0
+
+        umbral = float(np.percentile(HS, 30))
+
+        with rasterio.open(dtm) as src:
+            profile = src.profile
+        profile.update(driver='GTiff', dtype='uint8', nodata=0, count=1, compress='lzw')
+
+        # Temporal unico en la misma carpeta: escenas y teselas en paralelo con los mismos angulos
+        # redondeados escriben la misma cache, y cada una debe renombrar un fichero completo
+        fd, tmp = tempfile.mkstemp(suffix='.tif', dir=os.path.dirname(salida))
+        os.close(fd)
+        try:
+            with rasterio.open(tmp, 'w', **profile) as dst:
+                dst.write(HS, 1)
+                dst.update_tags(UMBRAL_SOMBRA=umbral, SUN_AZIMUTH=azimuth, SUN_ELEVATION=elevation)
+            os.replace(tmp, salida)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        print('Hillshade calculado para azimut {} y elevacion {} (umbral de sombra {})'.format(azimuth, elevation, umbral))
         
         
     def get_cloud_pn(self):
@@ -277,12 +963,12 @@ class Landsat:
             If an error occurs while updating the MongoDB document.
         """
 
+        self.preparar()
+
         shape = os.path.join(self.data, 'Limites_PN_Donana.shp')
         crop = "-crop_to_cutline"
 
-        for i in os.listdir(self.ruta_escena):
-            if i.endswith('QA_PIXEL.TIF'):
-                cloud = os.path.join(self.ruta_escena, i)
+        cloud = self.manifest.ruta('ori', 'QA_PIXEL')
 
         #usamos Gdalwarp para realizar las mascaras, llamandolo desde el modulo subprocess
         cmd = ["gdalwarp", "-dstnodata" , "0" , "-cutline", ]
@@ -307,7 +993,7 @@ class Landsat:
         ds = gdal.Open(salida)
         cloud = np.array(ds.GetRasterBand(1).ReadAsArray())
         
-        mask = (cloud == self.cloud_mask_values[0]) | (cloud == self.cloud_mask_values[1])
+        mask = mascara_qa(cloud, self.sensor)
         
         #################
         ##### DEFINIR LOS VALORES PARA LA MASCARA Y AÑADIR EL DATO A MONGO
@@ -316,8 +1002,7 @@ class Landsat:
         #print(cloud_msk.size)
         clouds = float(cloud_msk.size * 900)
         #print(clouds)
-        PN = 533740500 
-        self.pn_cover = round(100 - (clouds/PN) * 100, 2)
+        self.pn_cover = round(100 - (clouds/AREA_PN) * 100, 2)
         ds = None
         cloud = None
         cloud_msk = None
@@ -349,7 +1034,7 @@ class Landsat:
     
         Notes
         -----
-        The area constant (RBIOS_AREA) must be adjusted to match the actual area 
+        The area constant (AREA_RBIOS) must be adjusted to match the actual area 
         of the RBIOS.shp shapefile in square meters.
     
         Raises
@@ -363,13 +1048,13 @@ class Landsat:
         --------
         get_cloud_pn : Calculate cloud coverage over Doñana National Park.
         """
+
+        self.preparar()
         
         shape = os.path.join(self.data, 'RBIOS.shp')
         crop = "-crop_to_cutline"
     
-        for i in os.listdir(self.ruta_escena):
-            if i.endswith('QA_PIXEL.TIF'):
-                cloud = os.path.join(self.ruta_escena, i)
+        cloud = self.manifest.ruta('ori', 'QA_PIXEL')
     
         cmd = ["gdalwarp", "-dstnodata", "0", "-cutline"]
         path_masks = os.path.join(self.ruta_escena, 'masks')
@@ -391,15 +1076,12 @@ class Landsat:
         ds = gdal.Open(salida)
         cloud = np.array(ds.GetRasterBand(1).ReadAsArray())
         
-        mask = (cloud == self.cloud_mask_values[0]) | (cloud == self.cloud_mask_values[1])
+        mask = mascara_qa(cloud, self.sensor)
         
         cloud_msk = cloud[mask]
         clouds = float(cloud_msk.size * 900)
         
-        # TODO: Adjust this value to match the actual area of RBIOS.shp
-        RBIOS_AREA = 2680000000  # Approximately 268,000 ha in m²
-        
-        rbios_cover = round(100 - (clouds/RBIOS_AREA) * 100, 2)
+        rbios_cover = round(100 - (clouds/AREA_RBIOS) * 100, 2)
         self.rbios_cover = rbios_cover
         
         ds = None
@@ -419,45 +1101,272 @@ class Landsat:
         print("El porcentaje de nubes en la Reserva de la Biosfera es de " + str(rbios_cover))
 
 
-    def remove_masks(self):
+    def get_cloud_zonas(self, recintos=True):
 
         """
-        Delete temporary cloud mask files generated during processing.
+        Calculate the cloud coverage of every zone of interest from a single read of QA_PIXEL.
 
-        This method removes all files inside the `masks/` subfolder of the Landsat scene 
-        directory and then deletes the folder itself. It is typically called after 
-        cloud coverage has been calculated and the intermediate mask files are no longer needed.
+        The zones (Doñana National Park, Biosphere Reserve and, optionally, each polygon 
+        of the tile's `Recintos_Marisma.shp`) are rasterized once onto the QA_PIXEL grid and cached 
+        (see `_zonas_nubes`). Only the window of QA_PIXEL covering the zones is read and 
+        the clear land / clear water pixels of each zone are counted from it, with no 
+        `gdalwarp` calls or temporary files.
 
-        Raises
-        ------
-        OSError
-            If any file or the `masks/` folder cannot be deleted.
+        The results use the same definitions as `get_cloud_pn` and `get_cloud_rbios` and 
+        are stored in MongoDB under `Clouds.cloud_PN`, `Clouds.cloud_RBIOS` and 
+        `Clouds.Recintos`.
+
+        Parameters
+        ----------
+        recintos : bool, optional
+            Also compute the coverage of each marsh polygon (default is True).
+
+        Returns
+        -------
+        dict
+            Cloud coverage percentage of each zone.
         """
 
-        path_masks = os.path.join(self.ruta_escena, 'masks')
-        for i in os.listdir(path_masks):
+        self.preparar()
 
-            name = os.path.join(path_masks, i)
-            os.chmod(name, stat.S_IWRITE)
-            os.remove(name)
+        cloud = self.manifest.ruta('ori', 'QA_PIXEL')
 
-        shutil.rmtree(path_masks)
+        with rasterio.open(cloud) as qa:
+            zonas = self._zonas_nubes(qa, recintos)
 
+            res = qa.res[0]
+            col_off = int(round((zonas['origen'][0] - qa.transform.c) / res))
+            row_off = int(round((qa.transform.f - zonas['origen'][1]) / res))
+            rows, cols = zonas['shape']
+            # Fuera de la escena se rellena con 1 (relleno de QA_PIXEL), que no cuenta como despejado
+            QA = qa.read(1, window=Window(col_off, row_off, cols, rows), boundless=True, fill_value=1).ravel()
 
-    def apply_gapfill(self):
+        despejado = mascara_qa(QA, self.sensor)
+        QA = None
 
-        """
-        Apply gap-filling to Landsat 7 bands acquired after June 2003.
+        coberturas = {}
+        for nombre, indices in zonas['indices'].items():
+            claros = float(np.count_nonzero(despejado[indices]) * res * res)
+            area = {'PN': AREA_PN, 'RBIOS': AREA_RBIOS}.get(nombre, indices.size * res * res)
+            coberturas[nombre] = round(100 - (claros / area) * 100, 2) if area else None
 
-        This method detects if the input scene corresponds to Landsat 7 after the 
-        Scan Line Corrector (SLC) failure (June 2003). If so, it uses GDAL's 
-        `FillNodata` algorithm to interpolate missing pixels (gaps) in each 
-        reflectance band.
+        self.pn_cover = coberturas['PN']
+        self.rbios_cover = coberturas['RBIOS']
+        nubes_recintos = {k.split('/', 1)[1]: v for k, v in coberturas.items() if k.startswith('Recintos/')}
 
-        The method only processes the following bands: blue, green, red, nir, swir1, and swir2.
+        cambios = {'Clouds.cloud_PN': self.pn_cover, 'Clouds.cloud_RBIOS': self.rbios_cover}
+        if recintos:
+            cambios['Clouds.Recintos'] = nubes_recintos
 
-        Raises
-        ------
+        try:
+            db.update_one({'_id': self.last_name}, {'$set': cambios}, upsert=True)
+        except Exception as e:
+            print("Unexpected error:", type(e), e)
+
+        print("El porcentaje de nubes en el Parque Nacional es de " + str(self.pn_cover))
+        print("El porcentaje de nubes en la Reserva de la Biosfera es de " + str(self.rbios_cover))
+
+        return coberturas
+
+
+    def triaje_nubes(self, factor=8):
+
+        """
+        Estimate the cloud coverage of PN and RBIOS from a decimated read of QA_PIXEL.
+
+        The window of QA_PIXEL covering the zones is read at 1/`factor` resolution 
+        (nearest neighbour) and the zone masks cached by `_zonas_nubes` are sampled at 
+        the same pixels, so the estimate takes a fraction of a second. It has no side 
+        effects (no folders, quicklook or MongoDB writes) and can be called on a scene 
+        opened with `perezoso=True` to decide whether it is worth processing.
+
+        Parameters
+        ----------
+        factor : int, optional
+            Decimation factor of the read (default is 8, i.e. 240 m pixels).
+
+        Returns
+        -------
+        dict
+            Estimated cloud coverage percentage of 'PN' and 'RBIOS'.
+        """
+
+        cloud = self.manifest.ruta('ori', 'QA_PIXEL')
+
+        with rasterio.open(cloud) as qa:
+            zonas = self._zonas_nubes(qa)
+
+            res = qa.res[0]
+            col_off = int(round((zonas['origen'][0] - qa.transform.c) / res))
+            row_off = int(round((qa.transform.f - zonas['origen'][1]) / res))
+            rows, cols = zonas['shape']
+            h, w = max(1, rows // factor), max(1, cols // factor)
+            QA = qa.read(1, window=Window(col_off, row_off, cols, rows), out_shape=(h, w), boundless=True,
+                         fill_value=1, resampling=Resampling.nearest)
+
+        despejado = mascara_qa(QA, self.sensor)
+        # Pixeles de la malla completa que caen en cada pixel de la lectura diezmada
+        filas = np.floor((np.arange(h) + 0.5) * rows / h).astype(np.int64)
+        columnas = np.floor((np.arange(w) + 0.5) * cols / w).astype(np.int64)
+
+        coberturas = {}
+        for nombre in ('PN', 'RBIOS'):
+            zona = np.zeros(rows * cols, dtype=bool)
+            zona[zonas['indices'][nombre]] = True
+            zona = zona.reshape(rows, cols)[np.ix_(filas, columnas)]
+            total = np.count_nonzero(zona)
+            coberturas[nombre] = round(100 - np.count_nonzero(despejado & zona) / total * 100, 2) if total else None
+
+        print('Triaje de nubes ({}): {}'.format(self.last_name, coberturas))
+
+        return coberturas
+
+
+    def _zonas_nubes(self, qa, recintos=True):
+
+        """
+        Return the zone masks rasterized onto the QA_PIXEL grid, building them if needed.
+
+        Zones are rasterized on a grid with the pixel size and alignment of QA_PIXEL 
+        that covers only their bounding box, and each zone is stored as the flat 
+        indices of its pixels in `data/zonas_nubes.npz`. Landsat Collection 2 grids 
+        share the same alignment, so the cache is reused across scenes and rebuilt 
+        only when the shapefiles, the CRS or the grid alignment change.
+
+        Parameters
+        ----------
+        qa : rasterio.DatasetReader
+            Open QA_PIXEL band of the scene.
+
+        recintos : bool, optional
+            Include one zone per marsh polygon name of the tile (`recintos`); polygons 
+            sharing a name are merged into one zone. The cache always holds every zone, 
+            so calls with and without `recintos` share it.
+
+        Returns
+        -------
+        dict
+            `origen` (upper left corner), `shape` (rows, cols) and `indices` 
+            (zone name to flat pixel indices).
+        """
+
+        ruta = self.tesela['zonas_nubes']
+        # La cache guarda siempre todas las zonas; sin `recintos` se filtran al devolverlas
+        shapes = {'PN': os.path.join(self.data, 'Limites_PN_Donana.shp'), 'RBIOS': os.path.join(self.data, 'RBIOS.shp'),
+                  'Recintos': self.tesela['recintos']}
+
+        res = qa.res[0]
+        fase = (qa.transform.c % res, qa.transform.f % res)
+        firma = ';'.join(['{}:{}:{}'.format(os.path.split(f)[1], os.stat(f).st_size, int(os.stat(f).st_mtime))
+                          for f in shapes.values()] + [str(qa.crs), str(res), str(fase)])
+
+        def filtrar(indices):
+            return {n: v for n, v in indices.items() if recintos or not n.startswith('Recintos/')}
+
+        if os.path.exists(ruta):
+            with np.load(ruta) as cache:
+                if str(cache['firma']) == firma:
+                    return {'origen': tuple(cache['origen']), 'shape': tuple(int(i) for i in cache['shape']),
+                            'indices': filtrar({str(n): cache['zona_{}'.format(i)]
+                                                for i, n in enumerate(cache['nombres'])})}
+
+        print('Rasterizando las zonas para el calculo de nubes en', ruta)
+
+        geometrias = {}
+        for nombre, shp in shapes.items():
+            gdf = gpd.read_file(shp).to_crs(qa.crs)
+            if nombre == 'Recintos':
+                for _, row in gdf.iterrows():
+                    # MongoDB no admite puntos en las claves. Los recintos con el mismo nombre
+                    # forman una sola zona con la union de sus poligonos
+                    clave = 'Recintos/' + str(row['Nombre']).replace('.', '_')
+                    geometrias.setdefault(clave, []).append(row['geometry'])
+            else:
+                geometrias[nombre] = list(gdf.geometry)
+
+        minx, miny, maxx, maxy = gpd.GeoSeries([g for geoms in geometrias.values() for g in geoms]).total_bounds
+        x0 = fase[0] + np.floor((minx - fase[0]) / res) * res
+        y0 = fase[1] + np.ceil((maxy - fase[1]) / res) * res
+        shape = (int(np.ceil((y0 - miny) / res)), int(np.ceil((maxx - x0) / res)))
+        transform = Affine(res, 0, x0, 0, -res, y0)
+
+        nombres = sorted(geometrias)
+        arrays = {'firma': np.array(firma), 'origen': np.array((x0, y0)), 'shape': np.array(shape),
+                  'nombres': np.array(nombres)}
+        indices = {}
+        for i, nombre in enumerate(nombres):
+            zona = rasterize(geometrias[nombre], out_shape=shape, transform=transform, fill=0, default_value=1, dtype='uint8')
+            indices[nombre] = arrays['zona_{}'.format(i)] = np.flatnonzero(zona).astype(np.int32)
+
+        # Temporal unico en la misma carpeta: escenas en paralelo pueden generar la misma cache
+        fd, tmp = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(ruta))
+        os.close(fd)
+        try:
+            np.savez(tmp, **arrays)
+            os.replace(tmp, ruta)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        return {'origen': (x0, y0), 'shape': shape, 'indices': filtrar(indices)}
+
+
+    def remove_masks(self):
+
+        """
+        Delete temporary cloud mask files generated during processing.
+
+        This method removes all files inside the `masks/` subfolder of the Landsat scene 
+        directory and then deletes the folder itself. It is typically called after 
+        cloud coverage has been calculated and the intermediate mask files are no longer needed.
+
+        Raises
+        ------
+        OSError
+            If any file or the `masks/` folder cannot be deleted.
+        """
+
+        path_masks = os.path.join(self.ruta_escena, 'masks')
+        for i in os.listdir(path_masks):
+
+            name = os.path.join(path_masks, i)
+            os.chmod(name, stat.S_IWRITE)
+            os.remove(name)
+
+        shutil.rmtree(path_masks)
+
+
+    def apply_gapfill(self, recortado=False, n_workers=None):
+
+        """
+        Apply gap-filling to Landsat 7 bands acquired after June 2003.
+
+        This method detects if the input scene corresponds to Landsat 7 after the 
+        Scan Line Corrector (SLC) failure (June 2003). If so, it uses GDAL's 
+        `FillNodata` algorithm to interpolate missing pixels (gaps) in each 
+        reflectance band.
+
+        The method only processes the following bands: blue, green, red, nir, swir1, and swir2.
+
+        With `recortado=True` only the window of the original bands that covers the 
+        study extent (plus the search distance) is filled, with one gap mask per scene 
+        (the union of the NoData masks of the bands), the bands are filled in parallel 
+        and only their own NoData pixels inside the WRS-2 cutline are written back (see 
+        `_gapfill_recortado`). 
+        `comparar_gapfill` checks both modes on copies of the bands.
+
+        Parameters
+        ----------
+        recortado : bool, optional
+            Fill only the study-area window, in parallel (default is False).
+
+        n_workers : int, optional
+            Number of bands filled at the same time in `recortado` mode. Defaults 
+            to one worker per band.
+
+        Raises
+        ------
         RuntimeError
             If a band cannot be opened or processed during the gap-filling operation.
         """
@@ -475,20 +1384,26 @@ class Landsat:
                 'b5': 'swir1',
                 'b7': 'swir2'
             }
+
+            if self.tar:
+                # Gapfill escribe sobre las bandas originales: solo se extraen del tar esas bandas
+                claves = [c for c in self.manifest.ficheros('ori') if c.startswith('SR_') and c.split('_')[-1].lower() in band_mapping]
+                self.manifest.extraer('ori', claves)
+                for clave in claves:
+                    setattr(self, clave.split('_')[-1].lower(), self.manifest.ruta('ori', clave))
+
+            if recortado:
+                bandas = [getattr(self, b) for b in band_mapping if self.manifest.existe('ori', getattr(self, b, None))]
+                self._gapfill_recortado(bandas, n_workers)
+                print("Gapfill aplicado exitosamente a las bandas de Landsat 7.")
+                return
             
             for band_attr, band_name in band_mapping.items():
                 if hasattr(self, band_attr):
                     band_path = getattr(self, band_attr)
-                    if band_path and os.path.exists(band_path):
+                    if self.manifest.existe('ori', band_path):
                         print(f"Aplicando gapfill a la banda {band_name} ({band_path})")
-
-                        # Usar GDAL para llenar los valores NoData en el archivo original
-                        src_ds = gdal.Open(band_path, gdalconst.GA_Update)
-                        if src_ds is not None:
-                            gdal.FillNodata(src_ds.GetRasterBand(1), maskBand=None, maxSearchDist=10, smoothingIterations=1)
-                            src_ds = None  # Liberar el dataset después de modificar
-                        else:
-                            print(f"No se pudo abrir la banda {band_path} para gapfill.")
+                        self._gapfill_completo(band_path)
                     else:
                         print(f"Banda {band_name} no encontrada o no existe.")
                 else:
@@ -497,7 +1412,178 @@ class Landsat:
             print("Gapfill aplicado exitosamente a las bandas de Landsat 7.")
 
 
-    def projwin(self):
+    @staticmethod
+    def _gapfill_completo(banda, max_dist=10):
+
+        """
+        Fill the NoData pixels of a whole band in place with `gdal.FillNodata`.
+
+        Parameters
+        ----------
+        banda : str
+            Path to the original band.
+
+        max_dist : int, optional
+            `maxSearchDist` of `gdal.FillNodata` (default is 10 pixels).
+        """
+
+        # Usar GDAL para llenar los valores NoData en el archivo original
+        src_ds = gdal.Open(banda, gdalconst.GA_Update)
+        if src_ds is not None:
+            gdal.FillNodata(src_ds.GetRasterBand(1), maskBand=None, maxSearchDist=max_dist, smoothingIterations=1)
+            src_ds = None  # Liberar el dataset después de modificar
+        else:
+            print(f"No se pudo abrir la banda {banda} para gapfill.")
+
+
+    def _gapfill_recortado(self, bandas, n_workers=None, max_dist=10):
+
+        """
+        Fill the SLC-off gaps of the study-area window of Landsat 7 bands in parallel.
+
+        The window of the original bands covering the tile extent is padded with the search 
+        distance so the interpolation near its edges sees the same neighbours as a 
+        full-band fill. The gap mask is computed once per scene as the union of the 
+        NoData masks of all bands (the masks `gdal.FillNodata` uses on each whole band) 
+        and shared by the band workers, as is the rasterized WRS-2 cutline. Each band 
+        only gets values written where it was NoData itself and inside the cutline; 
+        pixels that are valid in one band but NoData in another are kept as they are, 
+        but they are not used as interpolation sources. `comparar_gapfill` measures the 
+        difference with the full-band fill.
+
+        Parameters
+        ----------
+        bandas : list of str
+            Paths to the original bands to fill in place.
+
+        n_workers : int, optional
+            Number of bands filled at the same time. Defaults to one per band.
+
+        max_dist : int, optional
+            `maxSearchDist` of `gdal.FillNodata` (default is 10 pixels).
+        """
+
+        if not bandas:
+            return
+
+        qa = self.manifest.ruta('ori', 'QA_PIXEL')
+
+        with rasterio.open(qa) as src:
+            res = src.res[0]
+            xmin, ymin, xmax, ymax = self.get_extent()
+            col0 = max(0, int(np.floor((xmin - src.transform.c) / res)) - max_dist)
+            row0 = max(0, int(np.floor((src.transform.f - ymax) / res)) - max_dist)
+            col1 = min(src.width, int(np.ceil((xmax - src.transform.c) / res)) + max_dist)
+            row1 = min(src.height, int(np.ceil((src.transform.f - ymin) / res)) + max_dist)
+            ventana = Window(col0, row0, col1 - col0, row1 - row0)
+
+            wrs = gpd.read_file(self.tesela['wrs']).to_crs(src.crs)
+            dentro = rasterize(list(wrs.geometry), out_shape=(ventana.height, ventana.width),
+                               transform=src.window_transform(ventana), fill=0, default_value=1,
+                               dtype='uint8').astype(bool)
+
+        # Mascara de gaps comun a la escena: union de las mascaras de NoData de las bandas
+        # (las que usa FillNodata con maskBand=None), calculada una sola vez
+        validos = np.ones((ventana.height, ventana.width), dtype=np.uint8)
+        for banda in bandas:
+            with rasterio.open(banda) as src:
+                validos &= (src.read_masks(1, window=ventana) > 0).astype(np.uint8)
+
+        print('Gapfill sobre la ventana', ventana, 'con', int((validos == 0).sum()), 'pixeles sin datos')
+
+        def rellenar(banda):
+
+            ds = gdal.Open(banda, gdalconst.GA_Update)
+            if ds is None:
+                print(f"No se pudo abrir la banda {banda} para gapfill.")
+                return
+            band = ds.GetRasterBand(1)
+            arr = band.ReadAsArray(col0, row0, ventana.width, ventana.height)
+
+            nodata = band.GetNoDataValue()
+            if nodata is None:
+                print(f"La banda {banda} no tiene NoData, no hay gaps que rellenar.")
+                return
+            # Solo se escriben los pixeles sin dato de esta banda dentro del cutline
+            escribir = dentro & (arr == nodata)
+
+            mem = gdal.GetDriverByName('MEM').Create('', ventana.width, ventana.height, 1, band.DataType)
+            mem.GetRasterBand(1).WriteArray(arr)
+            msk = gdal.GetDriverByName('MEM').Create('', ventana.width, ventana.height, 1, gdal.GDT_Byte)
+            msk.GetRasterBand(1).WriteArray(validos)
+
+            gdal.FillNodata(mem.GetRasterBand(1), maskBand=msk.GetRasterBand(1), maxSearchDist=max_dist, smoothingIterations=1)
+
+            arr[escribir] = mem.GetRasterBand(1).ReadAsArray()[escribir]
+            band.WriteArray(arr, col0, row0)
+            ds = None
+            print(f"Gapfill aplicado a la banda {banda}")
+
+        with ThreadPoolExecutor(max_workers=n_workers or len(bandas)) as executor:
+            list(executor.map(rellenar, bandas))
+
+
+    def comparar_gapfill(self, n_workers=None):
+
+        """
+        Compare the study-window gapfill with the full-band fill on copies of the bands.
+
+        Each Landsat 7 reflectance band is copied twice to a temporary folder; one copy 
+        is filled whole (`_gapfill_completo`) and the other with `_gapfill_recortado`. 
+        The original bands are not modified and, when the scene is read from its 
+        `.tar`, they are copied straight from the archive. Use it to check a scene 
+        before running the pipeline with `gapfill_recortado=True`.
+
+        Parameters
+        ----------
+        n_workers : int, optional
+            Number of bands filled at the same time in the cropped mode.
+
+        Returns
+        -------
+        dict
+            For each band, the number of pixels inside the study window and the WRS-2 
+            cutline where both fills differ and the largest absolute difference.
+        """
+
+        # En modo tar las bandas son rutas /vsitar/: se comprueban y copian a través del manifiesto
+        bandas = [getattr(self, b) for b in ['b1', 'b2', 'b3', 'b4', 'b5', 'b7']
+                  if self.manifest.existe('ori', getattr(self, b, None))]
+        if not bandas:
+            return {}
+
+        resultados = {}
+        with tempfile.TemporaryDirectory(dir=self.ori) as tmp:
+            completas, recortadas = [], []
+            for banda in bandas:
+                nombre = os.path.split(banda)[1]
+                completas.append(self.manifest.copiar('ori', banda, os.path.join(tmp, 'completo_' + nombre)))
+                recortadas.append(self.manifest.copiar('ori', banda, os.path.join(tmp, 'recortado_' + nombre)))
+
+            for banda in completas:
+                self._gapfill_completo(banda)
+            self._gapfill_recortado(recortadas, n_workers)
+
+            with rasterio.open(self.manifest.ruta('ori', 'QA_PIXEL')) as src:
+                ventana = rasterio.windows.from_bounds(*self.get_extent(), transform=src.transform)
+                ventana = ventana.round_offsets().round_lengths()
+                wrs = gpd.read_file(self.tesela['wrs']).to_crs(src.crs)
+                dentro = rasterize(list(wrs.geometry), out_shape=(ventana.height, ventana.width),
+                                   transform=src.window_transform(ventana), fill=0, default_value=1,
+                                   dtype='uint8').astype(bool)
+
+            for banda, completa, recortada in zip(bandas, completas, recortadas):
+                with rasterio.open(completa) as a, rasterio.open(recortada) as b:
+                    diferencia = np.abs(a.read(1, window=ventana, boundless=True).astype(np.int64) -
+                                        b.read(1, window=ventana, boundless=True).astype(np.int64))[dentro]
+                resultados[os.path.split(banda)[1]] = {'pixeles_distintos': int((diferencia > 0).sum()),
+                                                       'diferencia_maxima': int(diferencia.max()) if diferencia.size else 0}
+                print('Gapfill', os.path.split(banda)[1], resultados[os.path.split(banda)[1]])
+
+        return resultados
+
+
+    def projwin(self, en_proceso=False, n_workers=None):
 
         """
         Apply projection, resolution, and geographic extent to all valid bands.
@@ -507,70 +1593,198 @@ class Landsat:
         and clip them to a predefined extent defined by a WRS-2 shapefile. It accounts 
         for differences in band naming between OLI (Landsat 8/9) and TM/ETM+ (Landsat 4/5/7) sensors.
 
+        With `en_proceso=True` the warp runs inside Python through the GDAL API: the
+        WRS-2 cutline is rasterized once onto the output grid and all bands are warped
+        concurrently with multithreaded warping, reporting the time spent on each band.
+
         The output files are saved in the `geo` directory of the scene.
 
+        Parameters
+        ----------
+        en_proceso : bool, optional
+            Use the in-process GDAL API instead of one `gdalwarp` call per band
+            (default is False).
+
+        n_workers : int, optional
+            Number of bands warped at the same time when `en_proceso` is True.
+            Defaults to one worker per band.
+
+        Returns
+        -------
+        dict or None
+            Seconds spent on each output band when `en_proceso` is True.
+
         Raises
         ------
         RuntimeError
             If any band fails to process during the reprojection or clipping steps.
         """     
         
+        self.preparar()
+
+        #geo = '/media/diego/31F8C0B3792FC3B6/EBD/Protocolo_v2_2024/geo'
+        #path_rad = os.path.join(self.geo, self.escena)
+        #os.makedirs(path_rad, exist_ok=True)
+        wrs = self.tesela['wrs']
+        bandas = self._bandas_projwin()
+
+        if en_proceso:
+            tiempos = self._projwin_gdal(bandas, wrs, n_workers)
+            self.manifest.escanear('geo')
+            return tiempos
+
+        for ins, out in bandas:
+
+            cmd = "gdalwarp -ot Int32 -srcnodata 0 -dstnodata '-9999' -tr 30 30 -te {} {} {} {} -tap -cutline {} {} {}".format(*self.get_extent(), wrs, ins, out)
+            print(cmd)
+            os.system(cmd)
+
+        self.manifest.escanear('geo')
+
+
+    def _bandas_projwin(self):
+
+        """
+        List the (input, output) paths of the bands handled by `projwin`.
+
+        Returns
+        -------
+        list of tuple
+            Pairs with the original band path and its output path in `geo_escena`.
+        """
+
         olibands = {'B1': 'cblue_b1', 'B2': 'blue_b2', 'B3': 'green_b3', 'B4': 'red_b4', 'B5': 'nir_b5', 'B6': 'swir1_b6',
                    'B7': 'swir2_b7', 'PIXEL': 'fmask', 'B10': 'lst'}
         
         etmbands = {'B1': 'blue_b1', 'B2': 'green_b2', 'B3': 'red_b3', 'B4': 'nir_b4', 'B5': 'swir1_b5',
                    'B7': 'swir2_b7', 'PIXEL': 'fmask', 'B6': 'lst'}
-        
-        
-        #geo = '/media/diego/31F8C0B3792FC3B6/EBD/Protocolo_v2_2024/geo'
-        #path_rad = os.path.join(self.geo, self.escena)
-        #os.makedirs(path_rad, exist_ok=True)
-        wrs = os.path.join(self.data, 'wrs_202034.shp')
-        
-        for i in os.listdir(self.ruta_escena):
-            
-            if self.sat in ['L8', 'L9']:
-                if i.endswith('.TIF'):
 
-                    banda = i.split('_')[-1][:-4]
+        if self.sat in ['L8', 'L9']:
+            nombres = olibands
+        elif self.sat in ['L7', 'L5', 'L4']:
+            nombres = etmbands
+        else:
+            print('Lo siento, pero no encuentro el satélite')
+            return []
+
+        bandas = []
+        for clave, ins in self.manifest.ficheros('ori').items():
+            if ins.endswith('.TIF'):
 
-                    if banda in olibands.keys():
-                        ins = os.path.join(self.ruta_escena, i)
+                banda = clave.split('_')[-1]
 
-                        name = self.escena_date + self.sat + self.sensor + self.path + '_' + self.row[1:] + '_g2_' + olibands[banda] + '.tif'
-                        out = os.path.join(self.geo_escena, name.lower())
+                if banda in nombres.keys():
 
-                        cmd = "gdalwarp -ot Int32 -srcnodata 0 -dstnodata '-9999' -tr 30 30 -te 633570 4053510 851160 4249530 -tap -cutline {} {} {}".format(wrs, ins, out)
-                        print(cmd)
-                        os.system(cmd)
+                    name = self.escena_date + self.sat + self.sensor + self.path + '_' + self.row[1:] + '_g2_' + nombres[banda] + '.tif'
+                    out = os.path.join(self.geo_escena, name.lower())
+                    bandas.append((ins, out))
 
-                    else:
-                        continue
-                        
-            elif self.sat in ['L7', 'L5', 'L4']:
-                if i.endswith('.TIF'):
+        return bandas
 
-                    banda = i.split('_')[-1][:-4]
 
-                    if banda in etmbands.keys():
-                        ins = os.path.join(self.ruta_escena, i)
+    def _cutline_mask(self, wrs, crs):
 
-                        name = self.escena_date + self.sat + self.sensor + self.path + '_' + self.row[1:] + '_g2_' + etmbands[banda] + '.tif'
-                        out = os.path.join(self.geo_escena, name.lower())
+        """
+        Rasterize the WRS-2 cutline onto the fixed output grid.
 
-                        cmd = "gdalwarp -ot Int32 -srcnodata 0 -dstnodata '-9999' -tr 30 30 -te 633570 4053510 851160 4249530 -tap -cutline {} {} {}".format(wrs, ins, out)
-                        print(cmd)
-                        os.system(cmd)
+        The cutline is reprojected to the scene CRS first, as `gdalwarp -cutline`
+        does, so the shapefile may be stored in any reference system.
 
-                    else:
-                        continue
-                
-                
-            else:
-                print('Lo siento, pero no encuentro el satélite')
+        Parameters
+        ----------
+        wrs : str
+            Path to the WRS-2 shapefile used as cutline.
+
+        crs : rasterio.crs.CRS or str
+            Reference system of the output grid (the one of the scene bands).
+
+        Returns
+        -------
+        numpy.ndarray
+            Boolean array with the output grid shape, True inside the cutline.
+        """
+
+        xmin, ymin, xmax, ymax = self.get_extent()
+        cols = int(round((xmax - xmin) / RES))
+        rows = int(round((ymax - ymin) / RES))
+
+        gdf = gpd.read_file(wrs)
+        if gdf.crs is not None:
+            gdf = gdf.to_crs(crs)
+
+        # Igual que gdalwarp -cutline: se queman los píxeles cuyo centro cae dentro del polígono
+        cutline = rasterize(((geom, 1) for geom in gdf.geometry if geom is not None), out_shape=(rows, cols),
+                            transform=Affine(RES, 0, xmin, 0, -RES, ymax), fill=0, dtype='uint8')
+
+        return cutline.astype(bool)
+
+
+    def _warp_banda(self, ins, out, cutline, threads):
+
+        """
+        Warp a single band in memory, apply the rasterized cutline and write it as GeoTIFF.
+
+        Returns
+        -------
+        float
+            Seconds spent on the band.
+        """
+
+        t0 = time.time()
+
+        opciones = gdal.WarpOptions(format='MEM', outputType=gdal.GDT_Int32, srcNodata=0, dstNodata=-9999,
+                                    xRes=RES, yRes=RES, outputBounds=self.get_extent(), targetAlignedPixels=True,
+                                    multithread=True, warpOptions=['NUM_THREADS={}'.format(threads)])
+        mem = gdal.Warp('', ins, options=opciones)
+        if mem is None:
+            raise RuntimeError('Error al proyectar la banda {}'.format(ins))
+
+        band = mem.GetRasterBand(1)
+        arr = band.ReadAsArray()
+        arr[~cutline] = -9999
+        band.WriteArray(arr)
+
+        gdal.GetDriverByName('GTiff').CreateCopy(out, mem)
+        mem = None
+
+        return time.time() - t0
+
+
+    def _projwin_gdal(self, bandas, wrs, n_workers=None):
+
+        """
+        In-process version of `projwin` using the GDAL API and a thread pool.
+
+        Returns
+        -------
+        dict
+            Seconds spent on each output band, keyed by output file name.
+        """
+
+        if not bandas:
+            return {}
+
+        t0 = time.time()
+        with rasterio.open(bandas[0][0]) as src:
+            crs = src.crs
+        cutline = self._cutline_mask(wrs, crs)
+
+        n_workers = n_workers or len(bandas)
+        threads = max(1, (os.cpu_count() or 1) // n_workers)
+
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futuros = {os.path.split(out)[1]: executor.submit(self._warp_banda, ins, out, cutline, threads)
+                       for ins, out in bandas}
+            tiempos = {name: futuro.result() for name, futuro in futuros.items()}
+
+        for name, segundos in sorted(tiempos.items()):
+            print('Banda {} proyectada en {:.2f} segundos'.format(name, segundos))
+        print('Geo finalizado en {:.2f} segundos'.format(time.time() - t0))
+
+        return tiempos
                 
                 
-    def coef_sr_st(self):
+    def coef_sr_st(self, reflectancia=True):
 
         """
         Apply surface reflectance and land surface temperature coefficients to image bands.
@@ -585,17 +1799,30 @@ class Landsat:
         The processed bands are saved in the `rad` (radiometric correction) and 
         `pro` (final products) directories.
 
+        If the object was created with `bloque`, bands are streamed in blocks of 
+        that many rows with in-place float32 arithmetic, so memory use does not 
+        depend on the scene size.
+
+        Parameters
+        ----------
+        reflectancia : bool, optional
+            Write the reflectance bands to `rad` (default is True). The fused 
+            normalization (`normalize(fusionado=True)`) reads the geo bands 
+            directly and does not need them.
+
         Raises
         ------
         RuntimeError
             If any band cannot be processed or written to disk.
         """
+
+        self.preparar()
     
         #path_geo = os.path.join(self.geo, self.escena)
         #path_rad = os.path.join(self.rad, self.escena)
         #os.makedirs(path_rad, exist_ok=True)
         
-        for i in os.listdir(self.geo_escena):
+        for i in [os.path.split(r)[1] for r in self.manifest.ficheros('geo').values()]:
     
             if i.endswith('.tif'):
     
@@ -604,11 +1831,18 @@ class Landsat:
     
                 if banda not in ['fmask', 'lst']:
 
+                    if not reflectancia:
+                        continue
+
                     print("Aplicando coeficientes a banda", banda)
                     
                     #nombre de salida que reemplace la  _g2_ del nombre original por _gr2_
                     rs = os.path.join(self.geo_escena, i)
                     out = os.path.join(self.rad_escena, i.replace('_g2_', '_gr2_'))
+
+                    if self.bloque:
+                        self._coeficientes_por_bloques(rs, out, 0.0000275, -0.2, recortar=True)
+                        continue
     
                     with rasterio.open(rs) as src:
                         RS = src.read(1)
@@ -635,6 +1869,10 @@ class Landsat:
                     #nombre de salida que reemplace la  _g2_ del nombre original por _gr2_
                     rs = os.path.join(self.geo_escena, i)
                     out = os.path.join(self.pro_escena, i.replace('_g2_', '_'))
+
+                    if self.bloque:
+                        self._coeficientes_por_bloques(rs, out, 0.00341802, 149.0 - 273.15)
+                        continue
     
                     with rasterio.open(rs) as src:
                         RS = src.read(1)
@@ -654,19 +1892,62 @@ class Landsat:
     
                 elif banda == 'fmask':
 
-                    print("Copiando", banda)
+                    print("Enlazando", banda)
                     src = rs = os.path.join(self.geo_escena, i)
                     dst = os.path.join(self.rad_escena, i.replace('_g2_', '_'))                
-                    shutil.copy(src, dst)
+                    enlazar(src, dst)
     
                 else:                                       
                     continue
     
+        self.manifest.escanear('rad', 'pro')
         print('Coeficientes aplicados con éxito')
 
+
+    def _coeficientes_por_bloques(self, rs, out, escala, offset, recortar=False):
+
+        """
+        Apply `escala * RS + offset` to a geo band block by block.
+
+        Parameters
+        ----------
+        rs : str
+            Path to the Int32 band in `geo_escena`.
+
+        out : str
+            Path to the float32 output band.
+
+        escala, offset : float
+            Scale and offset of the Collection 2 product.
+
+        recortar : bool, optional
+            Clip the result to the [0, 1] range (reflectance bands).
+        """
+
+        with rasterio.open(rs) as src:
+            meta = src.meta
+            meta.update(dtype=rasterio.float32)
+
+            with rasterio.open(out, 'w', **meta) as dst:
+                for ventana in ventanas(src.height, src.width, self.bloque):
+
+                    RS = src.read(1, window=ventana)
+                    nd = (RS == -9999)
+
+                    valores = RS.astype(np.float32)
+                    RS = None
+                    valores *= np.float32(escala)
+                    valores += np.float32(offset)
+                    if recortar:
+                        np.clip(valores, 0, 1, out=valores)
+                    valores[nd] = -9999
+
+                    dst.write(valores, 1, window=ventana)
+
                  
             
-    def normalize(self):
+    def normalize(self, n_workers=None, diagnosticos='grafico', fusionado=False, robusto=None, max_por_clase=2000,
+                  modelo=None):
         
         """
         Perform full band normalization using invariant areas and cloud masking.
@@ -676,11 +1957,49 @@ class Landsat:
         adjusts regression parameters to meet quality thresholds.
 
         For each band:
-        - Calls `nor1()` to compute regression parameters.
+        - Evaluates the `nor1` regression ladder from a single read of its inputs.
         - If parameters satisfy quality criteria (R² > 0.85 and at least 10 valid pixels 
         per invariant area), normalization is applied using `nor2l8()`.
         - Normalization parameters and diagnostics are saved and stored in MongoDB.
 
+        Bands are independent from each other, so with `n_workers > 1` they are normalized 
+        concurrently in a process pool. The per-band results are merged in band order before 
+        writing `coeficientes.txt` and updating MongoDB, so the output does not depend on 
+        which band finishes first.
+
+        Parameters
+        ----------
+        n_workers : int, optional
+            Number of bands normalized at the same time. None or 1 runs the bands 
+            sequentially (default).
+
+        diagnosticos : {'grafico', 'histograma'}, optional
+            'grafico' draws the regression plots during normalization (default). 
+            'histograma' stores compact 2D histograms next to `coeficientes.txt` 
+            so normalization does not wait on matplotlib; the figures are drawn 
+            later with `diagnosticos.py`.
+
+        fusionado : bool, optional
+            Normalize straight from the Int32 geo bands. The fit converts only the 
+            PIA samples to reflectance, and the output is written in a single 
+            read-compute-write pass that applies the SR scale/offset, clipping, 
+            NoData and the normalization equation (see `_nor_fusionado`), so the 
+            rad reflectance bands are not needed (default is False).
+
+        robusto : {None, 'theilsen', 'ransac'}, optional
+            Fit each candidate of the ladder with a robust estimator on a 
+            deterministic class-stratified sample of the PIA pixels, capped at 
+            `max_por_clase` pixels per class, instead of least squares on every 
+            pixel (see `_ajuste_nor`). Results keep the `parametrosnor` schema.
+
+        max_por_clase : int, optional
+            Maximum number of pixels per PIA class in `robusto` mode (default is 2000).
+
+        modelo : {None, 'global', 'mezcla'}, optional
+            Fit per-class and pooled models in the same pass and store the per-class 
+            slopes and residuals in `parametrosnor` (key `Clases`). 'global' applies 
+            the pooled model and 'mezcla' the class-weighted blend (see `_modelos_clases`).
+
         Outputs
         -------
         - Normalized bands saved in `nor_escena` with `_grn2_` suffix.
@@ -692,77 +2011,146 @@ class Landsat:
         ------
         RuntimeError
             If normalization fails for one or more bands.
+
+        teselas.DatosTeselaError
+            If the tile has no reference scene or its reference bands or PIA 
+            rasters are missing.
         """
 
+        self.preparar()
+
         #path_rad = os.path.join(self.rad, self.escena)
-                
-        bandas = ['blue', 'green', 'red', 'nir', 'swir1', 'swir2']
 
         #Vamos a pasar las bandas recortadas desde temp
-        for i in os.listdir(self.rad_escena):
-                    
-            if re.search('b[1-7].tif$', i):
-                
-                banda = os.path.join(self.rad_escena, i)
-                banda_num = i.split('_')[-2]
-                
-                print('Estamos en NORMALIZE con la banda', banda, 'que es la', banda_num, 'desde normalize')
-                #Primera llamada a nor1
-                self.iter = 1
-                self.nor1(banda, self.noequilibrado)
-                
-                #Esto es un poco feo, pero funciona. Probar a hacerlo con una lista de funciones
-                if banda_num not in self.parametrosnor.keys():
-                    
-                    self.iter += 1
-                    print('Iteracion', self.iter)
-                    self.nor1(banda, self.noequilibrado, coef = 2)
-                    if banda_num not in self.parametrosnor.keys():
-                        self.iter += 1
-                        print('Iteracion', self.iter)
-                        self.nor1(banda, self.equilibrado)
-                        if banda_num not in self.parametrosnor.keys():
-                            self.iter += 1
-                            print('Iteracion', self.iter)
-                            self.nor1(banda, self.equilibrado, coef = 2)
-                            if banda_num not in self.parametrosnor.keys():
-                                self.iter += 1
-                                print('Iteracion', self.iter)
-                                self.nor1(banda, self.noequilibrado, coef = 3,)
-                                if banda_num not in self.parametrosnor.keys():
-                                    self.iter += 1
-                                    print('Iteracion', self.iter)
-                                    self.nor1(banda, self.equilibrado, coef = 3)
-                                else:
-                                    print('No se ha podido normalizar la banda ', banda_num)
-                                    
-            #Una vez acabados los bucles guardamos los coeficientes en un txt. Redundante pero asi hay 
-            #que hacerlo porque quiere David
-            #path_nor = os.path.join(self.nor, self.escena)
-            #os.makedirs(path_nor, exist_ok=True)
-            arc = os.path.join(self.nor_escena, 'coeficientes.txt')
-            f = open(arc, 'w')
-            for i in sorted(self.parametrosnor.items()):
-                f.write(str(i)+'\n')
-            f.close()  
-            
-            #Insertamos los Kls en la base de datos
-            #connection = pymongo.MongoClient("mongodb://localhost")
-            #db=connection.teledeteccion
-            #landsat = db.landsat
+        bandas = self.manifest.buscar('geo' if fusionado else 'rad', 'b[1-7].tif$')
+
+        # Sin escena de referencia o sin PIAs de la tesela no hay normalizacion posible
+        if not self.tesela['referencia']:
+            raise DatosTeselaError('La tesela {} no tiene escena de referencia, no se puede normalizar'.format(
+                self.tesela['id']))
+        requerir(self.tesela, 'equilibrada', 'noequilibrada', *self._referencias_nor().values())
+
+        # La Fmask y el almacen de PIAs se preparan una sola vez antes de repartir las bandas entre procesos
+        self._copiar_fmask_nor()
+        self._store_pias()
+
+        if n_workers and n_workers > 1 and len(bandas) > 1:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                resultados = list(executor.map(partial(self._normalizar_banda, diagnosticos=diagnosticos,
+                                                       robusto=robusto, max_por_clase=max_por_clase,
+                                                       modelo=modelo), bandas))
+        else:
+            resultados = [self._normalizar_banda(banda, diagnosticos, robusto, max_por_clase, modelo) for banda in bandas]
 
-            # Lista con las bandas normalizadas para el mail
-            self.bandas_normalizadas = sorted(self.parametrosnor.keys())
+        parametros = dict(self.parametrosnor)
+        for banda_num, valores in resultados:
+            if valores is not None:
+                parametros[banda_num] = valores
+        self.parametrosnor = dict(sorted(parametros.items()))
 
-            try:
+        #Una vez acabados los bucles guardamos los coeficientes en un txt. Redundante pero asi hay 
+        #que hacerlo porque quiere David
+        #path_nor = os.path.join(self.nor, self.escena)
+        #os.makedirs(path_nor, exist_ok=True)
+        arc = os.path.join(self.nor_escena, 'coeficientes.txt')
+        f = open(arc, 'w')
+        for i in sorted(self.parametrosnor.items()):
+            f.write(str(i)+'\n')
+        f.close()  
+        
+        #Insertamos los Kls en la base de datos
+        #connection = pymongo.MongoClient("mongodb://localhost")
+        #db=connection.teledeteccion
+        #landsat = db.landsat
 
-                db.update_one({'_id': self.last_name}, {'$set':{'Info.Pasos.nor': 
-                        {'Normalize': 'True', 'Nor-Values': self.parametrosnor, 'Fecha': datetime.now()}}})
+        # Lista con las bandas normalizadas para el mail
+        self.bandas_normalizadas = sorted(self.parametrosnor.keys())
+        self.manifest.escanear('nor')
 
-            except Exception as e:
-                print("Unexpected error:", type(e), e)
-        
-        
+        try:
+
+            db.update_one({'_id': self.last_name}, {'$set':{'Info.Pasos.nor': 
+                    {'Normalize': 'True', 'Nor-Values': self.parametrosnor, 'Fecha': datetime.now()}}})
+
+        except Exception as e:
+            print("Unexpected error:", type(e), e)
+
+
+    def _normalizar_banda(self, banda, diagnosticos='grafico', robusto=None, max_por_clase=2000, modelo=None):
+
+        """
+        Run the normalization retry ladder for a single band.
+
+        The inputs are read once and the samples of both PIA masks extracted once; 
+        the six (mask, coef) candidate fits are then evaluated from memory in order 
+        until one passes the quality criteria. It runs either in the main process 
+        or in a worker of the pool started by `normalize`.
+
+        Parameters
+        ----------
+        banda : str
+            Path to the band in `rad_escena`.
+
+        diagnosticos : {'grafico', 'histograma'}, optional
+            How the diagnostics of the accepted fit are saved (see `_aplicar_nor`).
+
+        robusto, max_por_clase, modelo : optional
+            Robust subsampled fit and per-class model options (see `_ajuste_nor`).
+
+        Returns
+        -------
+        tuple
+            Band name and its `parametrosnor` entry, or None if it could not be normalized.
+        """
+
+        banda_num = banda.split('_')[-2]
+        print('Estamos en NORMALIZE con la banda', banda, 'que es la', banda_num, 'desde normalize')
+
+        escalera = [(self.noequilibrado, 1), (self.noequilibrado, 2), (self.equilibrado, 1),
+                    (self.equilibrado, 2), (self.noequilibrado, 3), (self.equilibrado, 3)]
+
+        # Leemos una sola vez las entradas y las muestras de las dos mascaras de PIAs
+        muestras = self._leer_muestras_nor(banda, [self.noequilibrado, self.equilibrado])
+        if not muestras:
+            print('No hay banda de referencia para', banda_num)
+            return banda_num, None
+
+        for n, (mascara, coef) in enumerate(escalera, start=1):
+            self.iter = n
+            print('Iteracion', self.iter, 'mascara:', mascara, 'coef:', coef)
+            ajuste = self._ajuste_nor(*muestras[mascara], coef = coef, robusto=robusto, max_por_clase=max_por_clase,
+                                      modelo=modelo)
+            if self._ajuste_valido(ajuste):
+                self._aplicar_nor(banda, ajuste, diagnosticos)
+                return banda_num, self.parametrosnor[banda_num]
+
+        print('No se ha podido normalizar la banda ', banda_num)
+        return banda_num, None
+
+
+    def _copiar_fmask_nor(self):
+
+        """
+        Link the fmask band from `rad_escena` into `nor_escena` once per scene (see `enlaces.enlazar`).
+
+        Returns
+        -------
+        str
+            Path to the fmask band in `nor_escena`.
+        """
+
+        if getattr(self, 'fmask_nor', None) and os.path.exists(self.fmask_nor):
+            return self.fmask_nor
+
+        src = self.manifest.ruta('rad', 'fmask')
+        clouds = os.path.split(src)[1]
+        dst = os.path.join(self.nor_escena, clouds.replace('_gr2_', '_grn2_'))
+        
+        enlazar(src, dst)
+        self.fmask_nor = dst
+
+        return dst
+        
         
     def nor1(self, banda, mascara, coef = 1):
         
@@ -781,6 +2169,9 @@ class Landsat:
         per class), the slope and intercept are stored, and the normalized image is 
         subsequently generated via `nor2l8()`.
 
+        `normalize` does not call this method; it reads the inputs once per band and
+        evaluates the whole retry ladder from memory (see `_normalizar_banda`).
+
         Parameters
         ----------
         banda : str
@@ -801,175 +2192,531 @@ class Landsat:
         """
 
         print('comenzando nor1')
-        
+        print('mascara: ', mascara)
+
+        muestras = self._leer_muestras_nor(banda, [mascara])
+        if mascara not in muestras:
+            return
+
+        ajuste = self._ajuste_nor(*muestras[mascara], coef = coef)
+
+        if self._ajuste_valido(ajuste):
+            self._aplicar_nor(banda, ajuste)
+        else:
+            print('no se puede normalizar la banda', banda)
+
+
+    def _referencias_nor(self):
+
+        """
+        Return the reference bands used to normalize each band.
+
+        The reference scene is set per tile in `teselas.TESELAS` (August 2022 for 
+        202_34).
+
+        Returns
+        -------
+        dict
+            Band name (`blue`, `green`, ...) to reference raster path. Empty if the 
+            tile has no reference scene.
+        """
+
+        ref = self.tesela['referencia']
+        if not ref:
+            return {}
+
         #Ruta a las bandas usadas para normalizar  /media/diego/Datos4/EBD/Protocolo_v2_2024/data/ref
-        path_blue = os.path.join(self.data, '20220802l8oli202_34_gr2_blue_b2.tif')
-        path_green = os.path.join(self.data, '20220802l8oli202_34_gr2_green_b3.tif')
-        path_red = os.path.join(self.data, '20220802l8oli202_34_gr2_red_b4.tif')
-        path_nir = os.path.join(self.data, '20220802l8oli202_34_gr2_nir_b5.tif')
-        path_swir1 = os.path.join(self.data, '20220802l8oli202_34_gr2_swir1_b6.tif')
-        path_swir2 = os.path.join(self.data, '20220802l8oli202_34_gr2_swir2_b7.tif')
-        
-        dnorbandas = {'blue': path_blue, 'green': path_green, 'red': path_red, 'nir': path_nir, 'swir1': path_swir1, 'swir2': path_swir2}
-        #dnorbandasl7 = {'B1': path_blue, 'B2': path_green, 'B3': path_red, 'B4': path_nir, 'B5': path_swir1, 'B7': path_swir2}
+        path_blue = os.path.join(self.data, ref + '_gr2_blue_b2.tif')
+        path_green = os.path.join(self.data, ref + '_gr2_green_b3.tif')
+        path_red = os.path.join(self.data, ref + '_gr2_red_b4.tif')
+        path_nir = os.path.join(self.data, ref + '_gr2_nir_b5.tif')
+        path_swir1 = os.path.join(self.data, ref + '_gr2_swir1_b6.tif')
+        path_swir2 = os.path.join(self.data, ref + '_gr2_swir2_b7.tif')
         
-        #if self.sensore == 'OLI':
-            #dnorbandas = dnorbandasl8
-        #else:
-            #dnorbandas = dnorbandasl7
-            
-        #path_nor = os.path.join(self.nor, self.escena)
-        #path_rad = os.path.join(self.rad, self.escena)
+        return {'blue': path_blue, 'green': path_green, 'red': path_red, 'nir': path_nir, 'swir1': path_swir1, 'swir2': path_swir2}
 
-        # Copiamos la banda de Fmask a nor
 
-        clouds = [i for i in os.listdir(self.rad_escena) if 'fmask' in i][0]
-        src = os.path.join(self.rad_escena, clouds)
-        dst = os.path.join(self.nor_escena, clouds.replace('_gr2_', '_grn2_'))
-        
-        shutil.copy(src, dst)
-                    
-        mask_nubes = dst
+    def _leer_muestras_nor(self, banda, mascaras):
+
+        """
+        Read the inputs of a band once and extract the PIA samples for each mask.
+
+        Reference reflectance and PIA classes come from the compact store built by 
+        `_store_pias`, so only the cloud mask and the current band are read from 
+        disk, and only over the windows listed in the store (`_leer_ventanas_pias`).
+
+        Parameters
+        ----------
+        banda : str
+            Path to the band in `rad_escena`.
+
+        mascaras : list of str
+            PIA rasters (`self.noequilibrado`, `self.equilibrado`).
+
+        Returns
+        -------
+        dict
+            For each mask, a tuple (current values, reference values, PIA classes) 
+            of the valid PIA pixels. Empty if the band has no reference.
+        """
+
+        banda_num = banda.split('_')[-2]
+        print('----------------La banda num en nor 1 es----------------', banda_num)
+
+        if banda_num not in self._referencias_nor().keys():
+            return {}
+
+        mask_nubes = self._copiar_fmask_nor()
         print('Mascara de nubes: ', mask_nubes)
-        
-        if mascara == self.noequilibrado:
-            poly_inv_tipo = os.path.join(self.data, 'NoEquilibrada.tif')
-        else:
-            poly_inv_tipo = os.path.join(self.data, 'Equilibrada.tif')
 
-        print('mascara: ', mascara)
-                            
+        with np.load(self._store_pias()) as store:
+            ventanas = store['ventanas']
+            locales = store['indices_ventanas']
+            REF2 = store['ref_' + banda_num]
+            clases = {mascara: store[self._clave_store_pias(mascara)] for mascara in mascaras}
+            shape = tuple(store['shape'])
+
         with rasterio.open(mask_nubes) as nubes:
-            CLOUD = nubes.read()
-                
-        #Abrimos el raster con los rois
-        with rasterio.open(poly_inv_tipo) as pias:
-            PIAS = pias.read()
+            CLOUD = self._leer_ventanas_pias(nubes, ventanas, locales)
+
+        with rasterio.open(banda) as current:
+            if (current.height, current.width) != shape:
+                raise RuntimeError('La banda {} no coincide con la malla de las PIAs {}'.format(banda, shape))
+            CURRENT = self._leer_ventanas_pias(current, ventanas, locales)
+
+        # Las bandas de geo se pasan a reflectividad solo en los pixeles de las PIAs
+        if self._es_geo(banda):
+            CURRENT = reflectividad(CURRENT)
+
+        #Fmask: tierra limpia y agua clara (21824 y 21952 en OLI), ver qa.tabla_qa
+        validos = (CURRENT != -9999) & mascara_qa(CLOUD, self.sensor)
+
+        muestras = {}
+        for mascara, PIAS in clases.items():
+            seleccion = validos & (PIAS != 0)
+            muestras[mascara] = (CURRENT[seleccion], REF2[seleccion], PIAS[seleccion])
+
+        return muestras
+
+
+    @staticmethod
+    def _leer_ventanas_pias(src, ventanas, locales):
+
+        """
+        Gather the PIA pixels of a raster reading only the windows of the PIA store.
+
+        Parameters
+        ----------
+        src : rasterio.DatasetReader
+            Open raster on the PIA grid.
+
+        ventanas : numpy.ndarray
+            (col_off, row_off, width, height) of each window, in row order.
+
+        locales : numpy.ndarray
+            Index of every PIA pixel in the concatenation of the flattened windows.
+
+        Returns
+        -------
+        numpy.ndarray
+            Values at the PIA pixels, in the order of the store.
+        """
+
+        if not len(ventanas):
+            return np.zeros(0, dtype=src.dtypes[0])
+
+        datos = np.concatenate([src.read(1, window=Window(*ventana)).ravel() for ventana in ventanas])
+        return datos[locales]
+
+
+    def _clave_store_pias(self, mascara):
+
+        """Name of the class array of a PIA raster inside the PIA store."""
+
+        return 'pias_noequilibrada' if mascara == self.noequilibrado else 'pias_equilibrada'
+
+
+    def _store_pias(self):
+
+        """
+        Return the compact store with the PIA pixels of the reference scene, building it if needed.
+
+        The store is an `.npz` file in `data` holding the flat indices of the pixels 
+        that belong to any PIA, their class in `Equilibrada.tif` and `NoEquilibrada.tif` 
+        and the reference reflectance of every band at those pixels. The PIA pixels 
+        are also grouped in windows of `FILAS_PIAS` rows cropped to their columns, 
+        with each pixel's index inside those windows, so scene rasters are read only 
+        where there are PIAs. It records the size and modification time of its source 
+        rasters and is rebuilt when any of them changes.
+
+        The store is written to a unique temporary file in the same folder and then 
+        renamed, so scenes normalized in parallel never write the same file.
+
+        Returns
+        -------
+        str
+            Path to the store.
+        """
+
+        ruta = self.tesela['pias_store']
+        fuentes = [self.equilibrado, self.noequilibrado] + [v for k, v in sorted(self._referencias_nor().items())]
+        firma = ';'.join('{}:{}:{}'.format(os.path.split(f)[1], os.stat(f).st_size, int(os.stat(f).st_mtime))
+                         for f in fuentes)
+
+        if os.path.exists(ruta):
+            with np.load(ruta) as store:
+                if str(store['firma']) == firma and 'ventanas' in store.files:
+                    return ruta
+
+        print('Generando el almacen de PIAs en', ruta)
+
+        with rasterio.open(self.equilibrado) as eq, rasterio.open(self.noequilibrado) as noeq:
+            EQ = eq.read(1).ravel()
+            NOEQ = noeq.read(1).ravel()
+            shape = (eq.height, eq.width)
+
+        indices = np.flatnonzero((EQ != 0) | (NOEQ != 0)).astype(np.int32)
+        arrays = {'indices': indices, 'shape': np.array(shape),
+                  'pias_equilibrada': EQ[indices].astype(np.uint8),
+                  'pias_noequilibrada': NOEQ[indices].astype(np.uint8),
+                  'firma': np.array(firma)}
+        EQ = None
+        NOEQ = None
+
+        # Ventanas de FILAS_PIAS filas recortadas a las columnas con PIAs. Los indices estan
+        # ordenados, asi que recorrer las ventanas en orden conserva el orden del almacen
+        filas, cols = np.divmod(indices.astype(np.int64), shape[1])
+        ventanas, locales, desplazamiento = [], [], 0
+        for fila in range(0, shape[0], FILAS_PIAS):
+            ini, fin = np.searchsorted(filas, [fila, fila + FILAS_PIAS])
+            if ini == fin:
+                continue
+            f, c = filas[ini:fin], cols[ini:fin]
+            col0, fila0 = int(c.min()), int(f.min())
+            ancho, alto = int(c.max()) - col0 + 1, int(f.max()) - fila0 + 1
+            locales.append(desplazamiento + (f - fila0) * ancho + (c - col0))
+            ventanas.append((col0, fila0, ancho, alto))
+            desplazamiento += ancho * alto
+
+        arrays['ventanas'] = np.array(ventanas, dtype=np.int64).reshape(-1, 4)
+        arrays['indices_ventanas'] = np.concatenate(locales) if locales else np.zeros(0, dtype=np.int64)
+
+        for banda_num, path in self._referencias_nor().items():
+            with rasterio.open(path) as ref:
+                arrays['ref_' + banda_num] = self._leer_ventanas_pias(ref, arrays['ventanas'],
+                                                                      arrays['indices_ventanas'])
+
+        # Escribimos en un temporal unico de la misma carpeta y renombramos, para no dejar el
+        # almacen a medias ni pisar el temporal de otra escena que lo este generando a la vez
+        fd, tmp = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(ruta))
+        os.close(fd)
+        try:
+            np.savez(tmp, **arrays)
+            os.replace(tmp, ruta)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        return ruta
+
+
+    def _ajuste_nor(self, BANDA2, REF2, PIAS2, coef = 1, robusto=None, max_por_clase=2000, modelo=None):
+
+        """
+        Fit the normalization regression on in-memory PIA samples.
+
+        A first regression is fitted, pixels whose residual is at least `coef` 
+        times the residual standard deviation are dropped, and a second regression 
+        is fitted on the remaining pixels. Both fits come from sums and cross-products 
+        (`regresion_lineal`), the residual filter is a single boolean index and the 
+        pixels per PIA class are counted with one `bincount`.
+
+        With `robusto` the fit runs on a class-stratified sample of at most 
+        `max_por_clase` pixels per PIA class (`muestra_estratificada`) and both 
+        regressions use a robust estimator (`theil_sen` or `ransac`), so the cost 
+        per band does not depend on the number of clear PIA pixels. The result has 
+        the same keys, with the counts referred to the sample.
+
+        Parameters
+        ----------
+        BANDA2, REF2, PIAS2 : numpy.ndarray
+            Current values, reference values and PIA classes of the valid PIA pixels.
+
+        coef : int, optional
+            Multiplier for the standard deviation of residuals. Default is 1.
+
+        robusto : {None, 'theilsen', 'ransac'}, optional
+            Robust estimator on a stratified sample. None fits least squares on 
+            every pixel (default).
+
+        max_por_clase : int, optional
+            Maximum number of pixels per PIA class in `robusto` mode (default is 2000).
+
+        modelo : {None, 'global', 'mezcla'}, optional
+            Also fit one model per PIA class on the filtered pixels (see 
+            `_modelos_clases`). 'global' applies the pooled fit and 'mezcla' the 
+            class-weighted blend of the per-class fits. None skips them (default).
+
+        Returns
+        -------
+        dict
+            Fit parameters (`slope`, `intercept`, `std`, `r`, `N`), pixel count per 
+            PIA class (`Tipo_Area`), per-class models (`Clases`, with `modelo`) and 
+            the samples used for the diagnostic plots.
+        """
+
+        x = np.asarray(BANDA2, dtype=np.float64)
+        y = np.asarray(REF2, dtype=np.float64)
+        estimador = ESTIMADORES[robusto or 'ols']
+
+        if robusto:
+            muestra = muestra_estratificada(PIAS2, max_por_clase)
+            x, y, PIAS2 = x[muestra], y[muestra], PIAS2[muestra]
+
+        #Realizamos la primera regresion
+        First_slope, First_intercept, r_value = estimador(x, y)
+        print ('\n++++++++++++++++++++++++++++++++++')
+        print('slope: '+ str(First_slope), 'intercept:', First_intercept, 'r', r_value, 'N:', PIAS2.size)
+        print ('++++++++++++++++++++++++++++++++++\n')
+
+        # Con menos de dos pixeles validos (o todos iguales) no hay recta: ajuste fallido,
+        # y normalize pasa a la siguiente iteracion de la escalera
+        if not np.isfinite(First_slope):
+            print('No hay pixeles suficientes para ajustar la regresion, N:', PIAS2.size)
+            vacio = np.zeros(0, dtype=np.float64)
+            return {'slope': First_slope, 'intercept': First_intercept, 'std': float('nan'), 'r': r_value,
+                    'N': 0, 'Tipo_Area': {nombre: 0 for nombre in PIAS_CLASES.values()},
+                    'first_slope': First_slope, 'first_intercept': First_intercept,
+                    'x': x, 'y': y, 'x2': vacio, 'y2': vacio}
+
+        # Residuo de la primera regresion, calculado en un unico array
+        residuo = y - x * First_slope
+        residuo -= First_intercept
+        std = residuo.std() * coef
+        print('STD:', std, 'COEF:', coef)
+
+        #Ahora descartamos los pixeles con residuo alto para hacer la segunda regresion
+        np.abs(residuo, out=residuo)
+        dentro = residuo < std
+        residuo = None
+
+        current_PIA_NoData_STD = x[dentro]
+        ref_PIA_NoData_STD = y[dentro]
+
+        #Hemos enmascarado los resiudos, ahora calculamos la 2 regresion
+        slope, intercept, r_value = estimador(current_PIA_NoData_STD, ref_PIA_NoData_STD)
+        print ('\n++++++++++++++++++++++++++++++++++')
+        print ('slope: '+ str(slope), 'intercept:', intercept, 'r', r_value, 'N:', len(ref_PIA_NoData_STD))
+        print ('++++++++++++++++++++++++++++++++++\n')
+
+        #Comprobamos el numero de pixeles por cada area pseudo invariante
+        conteo = np.bincount(PIAS2[dentro], minlength=10)
+        values = {nombre: int(conteo[i]) for i, nombre in PIAS_CLASES.items()}
+        print('Values_dict:', values)
+
+        ajuste = {'slope': slope, 'intercept': intercept, 'std': float(std), 'r': r_value,
+                  'N': int(len(ref_PIA_NoData_STD)), 'Tipo_Area': values,
+                  'first_slope': First_slope, 'first_intercept': First_intercept,
+                  'x': x, 'y': y, 'x2': current_PIA_NoData_STD, 'y2': ref_PIA_NoData_STD}
+
+        if modelo:
+            clases, mezcla = self._modelos_clases(current_PIA_NoData_STD, ref_PIA_NoData_STD, PIAS2[dentro],
+                                                  slope, intercept)
+            ajuste['Clases'] = clases
+            ajuste['modelo'] = modelo
+            if modelo == 'mezcla' and mezcla is not None:
+                ajuste['slope'], ajuste['intercept'] = mezcla
+                print('Modelo mezcla por clases: slope', mezcla[0], 'intercept', mezcla[1])
+
+        return ajuste
+
+
+    def _modelos_clases(self, x, y, clases, slope, intercept, min_pixeles=10):
+
+        """
+        Fit one normalization model per PIA class in a single vectorized pass.
+
+        The grouped sums of every class are taken with weighted `bincount`s 
+        (`sumas_por_clases`) and each class fit comes from them (`lineal_desde_sumas`), 
+        together with the bias and RMSE of the pooled line on that class, which 
+        show where the global normalization degrades. The blend averages the slope 
+        and intercept of the classes with at least `min_pixeles` pixels, each class 
+        with the same weight, as the balanced PIA mask does.
+
+        Parameters
+        ----------
+        x, y, clases : numpy.ndarray
+            Current values, reference values and PIA classes of the filtered pixels.
+
+        slope, intercept : float
+            Pooled fit.
+
+        min_pixeles : int, optional
+            Minimum pixels of a class to enter the blend (default is 10).
+
+        Returns
+        -------
+        tuple
+            Dict of per-class models by class name, and the blended (slope, intercept) 
+            or None if no class qualifies.
+        """
+
+        sumas = sumas_por_clases(x, y, clases)
+        pendientes, ordenadas, rs, stds = lineal_desde_sumas(sumas)
+
+        # Residuos del modelo global en cada clase, tambien desde las sumas
+        n = sumas['n']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sesgo = (sumas['sy'] - slope * sumas['sx'] - intercept * n) / n
+            ecm = (sumas['syy'] + slope ** 2 * sumas['sxx'] + intercept ** 2 * n - 2 * slope * sumas['sxy']
+                   - 2 * intercept * sumas['sy'] + 2 * slope * intercept * sumas['sx']) / n
+        rmse = np.sqrt(np.maximum(ecm, 0))
+
+        def valor(v):
+            return float(v) if np.isfinite(v) else None
+
+        modelos = {}
+        for i, nombre in PIAS_CLASES.items():
+            modelos[nombre] = {'slope': valor(pendientes[i]), 'intercept': valor(ordenadas[i]), 'r': valor(rs[i]),
+                               'std': valor(stds[i]), 'N': int(n[i]), 'sesgo_global': valor(sesgo[i]),
+                               'rmse_global': valor(rmse[i])}
+
+        indices = [i for i in PIAS_CLASES if n[i] >= min_pixeles and np.isfinite(pendientes[i])]
+        mezcla = None
+        if indices:
+            mezcla = (float(np.mean(pendientes[indices])), float(np.mean(ordenadas[indices])))
+
+        return modelos, mezcla
+
+
+    def _ajuste_valido(self, ajuste):
+
+        """Check the quality criteria of a fit (a line was fitted, R > 0.85 and at least 10 pixels per PIA class)."""
+
+        return bool(np.isfinite(ajuste['slope']) and ajuste['r'] > 0.85 and min(ajuste['Tipo_Area'].values()) >= 10)
+
+
+    def _aplicar_nor(self, banda, ajuste, diagnosticos='grafico'):
+
+        """
+        Store a valid fit in `parametrosnor`, normalize the band and save its diagnostics.
+
+        Parameters
+        ----------
+        banda : str
+            Path to the band in `rad_escena` (or `geo_escena` in fused mode).
+
+        ajuste : dict
+            Fit returned by `_ajuste_nor`.
+
+        diagnosticos : {'grafico', 'histograma'}, optional
+            'grafico' draws the regression plots with seaborn right away (default). 
+            'histograma' only stores 2D histograms of the samples and the fit 
+            parameters (see `_histograma_nor`), to be drawn later with `diagnosticos.py`.
+        """
 
         banda_num = banda.split('_')[-2]
-        print('----------------La banda num en nor 1 es----------------', banda_num)
-        if banda_num in dnorbandas.keys():
-            with rasterio.open(banda) as current:
-                CURRENT = current.read()
-                print('Banda actual: ', banda, 'Shape:', CURRENT.shape)
-            #Aqui con el diccionario nos aseguramos de que estamos comparando cada banda con su homologa del 20020718
-            with rasterio.open(dnorbandas[banda_num]) as ref:
-                REF = ref.read()
-                print('Referencia: ', dnorbandas[banda_num], 'Shape:', REF.shape)
-            
-            #Ya tenemos todas las bandas de la imagen actual y de la imagen de referencia leidas como array
-            REF2 = REF[((CURRENT != -9999) & (PIAS != 0)) & ((CLOUD == self.cloud_mask_values[0]) | (CLOUD == self.cloud_mask_values[1]))] #los valores de Fmask usados son: 21824 Tierra limpia y 21952 Agua clara
-            BANDA2 = CURRENT[((CURRENT != -9999) & (PIAS != 0)) & ((CLOUD == self.cloud_mask_values[0]) | (CLOUD == self.cloud_mask_values[1]))]
-            PIAS2 = PIAS[((CURRENT != -9999) & (PIAS != 0)) & ((CLOUD == self.cloud_mask_values[0]) | (CLOUD == self.cloud_mask_values[1]))]
-            
-            #Realizamos la primera regresion
-            First_slope, First_intercept, r_value, p_value, std_err = linregress(BANDA2,REF2)
-            print ('\n++++++++++++++++++++++++++++++++++')
-            print('slope: '+ str(First_slope), 'intercept:', First_intercept, 'r', r_value, 'N:', PIAS2.size)
-            print ('++++++++++++++++++++++++++++++++++\n')
-                        
-            esperado = BANDA2 * First_slope + First_intercept
-            residuo = REF2 - esperado
-            #print('DESVIACION TÍPICA PRIMERA REGRESION:', std_err) COMO DE BUENO ES EL AJUSTE (SLOPE DAVID)
-            print('RESIDUO STD:', residuo.std())
-            print('RESIDUO STD_DDOF:', residuo.std(ddof=1))
-            std = residuo.std() * coef
-            print('STD:', std, 'COEF:', coef)
-                        
-            #Ahora calculamos el residuo para hacer la segunda regresion
-
-            mask_current_PIA_NoData_STD = np.ma.masked_where(abs(residuo)>=std, BANDA2)
-            mask_ref_PIA_NoData_STD = np.ma.masked_where(abs(residuo)>=std,REF2)
-            mask_pias_PIA_NoData_STD = np.ma.masked_where(abs(residuo)>=std,PIAS2)
-
-            current_PIA_NoData_STD = np.ma.compressed(mask_current_PIA_NoData_STD)
-            ref_PIA_NoData_STD = np.ma.compressed(mask_ref_PIA_NoData_STD)
-            pias_PIA_NoData_STD = np.ma.compressed(mask_pias_PIA_NoData_STD)
-                       
-            
-            #Hemos enmascarado los resiudos, ahora calculamos la 2 regresion
-            slope, intercept, r_value, p_value, std_err = linregress(current_PIA_NoData_STD,ref_PIA_NoData_STD)
-            print ('\n++++++++++++++++++++++++++++++++++')
-            print ('slope: '+ str(slope), 'intercept:', intercept, 'r', r_value, 'N:', len(ref_PIA_NoData_STD))
-            print ('++++++++++++++++++++++++++++++++++\n')
-            
-            
-            #Comprobamos el numero de pixeles por cada area pseudo invariante
-            values = {}
-            values_str = {1: 'Mar', 2: 'Embalses', 3: 'Pinar', 
-                          4: 'Urbano-1', 5: 'Urbano-2', 6: 'Aeropuertos', 7: 'Arena', 8: 'Pastizales', 9: 'Mineria'}
-            
-            print('Vamos a sacar el count de cada zona (dict)')
-            for i in range(1,10):
-
-                mask_pia_= np.ma.masked_where(pias_PIA_NoData_STD != i, pias_PIA_NoData_STD)
-                PIA = np.ma.compressed(mask_pia_)
-                a = PIA.tolist()
-                values[values_str[i]] = len(a)
-                print('Values_dict:', values)
-            
-            #pasamos las claves de cada zona a string
-            print(banda_num)
-            #Generamos el raster de salida despues de aplicarle la ecuacion de regresion. Esto seria el nor2
-            #Por aqui hay que ver como se soluciona
-            if r_value > 0.85 and min(values.values()) >= 10:
-                self.parametrosnor[banda_num]= {'Parametros':{'slope': slope, 'intercept': intercept, 'std': std,
-                        'r': r_value, 'N': len(ref_PIA_NoData_STD), 'iter': self.iter}, 'Tipo_Area': values}
-                
-                print('parametros en nor1: ', self.parametrosnor)
-                print('\ncomenzando nor2 con la banda:', banda[-6:-4], '\n')
-                #Hemos calculado la regresion con las bandas recortadas con Rois_extent
-                #Ahora vamos a pasar las bandas de rad (completas) para aplicar la ecuacion de regresion
-                #path_rad = os.path.join(self.rad, self.escena)
-                print('Ruta Rad:', self.rad_escena)
-                for r in os.listdir(self.rad_escena):
-                    print('BANDA', banda[-6:-4])
-                    if banda[-6:-4] in r and r.endswith('.tif'):
-                        print('banda:', r)
-                        raster = os.path.join(self.rad_escena, r)
-                        print('La banda que se va a normalizar es:', raster)
-
-                        if r_value > 0.85 and min(values.values()) >= 10:
-                            self.nor2l8(raster, slope, intercept)# Aqui hay que cambiar para que llame a las bandas de rad
-                            print('\nNormalizacion de ', banda_num, ' realizada.\n')
-                     
-                            fig = plt.figure(figsize=(15,10))
-                            ax1 = fig.add_subplot(121)
-                            ax2 = fig.add_subplot(122)
-                            ax1.set_ylim((0, 1))
-                            ax1.set_xlim((0, 1))
-                            ax2.set_ylim((0, 1))
-                            ax2.set_xlim((0, 1))
-                            
-                            sns.regplot(x=BANDA2, y=REF2, color='g', ax=ax1,
-                                line_kws={'color': 'grey', 'label': "y={0:.5f}x+{1:.5f}".format(First_slope, First_intercept)}
-                            ).set_title('Regresion PIAs')
-                            
-                            sns.regplot(x=current_PIA_NoData_STD, y=ref_PIA_NoData_STD, color='b', ax=ax2,
-                                line_kws={'color': 'grey', 'label': "y={0:.5f}x+{1:.5f}".format(slope, intercept)}
-                            ).set_title('Regresion PIAs-STD')
-                            
-                            #Legend
-                            ax1.legend()
-                            ax2.legend()
-                            
-                            title_ = os.path.split(banda)[1][:-4] + '. Iter: ' + str(self.iter)
-                            fig.suptitle(title_, fontsize=15, weight='bold')
-
-                            reg_name = os.path.join(self.nor_escena, os.path.split(banda)[1][:-4])+'.png'
-                            reg_nname = reg_name.replace('gr2', 'grn2')
-                            plt.savefig(reg_nname)
-                            plt.show()
-
-                        else:
-                            print('no se puede normalizar la banda', banda)
-                            pass
-                            
-            else:
-                print('no se puede normalizar la banda', banda)
-                pass
-                                       
-                    
+        slope, intercept = ajuste['slope'], ajuste['intercept']
+
+        self.parametrosnor[banda_num]= {'Parametros':{'slope': slope, 'intercept': intercept, 'std': ajuste['std'],
+                'r': ajuste['r'], 'N': ajuste['N'], 'iter': self.iter}, 'Tipo_Area': ajuste['Tipo_Area']}
+        if 'Clases' in ajuste:
+            self.parametrosnor[banda_num]['Parametros']['modelo'] = ajuste['modelo']
+            self.parametrosnor[banda_num]['Clases'] = ajuste['Clases']
+        
+        print('parametros en nor1: ', self.parametrosnor)
+        print('\ncomenzando nor2 con la banda:', banda[-6:-4], '\n')
+
+        if self._es_geo(banda):
+            # Normalizacion fusionada directamente desde la banda de geo
+            self._nor_fusionado(banda, slope, intercept)
+            print('\nNormalizacion de ', banda_num, ' realizada.\n')
+        else:
+            #Hemos calculado la regresion con las bandas recortadas con Rois_extent
+            #Ahora vamos a pasar las bandas de rad (completas) para aplicar la ecuacion de regresion
+            for raster in self.manifest.ficheros('rad').values():
+                if banda[-6:-4] in os.path.split(raster)[1] and raster.endswith('.tif'):
+                    print('La banda que se va a normalizar es:', raster)
+
+                    self.nor2l8(raster, slope, intercept)
+                    print('\nNormalizacion de ', banda_num, ' realizada.\n')
+
+        if diagnosticos == 'histograma':
+            self._histograma_nor(banda, ajuste)
+        else:
+            self._grafico_nor(banda, ajuste)
+
+
+    def _grafico_nor(self, banda, ajuste):
+
+        """Draw the scatter plots of both regressions of a band and save them as PNG in `nor_escena`."""
+
+        fig = plt.figure(figsize=(15,10))
+        ax1 = fig.add_subplot(121)
+        ax2 = fig.add_subplot(122)
+        ax1.set_ylim((0, 1))
+        ax1.set_xlim((0, 1))
+        ax2.set_ylim((0, 1))
+        ax2.set_xlim((0, 1))
+        
+        sns.regplot(x=ajuste['x'], y=ajuste['y'], color='g', ax=ax1,
+            line_kws={'color': 'grey', 'label': "y={0:.5f}x+{1:.5f}".format(ajuste['first_slope'], ajuste['first_intercept'])}
+        ).set_title('Regresion PIAs')
+        
+        sns.regplot(x=ajuste['x2'], y=ajuste['y2'], color='b', ax=ax2,
+            line_kws={'color': 'grey', 'label': "y={0:.5f}x+{1:.5f}".format(ajuste['slope'], ajuste['intercept'])}
+        ).set_title('Regresion PIAs-STD')
+        
+        #Legend
+        ax1.legend()
+        ax2.legend()
+        
+        title_ = os.path.split(banda)[1][:-4] + '. Iter: ' + str(self.iter)
+        fig.suptitle(title_, fontsize=15, weight='bold')
+
+        reg_name = os.path.join(self.nor_escena, os.path.split(banda)[1][:-4].replace('_g2_', '_gr2_'))+'.png'
+        reg_nname = reg_name.replace('gr2', 'grn2')
+        plt.savefig(reg_nname)
+        plt.show()
+
+
+    def _histograma_nor(self, banda, ajuste, bins=100):
+
+        """
+        Save compact diagnostics of a band fit instead of drawing them.
+
+        Stores the 2D histograms of the samples before and after the residual filter 
+        on a fixed [0, 1] grid, together with the parameters of both regressions, in 
+        a `_diag.npz` file next to `coeficientes.txt`. The figures are drawn later 
+        with `diagnosticos.dibujar_diagnosticos`.
+
+        Parameters
+        ----------
+        banda : str
+            Path to the band in `rad_escena`.
+
+        ajuste : dict
+            Fit returned by `_ajuste_nor`.
+
+        bins : int, optional
+            Number of bins per axis (default is 100).
+        """
+
+        rango = [[0, 1], [0, 1]]
+        antes, bordes, _ = np.histogram2d(ajuste['x'], ajuste['y'], bins=bins, range=rango)
+        despues, _, _ = np.histogram2d(ajuste['x2'], ajuste['y2'], bins=bins, range=rango)
+
+        nombre = os.path.split(banda)[1][:-4].replace('_g2_', '_gr2_').replace('gr2', 'grn2')
+        salida = os.path.join(self.nor_escena, nombre + '_diag.npz')
+
+        np.savez_compressed(salida, antes=antes.astype(np.int32), despues=despues.astype(np.int32), bordes=bordes,
+                            first_slope=ajuste['first_slope'], first_intercept=ajuste['first_intercept'],
+                            slope=ajuste['slope'], intercept=ajuste['intercept'], r=ajuste['r'], N=ajuste['N'],
+                            iter=self.iter, titulo=np.array(nombre + '. Iter: ' + str(self.iter)))
+        print('Diagnostico guardado en', salida)
+
+
     def nor2l8(self, banda, slope, intercept):
     
         """
@@ -998,6 +2745,8 @@ class Landsat:
         - Output values below 0 are clipped to 0.
         - Output values equal to or above 1 are clipped to 1.
         - NoData values (-9999) in the input are preserved in the output.
+        - If the object was created with `bloque`, the band is streamed in blocks 
+          of that many rows with in-place float32 arithmetic.
         """
                 
         print('estamos en nor2!')
@@ -1016,10 +2765,14 @@ class Landsat:
         print('Outfile', outFile)
         
         #Metemos la referencia para el NoData, vamos a coger la banda 5 en rad (... Y por que no?)
-        for i in os.listdir(self.rad_escena):
+        for clave, ruta in self.manifest.ficheros('rad').items():
             
-            if 'nir' in i:
-                ref = os.path.join(self.rad_escena, i)
+            if 'nir' in clave:
+                ref = ruta
+
+        if self.bloque:
+            self._nor2l8_por_bloques(banda, ref, outFile, slope, intercept)
+            return
         
         with rasterio.open(ref) as src:
             ref_rs = src.read()
@@ -1046,7 +2799,103 @@ class Landsat:
                 dst.write(rs.astype(rasterio.float32))
 
 
-    def run(self):
+    def _nor2l8_por_bloques(self, banda, ref, outFile, slope, intercept):
+
+        """
+        Windowed version of `nor2l8`, processing `self.bloque` rows at a time.
+
+        Parameters
+        ----------
+        banda : str
+            Path to the band in `rad_escena`.
+
+        ref : str
+            Band whose -9999 pixels mark NoData in the output (NIR).
+
+        outFile : str
+            Path to the normalized output band.
+
+        slope, intercept : float
+            Normalization equation.
+        """
+
+        with rasterio.open(banda) as src, rasterio.open(ref) as nodata:
+
+            profile = src.meta
+            profile.update(dtype=rasterio.float32)
+
+            with rasterio.open(outFile, 'w', **profile) as dst:
+                for ventana in ventanas(src.height, src.width, self.bloque):
+
+                    rs = src.read(1, window=ventana).astype(np.float32, copy=False)
+                    rs *= np.float32(slope)
+                    rs += np.float32(intercept)
+                    np.clip(rs, 0, 1, out=rs)
+                    rs[nodata.read(1, window=ventana) == -9999] = -9999
+
+                    dst.write(rs, 1, window=ventana)
+
+
+    def _es_geo(self, banda):
+
+        """Whether `banda` is an Int32 band of `geo_escena` (fused normalization) rather than a rad band."""
+
+        return os.path.dirname(banda) == self.geo_escena
+
+
+    def _nor_fusionado(self, banda, slope, intercept):
+
+        """
+        Write a normalized band straight from its geo band in a single pass.
+
+        Applies the SR scale/offset and clipping of `coef_sr_st` followed by the 
+        normalization equation and clipping of `nor2l8`, so the output matches 
+        `nor2l8` run on the rad band. It works in blocks of `self.bloque` rows, 
+        or over the whole band if `bloque` is not set.
+
+        Parameters
+        ----------
+        banda : str
+            Path to the Int32 band in `geo_escena`.
+
+        slope, intercept : float
+            Normalization equation.
+        """
+
+        outFile = os.path.join(self.nor_escena, os.path.split(banda)[1].replace('_g2_', '_grn2_'))
+        print('Outfile', outFile)
+
+        #Referencia para el NoData: la banda nir de geo, como en nor2l8 con la de rad
+        ref = [ruta for clave, ruta in self.manifest.ficheros('geo').items() if 'nir' in clave][0]
+
+        # En rad los NoData de la banda valen -9999 y nor2l8 los lleva a este valor
+        fondo = float(np.clip(-9999 * slope + intercept, 0, 1))
+
+        with rasterio.open(banda) as src, rasterio.open(ref) as nodata:
+
+            profile = src.meta
+            profile.update(dtype=rasterio.float32)
+
+            with rasterio.open(outFile, 'w', **profile) as dst:
+                for ventana in ventanas(src.height, src.width, self.bloque or src.height):
+
+                    DN = src.read(1, window=ventana)
+                    rs = DN.astype(np.float32)
+                    rs *= np.float32(SR_ESCALA)
+                    rs += np.float32(SR_OFFSET)
+                    np.clip(rs, 0, 1, out=rs)
+                    rs *= np.float32(slope)
+                    rs += np.float32(intercept)
+                    np.clip(rs, 0, 1, out=rs)
+                    rs[DN == -9999] = fondo
+                    DN = None
+                    rs[nodata.read(1, window=ventana) == -9999] = -9999
+
+                    dst.write(rs, 1, window=ventana)
+
+
+    def run(self, en_proceso=False, n_workers=None, diagnosticos='grafico', fusionado=False, reducido=False,
+            robusto=None, modelo=None, gapfill_recortado=False):
         """
         Execute the complete Landsat scene processing workflow.
     
@@ -1057,19 +2906,47 @@ class Landsat:
         The steps performed are:
     
         1. Generate a hillshade image using DTM and solar angles.
-        2. Compute cloud coverage within Doñana National Park.
-        3. Compute cloud coverage within Doñana Biosphere Reserve.
-        4. Delete temporary cloud mask files.
-        5. Apply gap-filling (only for Landsat 7 scenes post-SLC failure).
-        6. Reproject and clip spectral bands to a standard extent.
-        7. Apply surface reflectance and temperature coefficients.
-        8. Normalize all bands using pseudo-invariant features (PIFs) and a reference image.
+        2. Compute cloud coverage within Doñana National Park, Doñana Biosphere 
+           Reserve and each marsh polygon from a single read of QA_PIXEL.
+        3. Apply gap-filling (only for Landsat 7 scenes post-SLC failure).
+        4. Reproject and clip spectral bands to a standard extent.
+        5. Apply surface reflectance and temperature coefficients.
+        6. Normalize all bands using pseudo-invariant features (PIFs) and a reference image.
     
         Outputs are stored in the appropriate subdirectories:
         `pro` (products), `geo` (georeferenced), `rad` (radiometrically corrected),
         and `nor` (normalized).
     
         The method also updates MongoDB with relevant metadata and processing results.
+
+        Parameters
+        ----------
+        en_proceso : bool, optional
+            Run the geo stage through the in-process GDAL warp (see `projwin`).
+
+        n_workers : int, optional
+            Number of bands processed concurrently by the parallel stages.
+
+        diagnosticos : {'grafico', 'histograma'}, optional
+            How normalization diagnostics are saved (see `normalize`).
+
+        fusionado : bool, optional
+            Skip the rad reflectance bands and normalize straight from geo 
+            (see `normalize`).
+
+        reducido : bool, optional
+            Reduced pipeline for very cloudy scenes: cloud coverage and normalization 
+            only, without the hillshade that the products need.
+
+        robusto : {None, 'theilsen', 'ransac'}, optional
+            Robust subsampled normalization fits (see `normalize`).
+
+        modelo : {None, 'global', 'mezcla'}, optional
+            Per-PIA-class normalization models (see `normalize`).
+
+        gapfill_recortado : bool, optional
+            Fill Landsat 7 gaps only on the study window, bands in parallel 
+            (see `apply_gapfill`). Default is False, the full-band fill.
     
         Prints
         ------
@@ -1080,17 +2957,21 @@ class Landsat:
         RuntimeError
             If any critical step in the pipeline fails.
         """
+
+        self.preparar()
         
         t0 = time.time()
-        self.get_hillshade()
-        self.get_cloud_pn()
-        self.get_cloud_rbios()  # Added for Biosphere Reserve cloud coverage
-        self.remove_masks()
+        if not reducido:
+            self.get_hillshade()
+        self.get_cloud_zonas()
     
         # Apply gapfill if necessary
-        self.apply_gapfill()
+        self.apply_gapfill(recortado=gapfill_recortado, n_workers=n_workers)
         
-        self.projwin()
-        self.coef_sr_st()
-        self.normalize()
+        self.projwin(en_proceso=en_proceso, n_workers=n_workers)
+        self.coef_sr_st(reflectancia=not fusionado)
+        self.normalize(n_workers=n_workers, diagnosticos=diagnosticos, fusionado=fusionado, robusto=robusto,
+                       modelo=modelo)
+        # Sidecar con los ficheros de la escena para Product y los scripts de analisis
+        self.manifest.guardar(self.ruta_manifest)
         print('Escena finalizada en', abs(t0-time.time()), 'segundos')
@@ -0,0 +1,155 @@
+import numpy as np
+from functools import lru_cache
+
+
+
+# Clases de QA_PIXEL (Landsat Collection 2)
+RELLENO = 0
+DESPEJADO = 1
+AGUA = 2
+NUBE = 3
+SOMBRA = 4
+NIEVE = 5
+NUBE_DILATADA = 6
+CIRROS = 7
+DUDOSO = 8
+SIN_DATOS = 9  # Valores fuera de uint16, como el NoData -9999 de las bandas fmask de geo, rad y nor
+
+CLASES = {RELLENO: 'Relleno', DESPEJADO: 'Despejado', AGUA: 'Agua', NUBE: 'Nube', SOMBRA: 'Sombra',
+          NIEVE: 'Nieve', NUBE_DILATADA: 'Nube dilatada', CIRROS: 'Cirros', DUDOSO: 'Dudoso',
+          SIN_DATOS: 'Sin datos'}
+
+# Valor de relleno de QA_PIXEL en Collection 2 (solo el bit 0 activo)
+VALOR_RELLENO = 1
+
+
+@lru_cache(maxsize=None)
+def tabla_qa(sensor):
+
+    """Construye la tabla de consulta de 65536 entradas que clasifica los valores de QA_PIXEL.
+
+    Se parte de los píxeles sin flags de relleno, nubes, sombra o nieve y con las
+    confianzas de nube, sombra y nieve (y cirros en OLI) bajas. Son despejados si tienen
+    el bit de despejado (6) y no el de agua (7). Son agua si tienen el bit de agua y, en
+    OLI, también el de despejado; en TM y ETM+ el agua clara llega sin el bit 6. Con esto
+    las clases coinciden con los valores que se usaban hasta ahora: despejado 21824 y
+    agua 21952 en OLI, despejado 5440 y agua 5504 en TM y ETM+, y relleno solo el valor 1.
+    El resto de valores se asigna al flag de mayor prioridad (nube, sombra, nube dilatada,
+    nieve, cirros) o a `DUDOSO`.
+
+    Args:
+        sensor (str): 'OLI', 'ETM+' o 'TM'.
+
+    Returns:
+        numpy.ndarray: Tabla uint8 de solo lectura con la clase de cada valor de QA_PIXEL.
+    """
+
+    v = np.arange(65536, dtype=np.uint32)
+
+    def bit(n):
+        return ((v >> n) & 1).astype(bool)
+
+    def confianza(n):
+        return (v >> n) & 3
+
+    # TM y ETM+ no tienen banda de cirros y dejan su confianza a 0
+    cirros = 1 if sensor == 'OLI' else 0
+    limpio = (v & 0b111111 == 0) & (confianza(8) == 1) & (confianza(10) == 1) & \
+             (confianza(12) == 1) & (confianza(14) == cirros)
+
+    # El bit de despejado en el agua clara: activo en OLI, no en TM y ETM+
+    despejado_agua = bit(6) if sensor == 'OLI' else ~bit(6)
+
+    tabla = np.full(65536, DUDOSO, dtype=np.uint8)
+    tabla[limpio & bit(6) & ~bit(7)] = DESPEJADO
+    tabla[limpio & bit(7) & despejado_agua] = AGUA
+
+    # De menor a mayor prioridad, cada flag sobrescribe a los anteriores
+    if sensor == 'OLI':
+        tabla[bit(2)] = CIRROS
+    tabla[bit(5)] = NIEVE
+    tabla[bit(1)] = NUBE_DILATADA
+    tabla[bit(4)] = SOMBRA
+    tabla[bit(3)] = NUBE
+    tabla[VALOR_RELLENO] = RELLENO
+
+    tabla.setflags(write=False)
+    return tabla
+
+
+@lru_cache(maxsize=None)
+def tabla_mascara(sensor, clases=(DESPEJADO, AGUA)):
+
+    """Tabla booleana de 65536 entradas que es True para los valores de las clases indicadas.
+
+    Args:
+        sensor (str): 'OLI', 'ETM+' o 'TM'.
+        clases (tuple): Clases que forman la máscara. Por defecto despejado y agua.
+
+    Returns:
+        numpy.ndarray: Tabla booleana de solo lectura.
+    """
+
+    tabla = np.isin(tabla_qa(sensor), clases)
+    tabla.setflags(write=False)
+    return tabla
+
+
+def _como_indice(qa):
+
+    """Devuelve `qa` como índice uint16 de las tablas y la máscara de valores fuera de rango (o None).
+
+    Los valores negativos o mayores de 65535 (el NoData -9999 de las bandas Int32) no se
+    convierten con desbordamiento, que los confundiría con valores válidos de QA_PIXEL.
+    """
+
+    qa = np.asarray(qa)
+    fuera = None
+    if qa.dtype != np.uint16:
+        if qa.dtype.kind not in 'bu' or qa.dtype.itemsize > 2:
+            fuera = (qa < 0) | (qa > 65535)
+            if fuera.any():
+                qa = np.where(fuera, 0, qa)
+            else:
+                fuera = None
+        qa = qa.astype(np.uint16)
+    return qa, fuera
+
+
+def clasificar_qa(qa, sensor):
+
+    """Clasifica un array de QA_PIXEL con una sola consulta a la tabla del sensor.
+
+    Args:
+        qa (numpy.ndarray): Valores de QA_PIXEL.
+        sensor (str): 'OLI', 'ETM+' o 'TM'.
+
+    Returns:
+        numpy.ndarray: Array uint8 con las clases de `CLASES` (`SIN_DATOS` fuera de uint16).
+    """
+
+    indice, fuera = _como_indice(qa)
+    clases = tabla_qa(sensor)[indice]
+    if fuera is not None:
+        clases[fuera] = SIN_DATOS
+    return clases
+
+
+def mascara_qa(qa, sensor, clases=(DESPEJADO, AGUA)):
+
+    """Devuelve la máscara booleana de los píxeles de QA_PIXEL que pertenecen a `clases`.
+
+    Args:
+        qa (numpy.ndarray): Valores de QA_PIXEL.
+        sensor (str): 'OLI', 'ETM+' o 'TM'.
+        clases (tuple): Clases que forman la máscara. Por defecto despejado y agua.
+
+    Returns:
+        numpy.ndarray: Máscara booleana con la forma de `qa`.
+    """
+
+    indice, fuera = _como_indice(qa)
+    mascara = tabla_mascara(sensor, tuple(clases))[indice]
+    if fuera is not None:
+        mascara[fuera] = SIN_DATOS in clases
+    return mascara
@@ -0,0 +1,110 @@
+import os
+
+
+
+# Teselas WRS-2 (path_row) que procesa el protocolo.
+#   extent: ventana de estudio (xmin, ymin, xmax, ymax) en el CRS de la escena. None la calcula
+#           a partir de la huella WRS-2 y la RBIOS (ver Landsat.get_extent).
+#   referencia: escena normalizada de referencia con las bandas *_gr2_* en data.
+#   profundidad: escena de septiembre usada por el modelo de profundidad (water_mask_pv2).
+# Una tesela solo se activa cuando existen todos sus ficheros auxiliares (ver `config_tesela`:
+# escena de referencia, PIAs, DTM, capas estáticas y máscara de turbidez de water_mask_pv2,
+# recintos). 202_33 y 201_34 se añadirán así cuando estén preparados:
+#     '202_33': {'extent': None, 'referencia': '<escena>202_33', 'profundidad': '<escena>202_33'},
+TESELAS = {
+    '202_34': {'extent': (633570, 4053510, 851160, 4249530), 'referencia': '20220802l8oli202_34',
+               'profundidad': '20230930l9oli202_34'},
+}
+
+# Tesela original: sus ficheros auxiliares mantienen los nombres sin sufijo
+TESELA_PRINCIPAL = '202_34'
+
+
+class DatosTeselaError(FileNotFoundError):
+
+    """Falta un dato auxiliar de la tesela (escena de referencia, máscaras de agua, recintos...)."""
+
+
+def id_tesela(path, row):
+
+    """Devuelve el identificador 'PPP_RR' de una tesela a partir de su path y row.
+
+    Args:
+        path (str or int): Path WRS-2 (p.ej. '202').
+        row (str or int): Row WRS-2 (p.ej. '034' o '34').
+
+    Returns:
+        str: Identificador de la tesela, p.ej. '202_34'.
+    """
+
+    return '{}_{}'.format(int(path), int(row))
+
+
+def config_tesela(tesela, data):
+
+    """Devuelve la configuración de una tesela con las rutas de sus ficheros auxiliares.
+
+    Los ficheros de la tesela principal (202_34) mantienen sus nombres históricos; en el
+    resto se añade el sufijo '_PPP_RR' a los que no lo llevaban (PIAs, máscara de turbidez,
+    recintos, cachés).
+
+    Una tesela que no está en `TESELAS` (escenas sueltas) recibe las mismas rutas pero sin
+    extent, referencia ni profundidad, de modo que Landsat y Product se pueden crear y son
+    los pasos que necesitan esos datos los que lanzan `DatosTeselaError` (ver `requerir`).
+
+    Args:
+        tesela (str): Identificador 'PPP_RR'.
+        data (str): Ruta a la carpeta data del protocolo.
+
+    Returns:
+        dict: Configuración de la tesela (`id`, `configurada`, `extent`, `referencia`,
+            `profundidad`) y rutas a `wrs`, `dtm`, `equilibrada`, `noequilibrada`,
+            `water_mask_turb`, `recintos`, `pias_store`, `zonas_nubes` y `hillshades`.
+    """
+
+    path, row = tesela.split('_')
+    sufijo = '' if tesela == TESELA_PRINCIPAL else '_' + tesela
+
+    config = dict(TESELAS.get(tesela, {'extent': None, 'referencia': None, 'profundidad': None}))
+    config.update({
+        'id': tesela,
+        'configurada': tesela in TESELAS,
+        'wrs': os.path.join(data, 'wrs_{}{:03d}.shp'.format(path, int(row))),
+        'dtm': os.path.join(data, 'dtm_{}.tif'.format(tesela)),
+        'equilibrada': os.path.join(data, 'Equilibrada{}.tif'.format(sufijo)),
+        'noequilibrada': os.path.join(data, 'NoEquilibrada{}.tif'.format(sufijo)),
+        'water_mask_turb': os.path.join(data, 'water_mask_pv2', 'water_mask_turb{}.tif'.format(sufijo)),
+        'recintos': os.path.join(data, 'Recintos_Marisma{}.shp'.format(sufijo)),
+        'pias_store': os.path.join(data, 'pias_store{}.npz'.format(sufijo)),
+        'zonas_nubes': os.path.join(data, 'zonas_nubes{}.npz'.format(sufijo)),
+        'hillshades': os.path.join(data, 'hillshades{}'.format(sufijo)),
+    })
+
+    return config
+
+
+def requerir(config, *rutas):
+
+    """Comprueba que existen los ficheros auxiliares de una tesela antes de usarlos.
+
+    Args:
+        config (dict): Configuración devuelta por `config_tesela`.
+        *rutas (str): Claves de `config` (p.ej. 'water_mask_turb') o rutas de ficheros.
+
+    Returns:
+        list: Rutas comprobadas, en el mismo orden.
+
+    Raises:
+        DatosTeselaError: Si alguna clave no está configurada o algún fichero no existe.
+    """
+
+    comprobadas = []
+    for ruta in rutas:
+        if ruta in config:
+            if not config[ruta]:
+                raise DatosTeselaError('La tesela {} no tiene configurado {}'.format(config['id'], ruta))
+            ruta = config[ruta]
+        if not os.path.exists(ruta):
+            raise DatosTeselaError('Falta el fichero {} de la tesela {}'.format(ruta, config['id']))
+        comprobadas.append(ruta)
+    return comprobadas
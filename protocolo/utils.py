@@ -863,15 +863,15 @@ def subir_xml_y_tif_a_geonetwork(xml_path, tif_path, username, password, quicklo
 import os
 import shutil
 from datetime import datetime
-from pymongo import MongoClient
+from conexion import Perezosa
+from enlaces import enlazar
 
 # Conexión a la base de datos MongoDB
-client = MongoClient()
-database = client.Satelites
-db = database.Landsat
+database = Perezosa('Satelites')
+db = Perezosa('Satelites', 'Landsat')
 
 # Nueva colección para hidroperiodo
-db_hidroperiodo = database.Hidroperiodo
+db_hidroperiodo = Perezosa('Satelites', 'Hidroperiodo')
 
 def prepare_hydrop(productos_dir, output_dir, ciclo_hidrologico, umbral_nubes):
 
@@ -937,11 +937,11 @@ def prepare_hydrop(productos_dir, output_dir, ciclo_hidrologico, umbral_nubes):
                         # Buscar el archivo '_flood.tif' dentro de la carpeta de la escena
                         for archivo in os.listdir(escena_dir):
                             if archivo.endswith('_flood.tif'):
-                                # Copiar el archivo al directorio del ciclo hidrológico
+                                # Enlazar (o copiar) el archivo al directorio del ciclo hidrológico
                                 archivo_src = os.path.join(escena_dir, archivo)
                                 archivo_dst = os.path.join(ciclo_output_dir, archivo)
-                                shutil.copy2(archivo_src, archivo_dst)
-                                print(f"Archivo '{archivo}' copiado a '{ciclo_output_dir}'")
+                                metodo = enlazar(archivo_src, archivo_dst)
+                                print(f"Archivo '{archivo}' enlazado en '{ciclo_output_dir}' ({metodo})")
 
                                 # Añadir la escena con sus datos a la lista de escenas válidas
                                 escenas_validas.append({
@@ -1169,7 +1169,7 @@ if __name__ == "__main__":
 
 import geopandas as gpd
 import rasterio
-from rasterio.mask import mask
+from rasterio.mask import mask, raster_geometry_mask
 from matplotlib.patches import Patch
 import numpy as np
 import matplotlib.pyplot as plt
@@ -1232,15 +1232,34 @@ def add_legend(ax, legend_type="rgb", line_width=2):
     ax.legend(handles=legend_elements, loc='lower left', fontsize=10, frameon=False, bbox_to_anchor=(0.1, 0.1))
 
 
-def process_composition_rgb(swir1, nir, blue, shape, output_path):
+def recortar(src, geometry, datos=None):
+    """
+    Recorta un raster a las geometrías como `rasterio.mask.mask(crop=True)`.
+
+    Si se pasa `datos` (la banda completa ya leída) el recorte se hace sobre el array y del
+    fichero solo se usan los metadatos.
+    """
+    if datos is None:
+        return mask(src, geometry, crop=True)
+
+    fuera, transform, ventana = raster_geometry_mask(src, geometry, crop=True)
+    recorte = np.array(datos[ventana.toslices()])
+    recorte[fuera] = src.nodata if src.nodata is not None else 0
+    return recorte[np.newaxis], transform
+
+
+def process_composition_rgb(swir1, nir, blue, shape, output_path, bandas=None):
     """
     Procesa la composición RGB y guarda la visualización.
+
+    `bandas` es un diccionario opcional ruta -> array con bandas ya leídas (caché de Product).
     """
+    bandas = bandas or {}
     with rasterio.open(swir1) as src_swir1, rasterio.open(nir) as src_nir, rasterio.open(blue) as src_blue:
         geometry = gpd.read_file(shape).geometry.values
-        swir1, _ = mask(src_swir1, geometry, crop=True)
-        nir, _ = mask(src_nir, geometry, crop=True)
-        blue, transform = mask(src_blue, geometry, crop=True)
+        swir1, _ = recortar(src_swir1, geometry, bandas.get(swir1))
+        nir, _ = recortar(src_nir, geometry, bandas.get(nir))
+        blue, transform = recortar(src_blue, geometry, bandas.get(blue))
 
         # Escalar y combinar bandas
         swir1_scaled = np.clip((swir1[0] - 0) / (0.45 - 0), 0, 1)
@@ -0,0 +1,47 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+gpd = pytest.importorskip('geopandas')
+pytest.importorskip('osgeo')
+from rasterio.features import rasterize
+from rasterio.transform import Affine
+from shapely.geometry import box
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'protocolo'))
+from protocolov2 import Landsat, RES
+
+
+# Malla de salida de 100x100 píxeles en UTM 29N
+CRS_ESCENA = 'EPSG:32629'
+EXTENT = (700000, 4100000, 703000, 4103000)
+HUELLA = box(700600, 4100600, 702400, 4102400)
+
+
+def _landsat():
+
+    escena = Landsat.__new__(Landsat)
+    escena.get_extent = lambda: EXTENT
+    return escena
+
+
+def _esperada():
+
+    xmin, ymin, xmax, ymax = EXTENT
+    shape = (int((ymax - ymin) / RES), int((xmax - xmin) / RES))
+    return rasterize([(HUELLA, 1)], out_shape=shape, transform=Affine(RES, 0, xmin, 0, -RES, ymax),
+                     fill=0, dtype='uint8').astype(bool)
+
+
+@pytest.mark.parametrize('crs_wrs', [CRS_ESCENA, 'EPSG:4326', 'EPSG:25830'])
+def test_cutline_reproyectado(tmp_path, crs_wrs):
+
+    wrs = str(tmp_path / 'wrs.shp')
+    gpd.GeoDataFrame(geometry=[HUELLA], crs=CRS_ESCENA).to_crs(crs_wrs).to_file(wrs)
+
+    cutline = _landsat()._cutline_mask(wrs, CRS_ESCENA)
+
+    assert cutline.shape == (100, 100)
+    assert np.array_equal(cutline, _esperada())
@@ -0,0 +1,46 @@
+import os
+import sys
+import tarfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'protocolo'))
+from manifest import SceneManifest
+
+
+ESCENA = 'LE07_L2SP_202034_20220110_20220205_02_T1'
+
+
+def _manifiesto(tmp_path):
+
+    fuente = tmp_path / 'fuente'
+    fuente.mkdir()
+    (fuente / (ESCENA + '_SR_B1.TIF')).write_bytes(b'banda1')
+    tar = str(tmp_path / (ESCENA + '.tar'))
+    with tarfile.open(tar, 'w') as t:
+        t.add(str(fuente / (ESCENA + '_SR_B1.TIF')), ESCENA + '_SR_B1.TIF')
+
+    return SceneManifest({'ori': str(tmp_path / 'ori')}, ESCENA, tars={'ori': tar})
+
+
+def test_existe_con_rutas_del_tar(tmp_path):
+
+    manifiesto = _manifiesto(tmp_path)
+    ruta = manifiesto.ruta('ori', 'SR_B1')
+
+    assert ruta.startswith('/vsitar/') and not os.path.exists(ruta)
+    assert manifiesto.existe('ori', ruta)
+    assert not manifiesto.existe('ori', ruta.replace('SR_B1', 'SR_B2'))
+    assert not manifiesto.existe('ori', None)
+
+
+def test_copiar_desde_el_tar_y_extraido(tmp_path):
+
+    manifiesto = _manifiesto(tmp_path)
+    ruta = manifiesto.ruta('ori', 'SR_B1')
+
+    copia = manifiesto.copiar('ori', ruta, str(tmp_path / 'copia.tif'))
+    assert open(copia, 'rb').read() == b'banda1'
+
+    manifiesto.extraer('ori', ['SR_B1'])
+    extraida = manifiesto.ruta('ori', 'SR_B1')
+    assert os.path.exists(extraida) and manifiesto.existe('ori', extraida)
+    assert open(manifiesto.copiar('ori', extraida, str(tmp_path / 'copia2.tif')), 'rb').read() == b'banda1'
@@ -0,0 +1,115 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('geopandas')
+pytest.importorskip('osgeo')
+pytest.importorskip('fiona')
+pytest.importorskip('rasterstats')
+import rasterio
+from rasterio.transform import from_origin
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'protocolo'))
+try:
+    import productos
+except Exception as e:  # utils.py lee capas de /mnt/datos_last al importarse
+    pytest.skip('productos no se puede importar: {}'.format(e), allow_module_level=True)
+
+
+ALTO, ANCHO = 12, 7
+TRANSFORM = from_origin(0, ALTO * 30, 30, 30)
+CRS = 'EPSG:32629'
+
+
+class BaseDatos:
+
+    def update_one(self, *args, **kwargs):
+        pass
+
+
+class Parar(Exception):
+    pass
+
+
+class Contador(productos.Product):
+
+    """Product que anota el mayor número de arrays que ha tenido a la vez en la caché."""
+
+    def _guardar_banda(self, nombre, datos, perfil=None):
+        super()._guardar_banda(nombre, datos, perfil)
+        self.pico = max(self.pico, len(self._bandas))
+
+    def turbidity(self):
+        # run se detiene aquí: solo interesa la caché hasta flood
+        self.pico_flood = self.pico
+        raise Parar()
+
+
+def _raster(ruta, datos, nodata=-9999, **tags):
+
+    with rasterio.open(ruta, 'w', driver='GTiff', height=ALTO, width=ANCHO, count=1, dtype=datos.dtype,
+                       crs=CRS, transform=TRANSFORM, nodata=nodata) as dst:
+        dst.write(datos, 1)
+        dst.update_tags(**tags)
+    return ruta
+
+
+def _producto(tmp_path, nombre):
+
+    rng = np.random.default_rng(0)
+    carpeta = tmp_path / nombre
+    carpeta.mkdir()
+
+    producto = Contador.__new__(Contador)
+    producto.pico = 0
+    producto.escena = '20240115l9oli202_34'
+    producto.pro_escena = str(carpeta)
+    producto.water_masks = str(tmp_path)
+    producto.tesela = {'id': '202_34'}
+    producto.sensor = 'OLI'
+    producto.clases_validas = (productos.DESPEJADO, productos.AGUA)
+    producto.voto_agua = (productos.AGUA,)
+    producto.memmap = False
+    producto._bandas, producto._metadatos, producto._memmaps = {}, {}, []
+    producto.productos_generados = []
+
+    for banda in ('blue', 'green', 'red', 'nir', 'swir1', 'swir2'):
+        datos = rng.uniform(0, 0.4, (ALTO, ANCHO)).astype(np.float32)
+        datos[0, :2] = -9999
+        setattr(producto, banda, _raster(str(tmp_path / (banda + '.tif')), datos))
+    fmask = rng.choice(np.array([21824, 21952, 22280], dtype=np.uint16), (ALTO, ANCHO))
+    producto.fmask = _raster(str(tmp_path / 'fmask.tif'), fmask, nodata=None)
+    hillshade = rng.integers(0, 255, (ALTO, ANCHO), dtype=np.uint8)
+    producto.hillshade = _raster(str(tmp_path / 'hillshade.tif'), hillshade, nodata=None, UMBRAL_SOMBRA='60')
+
+    return producto
+
+
+@pytest.fixture
+def escena(tmp_path, monkeypatch):
+
+    estatico = np.zeros((ALTO, ANCHO), dtype=np.uint8)
+    estatico[3, 3] = productos.EXCLUIDO
+    monkeypatch.setattr(productos, 'exclusion_estatica',
+                        lambda *args: (estatico, {'crs': rasterio.crs.CRS.from_string(CRS), 'transform': TRANSFORM}))
+    monkeypatch.setattr(productos, 'db', BaseDatos())
+    return tmp_path
+
+
+def test_run_por_bloques_no_cachea_hasta_turbidity(escena):
+
+    completo = _producto(escena, 'completo')
+    completo.run()
+    bloques = _producto(escena, 'bloques')
+    bloques.run(filas_flood=5)
+
+    # Sin filas_flood la caché tiene las bandas y los índices; con filas_flood, nada
+    assert completo.pico_flood >= 6
+    assert bloques.pico_flood == 0
+
+    for sufijo in ('_ndvi_.tif', '_ndwi.tif', '_mndwi.tif', '_flood.tif'):
+        with rasterio.open(os.path.join(completo.pro_escena, completo.escena + sufijo)) as a, \
+                rasterio.open(os.path.join(bloques.pro_escena, bloques.escena + sufijo)) as b:
+            np.testing.assert_array_equal(a.read(1), b.read(1))
@@ -0,0 +1,43 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('geopandas')
+pytest.importorskip('osgeo')
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'protocolo'))
+from protocolov2 import Landsat, regresion_lineal, theil_sen, ransac
+
+
+ESTIMADORES = [regresion_lineal, theil_sen, ransac]
+
+
+@pytest.mark.parametrize('estimador', ESTIMADORES)
+@pytest.mark.parametrize('x', [np.zeros(0), np.ones(1), np.full(5, 0.2)])
+def test_muestras_insuficientes(estimador, x):
+
+    slope, intercept, r = estimador(x, x.copy())
+
+    assert np.isnan(slope) and np.isnan(intercept) and np.isnan(r)
+
+
+@pytest.mark.parametrize('estimador', ESTIMADORES)
+def test_recta_exacta(estimador):
+
+    x = np.linspace(0, 1, 50)
+    slope, intercept, r = estimador(x, 2 * x + 1)
+
+    assert slope == pytest.approx(2) and intercept == pytest.approx(1) and r == pytest.approx(1)
+
+
+@pytest.mark.parametrize('robusto', [None, 'theilsen', 'ransac'])
+@pytest.mark.parametrize('n', [0, 1])
+def test_ajuste_nor_fallido(robusto, n):
+
+    escena = Landsat.__new__(Landsat)
+    x = np.full(n, 0.1)
+    ajuste = escena._ajuste_nor(x, x, np.ones(n, dtype=np.int64), robusto=robusto)
+
+    assert not escena._ajuste_valido(ajuste)
@@ -0,0 +1,46 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'protocolo'))
+from teselas import TESELAS, TESELA_PRINCIPAL, DatosTeselaError, config_tesela, id_tesela, requerir
+
+
+def test_tesela_principal_mantiene_nombres(tmp_path):
+
+    config = config_tesela(TESELA_PRINCIPAL, str(tmp_path))
+
+    assert config['configurada']
+    assert config['extent'] == TESELAS[TESELA_PRINCIPAL]['extent']
+    assert config['recintos'] == os.path.join(str(tmp_path), 'Recintos_Marisma.shp')
+    assert config['water_mask_turb'] == os.path.join(str(tmp_path), 'water_mask_pv2', 'water_mask_turb.tif')
+
+
+def test_tesela_desconocida_no_falla_al_configurar(tmp_path):
+
+    tesela = id_tesela('201', '034')
+    config = config_tesela(tesela, str(tmp_path))
+
+    assert tesela == '201_34' and tesela not in TESELAS
+    assert not config['configurada']
+    assert config['extent'] is None and config['referencia'] is None and config['profundidad'] is None
+    assert config['recintos'] == os.path.join(str(tmp_path), 'Recintos_Marisma_201_34.shp')
+
+
+def test_tesela_desconocida_falla_al_usar_sus_datos(tmp_path):
+
+    config = config_tesela('201_34', str(tmp_path))
+
+    with pytest.raises(DatosTeselaError, match='no tiene configurado referencia'):
+        requerir(config, 'referencia')
+    with pytest.raises(DatosTeselaError, match='201_34'):
+        requerir(config, 'water_mask_turb')
+
+
+def test_requerir_devuelve_rutas(tmp_path):
+
+    config = config_tesela('201_34', str(tmp_path))
+    open(config['recintos'], 'w').close()
+
+    assert requerir(config, 'recintos') == [config['recintos']]
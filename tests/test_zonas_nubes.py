@@ -0,0 +1,63 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+gpd = pytest.importorskip('geopandas')
+pytest.importorskip('osgeo')
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import box
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'protocolo'))
+from protocolov2 import Landsat
+
+
+CRS = 'EPSG:32629'
+
+
+def _escena(tmp_path):
+
+    data = tmp_path / 'data'
+    data.mkdir()
+    gpd.GeoDataFrame(geometry=[box(0, 0, 3000, 3000)], crs=CRS).to_file(str(data / 'Limites_PN_Donana.shp'))
+    gpd.GeoDataFrame(geometry=[box(0, 0, 6000, 6000)], crs=CRS).to_file(str(data / 'RBIOS.shp'))
+    # Dos poligonos con el mismo nombre y uno distinto
+    gpd.GeoDataFrame({'Nombre': ['A', 'A', 'B']},
+                     geometry=[box(0, 0, 300, 300), box(600, 600, 900, 900), box(1200, 1200, 1500, 1500)],
+                     crs=CRS).to_file(str(data / 'Recintos_Marisma.shp'))
+
+    qa = str(tmp_path / 'qa.tif')
+    with rasterio.open(qa, 'w', driver='GTiff', width=200, height=200, count=1, dtype='uint16', crs=CRS,
+                       transform=from_origin(0, 6000, 30, 30)) as dst:
+        dst.write(np.ones((200, 200), dtype=np.uint16), 1)
+
+    escena = Landsat.__new__(Landsat)
+    escena.data = str(data)
+    escena.tesela = {'zonas_nubes': str(data / 'zonas_nubes.npz'), 'recintos': str(data / 'Recintos_Marisma.shp')}
+    return escena, qa
+
+
+def test_recintos_con_el_mismo_nombre(tmp_path):
+
+    escena, qa = _escena(tmp_path)
+    with rasterio.open(qa) as src:
+        zonas = escena._zonas_nubes(src)
+
+    assert sorted(zonas['indices']) == ['PN', 'RBIOS', 'Recintos/A', 'Recintos/B']
+    assert zonas['indices']['Recintos/A'].size == 2 * zonas['indices']['Recintos/B'].size == 200
+
+
+def test_cache_compartida_con_y_sin_recintos(tmp_path):
+
+    escena, qa = _escena(tmp_path)
+    with rasterio.open(qa) as src:
+        escena._zonas_nubes(src, recintos=True)
+        mtime = os.stat(escena.tesela['zonas_nubes']).st_mtime_ns
+        sin = escena._zonas_nubes(src, recintos=False)
+        con = escena._zonas_nubes(src, recintos=True)
+
+    assert os.stat(escena.tesela['zonas_nubes']).st_mtime_ns == mtime
+    assert sorted(sin['indices']) == ['PN', 'RBIOS']
+    assert 'Recintos/A' in con['indices']